@@ -0,0 +1,362 @@
+#!/usr/bin/python
+
+from __future__ import division, print_function
+
+import os.path as op
+import sys
+
+# use the clodius in this checkout, even if it isn't installed
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+
+import argparse
+import clodius.cli.aggregate as cca
+import clodius.db_tiles as cdt
+import clodius.fast as cf
+import clodius.hdf_tiles as hdft
+import clodius.stats as cs
+import datetime
+import h5py
+import json
+import negspy.coordinates as nc
+import numpy as np
+import os
+import platform
+import pyBigWig as pbw
+import random
+import subprocess
+import time
+
+# the number of bases covered by the synthetic data sets, the largest
+# covers all of hg19
+SIZES = [
+        ('10m', 10 ** 7),
+        ('100m', 10 ** 8),
+        ('1g', 10 ** 9),
+        ('genome', None)
+        ]
+
+def get_chromsizes(size):
+    '''
+    Get the hg19 chromosomes which cover the first `size` bases of the
+    genome, truncating the last one.
+
+    :param size: The number of bases to cover, None for the whole genome
+    :return: A list of (chrom, length) tuples
+    '''
+    chrom_info = nc.get_chrominfo('hg19')
+    chromsizes = []
+    total = 0
+
+    for chrom in nc.get_chromorder('hg19'):
+        length = chrom_info.chrom_lengths[chrom]
+
+        if size is not None:
+            length = min(length, size - total)
+        if length <= 0:
+            break
+
+        chromsizes += [(chrom, length)]
+        total += length
+
+    return chromsizes
+
+def get_intervals(chromsizes, spacing, max_width, rng):
+    '''
+    Generate non-overlapping intervals roughly every `spacing` bases.
+
+    :return: A list of (chrom, starts, ends) tuples
+    '''
+    intervals = []
+
+    for (chrom, length) in chromsizes:
+        starts = np.arange(0, length - spacing, spacing) + rng.randint(0, spacing // 2)
+        ends = starts + rng.randint(1, max_width, len(starts))
+        intervals += [(chrom, starts, ends)]
+
+    return intervals
+
+def make_data(data_dir, size_name, size):
+    '''
+    Create the synthetic input files for one size, unless they already
+    exist.
+
+    :return: A dictionary of filenames
+    '''
+    prefix = op.join(data_dir, size_name)
+    files = {
+            'chromsizes': prefix + '.chromSizes',
+            'bigwig': prefix + '.bw',
+            'bedgraph': prefix + '.bedGraph',
+            'bedfile': prefix + '.bed',
+            'bedfile_dense': prefix + '.dense.bed',
+            'bedpe': prefix + '.bedpe'
+            }
+
+    if all([op.exists(f) for f in files.values()]):
+        return files
+
+    rng = np.random.RandomState(0)
+    chromsizes = get_chromsizes(size)
+
+    with open(files['chromsizes'], 'w') as f:
+        for (chrom, length) in chromsizes:
+            f.write('{}\t{}\n'.format(chrom, length))
+
+    # a signal track with a peak every 1kb
+    signal = get_intervals(chromsizes, 1000, 500, rng)
+
+    bwf = pbw.open(files['bigwig'], 'w')
+    bwf.addHeader(chromsizes)
+    with open(files['bedgraph'], 'w') as f:
+        for (chrom, starts, ends) in signal:
+            values = rng.random_sample(len(starts))
+
+            bwf.addEntries([chrom] * len(starts), starts.tolist(),
+                    ends=ends.tolist(), values=values.tolist())
+            for (start, end, value) in zip(starts, ends, values):
+                f.write('{}\t{}\t{}\t{:.4f}\n'.format(chrom, start, end, value))
+    bwf.close()
+
+    # an annotation every 100kb
+    annotations = get_intervals(chromsizes, 100000, 50000, rng)
+
+    with open(files['bedfile'], 'w') as f:
+        for (chrom, starts, ends) in annotations:
+            for (i, (start, end)) in enumerate(zip(starts, ends)):
+                f.write('{}\t{}\t{}\tgene{}\t{}\t+\n'.format(chrom, start, end, i,
+                    rng.randint(0, 1000)))
+
+    # an annotation every 1kb (about 3 million for the whole genome), to
+    # check that assigning them to zoom levels scales linearly
+    dense_annotations = get_intervals(chromsizes, 1000, 5000, rng)
+
+    with open(files['bedfile_dense'], 'w') as f:
+        for (chrom, starts, ends) in dense_annotations:
+            for (i, (start, end)) in enumerate(zip(starts, ends)):
+                f.write('{}\t{}\t{}\tfeature{}\t{}\t+\n'.format(chrom, start, end, i,
+                    rng.randint(0, 1000)))
+
+    # a pair of regions every 100kb
+    with open(files['bedpe'], 'w') as f:
+        for (chrom, starts, ends) in annotations:
+            for (start, end) in zip(starts, ends):
+                (chrom2, starts2, ends2) = annotations[rng.randint(len(annotations))]
+                j = rng.randint(len(starts2))
+
+                f.write('{}\t{}\t{}\t{}\t{}\t{}\n'.format(chrom, start, end,
+                    chrom2, starts2[j], ends2[j]))
+
+    return files
+
+def get_genome_length(files):
+    with open(files['chromsizes'], 'r') as f:
+        return sum([int(line.split()[1]) for line in f])
+
+def aggregate(args, output_file):
+    cca.cli.main(args=['aggregate'] + args + ['--output-file', output_file],
+            standalone_mode=False)
+
+    return {'output_size': op.getsize(output_file)}
+
+def benchmark_aggregate_bigwig(files, output_file):
+    return aggregate(['bigwig', files['bigwig'],
+        '--chromsizes-filename', files['chromsizes']], output_file)
+
+def benchmark_aggregate_bigwig_intervals(files, output_file):
+    return aggregate(['bigwig', files['bigwig'], '--use-intervals',
+        '--chromsizes-filename', files['chromsizes']], output_file)
+
+def benchmark_aggregate_bedgraph(files, output_file):
+    return aggregate(['bedgraph', files['bedgraph'],
+        '--chromsizes-filename', files['chromsizes']], output_file)
+
+def benchmark_aggregate_bedfile(files, output_file):
+    return aggregate(['bedfile', files['bedfile'], '--importance-column', '5',
+        '--chromsizes-filename', files['chromsizes']], output_file)
+
+def benchmark_aggregate_bedfile_dense(files, output_file):
+    return aggregate(['bedfile', files['bedfile_dense'], '--importance-column', '5',
+        '--chromsizes-filename', files['chromsizes']], output_file)
+
+def benchmark_aggregate_bedpe(files, output_file):
+    return aggregate(['bedpe', files['bedpe'], '--assembly', 'hg19'], output_file)
+
+def benchmark_hdf_tiles(files, input_file, num_tiles=1000):
+    random.seed(0)
+    genome_length = get_genome_length(files)
+
+    with h5py.File(input_file, 'r') as f:
+        max_zoom = int(f['meta'].attrs['max-zoom'])
+        max_width = int(f['meta'].attrs['max-width'])
+
+        for i in range(num_tiles):
+            # only request tiles which overlap the data
+            z = random.randint(0, max_zoom)
+            num_data_tiles = int(np.ceil(genome_length * 2 ** z / max_width))
+
+            hdft.get_data(f, z, random.randint(0, num_data_tiles - 1))
+
+    return {'tiles': num_tiles}
+
+def benchmark_db_tiles(files, input_file, num_tiles=1000):
+    random.seed(0)
+    genome_length = get_genome_length(files)
+    tileset_info = cdt.get_tileset_info(input_file)
+
+    for i in range(num_tiles):
+        z = random.randint(0, tileset_info['max_zoom'])
+        num_data_tiles = int(np.ceil(genome_length * 2 ** z / tileset_info['max_width']))
+
+        cdt.get_tiles(input_file, z, random.randint(0, num_data_tiles - 1))
+
+    return {'tiles': num_tiles}
+
+def benchmark_fast_aggregate(files, output_file):
+    # at most 1GB of values
+    length = min(get_genome_length(files), 2.5 * 10 ** 8)
+
+    values = np.random.RandomState(0).random_sample(int(length)).astype(np.float32)
+    cf.aggregate(values, 256)
+
+    return {'values': int(length)}
+
+# name: (function, the benchmark whose output it reads). Benchmarks that
+# don't read another benchmark's output are passed their own output file
+BENCHMARKS = [
+        ('aggregate_bigwig', (benchmark_aggregate_bigwig, None)),
+        ('aggregate_bigwig_intervals', (benchmark_aggregate_bigwig_intervals, None)),
+        ('aggregate_bedgraph', (benchmark_aggregate_bedgraph, None)),
+        ('aggregate_bedfile', (benchmark_aggregate_bedfile, None)),
+        ('aggregate_bedfile_dense', (benchmark_aggregate_bedfile_dense, None)),
+        ('aggregate_bedpe', (benchmark_aggregate_bedpe, None)),
+        ('hdf_tiles', (benchmark_hdf_tiles, 'aggregate_bigwig')),
+        ('db_tiles', (benchmark_db_tiles, 'aggregate_bedfile')),
+        ('fast_aggregate', (benchmark_fast_aggregate, None))
+        ]
+
+def get_output_file(data_dir, name, size_name):
+    return op.join(data_dir, '{}.{}.out'.format(size_name, name))
+
+def run_benchmark(name, files, data_dir, size_name):
+    '''
+    Run a single benchmark and print its results as JSON. Meant to be run
+    in a fresh interpreter (see run_in_process) so that the peak RSS only
+    covers this benchmark.
+    '''
+    # the aggregation functions are quite talkative
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+    (function, reads) = dict(BENCHMARKS)[name]
+
+    t1 = time.time()
+    result = function(files, get_output_file(data_dir, reads or name, size_name))
+    result['seconds'] = time.time() - t1
+    result['peak_rss'] = cs.get_peak_rss()
+
+    print(json.dumps(result), file=stdout)
+
+def run_in_process(name, files, data_dir, size_name, timeout):
+    # a forked process would start out with (and report) the parent's
+    # memory, so each benchmark gets a new interpreter
+    try:
+        output = subprocess.check_output([sys.executable, op.abspath(__file__),
+            '--run-one', name, '--files', json.dumps(files),
+            '--data-dir', data_dir, '--sizes', size_name], timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {'status': 'timeout'}
+    except subprocess.CalledProcessError:
+        return {'status': 'error'}
+
+    return dict(json.loads(output.decode('utf-8').strip().split('\n')[-1]),
+            status='ok')
+
+def get_metadata():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=op.dirname(op.abspath(__file__))).decode('utf-8').strip()
+    except (subprocess.CalledProcessError, OSError):
+        commit = None
+
+    return {
+            'date': datetime.datetime.now().isoformat(),
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'h5py': h5py.__version__
+            }
+
+def main():
+    parser = argparse.ArgumentParser(description="""
+
+    python benchmarks/run_benchmarks.py [--sizes 10m,100m] [--output results.json]
+
+    Generate synthetic data sets of increasing size, time the clodius
+    aggregation commands and tile readers on them and record the time,
+    peak RSS and output size of each as JSON.
+""")
+
+    parser.add_argument('--sizes', default='10m,100m',
+            help="Which data set sizes to use, out of: " +
+            ",".join([s[0] for s in SIZES]))
+    parser.add_argument('--benchmarks', default=None,
+            help="Which benchmarks to run (default: all), out of: " +
+            ",".join([b[0] for b in BENCHMARKS]))
+    parser.add_argument('--data-dir', default='/tmp/clodius-benchmarks',
+            help="Where to store the generated data and the outputs")
+    parser.add_argument('--timeout', default=3600, type=int,
+            help="The maximum number of seconds to let each benchmark run")
+    parser.add_argument('--output', default=None,
+            help="The file to write the results to (default: stdout)")
+    parser.add_argument('--run-one', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--files', default=None, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.run_one is not None:
+        run_benchmark(args.run_one, json.loads(args.files), args.data_dir, args.sizes)
+        return
+
+    sizes = dict(SIZES)
+    benchmark_names = [b[0] for b in BENCHMARKS]
+
+    if args.benchmarks is not None:
+        benchmark_names = [b for b in benchmark_names if b in args.benchmarks.split(',')]
+
+    if not op.exists(args.data_dir):
+        os.makedirs(args.data_dir)
+
+    results = []
+
+    for size_name in args.sizes.split(','):
+        print("generating data:", size_name, file=sys.stderr)
+        files = make_data(args.data_dir, size_name, sizes[size_name])
+        finished = set()
+
+        for name in benchmark_names:
+            reads = dict(BENCHMARKS)[name][1]
+
+            # the readers need the output of one of the aggregations
+            if reads is not None and reads not in finished:
+                if not op.exists(get_output_file(args.data_dir, reads, size_name)):
+                    run_in_process(reads, files, args.data_dir, size_name, args.timeout)
+
+            print("running:", name, size_name, file=sys.stderr)
+            result = run_in_process(name, files, args.data_dir, size_name, args.timeout)
+            result.update({'benchmark': name, 'size': size_name})
+            results += [result]
+            finished.add(name)
+
+            print(json.dumps(result), file=sys.stderr)
+
+    output = json.dumps({'meta': get_metadata(), 'results': results}, indent=2)
+
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import division, print_function
 import click
+import clodius.stats as cs
 
 
 # Monkey patch
@@ -11,10 +12,51 @@ CONTEXT_SETTINGS = {
     'help_option_names': ['-h', '--help'],
 }
 
+PROFILE_EXTENSIONS = {
+    'cprofile': 'pstats',
+    'tracemalloc': 'tracemalloc'
+}
+
 
 @click.group(context_settings=CONTEXT_SETTINGS)
-def cli():
-    pass
+@click.option(
+        '--profile',
+        type=click.Choice(['cprofile', 'tracemalloc']),
+        default=None,
+        help="Profile the command's run time (cprofile) or "
+        "memory allocations (tracemalloc)")
+@click.option(
+        '--profile-out',
+        default=None,
+        help="Where to write the pstats or allocation snapshot "
+        "(default: clodius.pstats or clodius.tracemalloc)")
+@click.option(
+        '--profile-stage',
+        multiple=True,
+        help="Only profile this stage of an aggregation (e.g. parse, "
+        "aggregate, hdf5_write, sqlite_insert). With tracemalloc, a "
+        "snapshot is written at the end of the stage to "
+        "<profile-out>.<stage>.<n>. Can be given more than once")
+@click.option(
+        '--profile-interval',
+        default=10,
+        type=float,
+        help="The minimum number of seconds between per-stage tracemalloc "
+        "snapshots")
+@click.pass_context
+def cli(ctx, profile, profile_out, profile_stage, profile_interval):
+    if profile is None:
+        return
+
+    if profile_out is None:
+        profile_out = 'clodius.' + PROFILE_EXTENSIONS[profile]
+
+    profiler = cs.Profiler(profile, profile_out, list(profile_stage),
+            profile_interval)
+    profiler.start()
+
+    # write the profile once the subcommand is done, even if it failed
+    ctx.call_on_close(profiler.stop)
 
 from . import (
     aggregate
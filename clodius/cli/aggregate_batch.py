@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function
+
+import click
+import importlib
+import json
+import multiprocessing as mpr
+import os.path as op
+import shlex
+import sys
+import time
+import traceback
+
+# the aggregate commands that can be run as part of a batch
+BATCH_TYPES = ['bedgraph', 'bigwig', 'bedfile', 'bedpe']
+
+def read_manifest(filename):
+    '''
+    Read a batch manifest. Each line contains an input file, the type of
+    aggregation to run on it and, optionally, the command line options to
+    pass to that aggregation, separated by tabs:
+
+        TADs1.txt   bedpe   --assembly hg19 --chr1-col 1 --chr2-col 1
+
+    Empty lines and lines starting with '#' are ignored.
+
+    :param filename: The name of the manifest file
+    :return: A list of (input_file, filetype, args) tuples
+    '''
+    jobs = []
+
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+
+            if len(line) == 0 or line.startswith('#'):
+                continue
+
+            parts = line.split('\t', 2)
+
+            if len(parts) < 2:
+                raise ValueError('Manifest lines need at least an input file '
+                        'and a type: {}'.format(line))
+
+            args = shlex.split(parts[2]) if len(parts) > 2 else []
+            jobs += [(parts[0], parts[1].strip(), args)]
+
+    return jobs
+
+def get_command(filetype):
+    from clodius.cli.aggregate import aggregate
+
+    if filetype not in BATCH_TYPES:
+        raise ValueError('Unknown aggregation type: {}'.format(filetype))
+
+    return aggregate.commands[filetype]
+
+def preload(jobs):
+    '''
+    Check the options of each job and load everything the jobs have in
+    common (the aggregation modules and the chromosome information of the
+    assemblies and chromsizes files) once, so that the worker processes
+    forked afterwards share them.
+
+    :param jobs: A list of (input_file, filetype, args) tuples
+    :return: A list of error messages, one for each job, which are None
+        for the jobs that can be run
+    '''
+    import clodius.cli.utils as ccu
+    import negspy.coordinates as nc
+
+    errors = []
+    chrominfos = set()
+
+    for (input_file, filetype, args) in jobs:
+        try:
+            command = get_command(filetype)
+            ctx = command.make_context(filetype, [input_file] + list(args))
+        except (ValueError, click.ClickException) as e:
+            errors += [str(e)]
+            continue
+
+        importlib.import_module('clodius.cli.aggregate_' + filetype)
+
+        chrominfos.add((ctx.params.get('assembly'), ctx.params.get('chromsizes_filename')))
+        errors += [None]
+
+    for (assembly, chromsizes_filename) in chrominfos:
+        try:
+            (chrom_info, chrom_order, _) = ccu.get_chrominfo(assembly, chromsizes_filename)
+
+            if chromsizes_filename is None:
+                # negspy keeps its own copy of the chromosome offsets, which
+                # it uses to calculate genome positions
+                nc.chr_pos_to_genome_pos(chrom_order[0], 0, assembly)
+        except (IOError, OSError, IndexError, ValueError):
+            # the jobs using it will report the missing assembly
+            pass
+
+    return errors
+
+def limit_workers(jobs):
+    '''
+    Make the jobs which ask for more than one worker process use a single
+    one. The jobs in a batch run in daemonic worker processes, which can't
+    start processes of their own.
+
+    :param jobs: A list of (input_file, filetype, args) tuples
+    :return: The list of jobs, with '--num-workers 1' added where needed
+    '''
+    limited = []
+
+    for (input_file, filetype, args) in jobs:
+        ctx = get_command(filetype).make_context(filetype, [input_file] + list(args))
+
+        if (ctx.params.get('num_workers') or 1) > 1:
+            print("Running {} with one worker instead of {} because the batch "
+                    "runs in parallel".format(input_file, ctx.params['num_workers']),
+                    file=sys.stderr)
+            args = list(args) + ['--num-workers', '1']
+
+        limited += [(input_file, filetype, args)]
+
+    return limited
+
+def run_job(job):
+    '''
+    Run one aggregation and report how it went rather than raising an
+    exception.
+
+    :param job: An (input_file, filetype, args) tuple
+    :return: A dictionary with the job's status and how long it took
+    '''
+    (input_file, filetype, args) = job
+    result = {'input': input_file, 'type': filetype}
+
+    t1 = time.time()
+    try:
+        command = get_command(filetype)
+        command.main(args=[input_file] + list(args),
+                prog_name='clodius aggregate ' + filetype,
+                standalone_mode=False)
+
+        # a command which stopped without raising an exception may still
+        # not have written anything
+        output_file = command.make_context(filetype,
+                [input_file] + list(args)).params.get('output_file')
+        if output_file is not None and not op.exists(output_file):
+            raise IOError("No output was written to {}".format(output_file))
+
+        result['status'] = 'ok'
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+
+    result['seconds'] = time.time() - t1
+
+    return result
+
+def _batch(manifest, num_workers=None, report_file=None):
+    '''
+    Aggregate all of the files listed in a manifest using a pool of worker
+    processes. A failure in one file doesn't stop the others from being
+    processed.
+
+    :param manifest: The manifest file (see read_manifest)
+    :param num_workers: The number of worker processes (default: the
+        number of CPUs)
+    :param report_file: A file to write the result for each input file to,
+        as JSON lines ('-' for stderr)
+    :return: The list of results, in the order in which the jobs finished
+    '''
+    jobs = read_manifest(manifest)
+    errors = preload(jobs)
+
+    if num_workers is None:
+        num_workers = mpr.cpu_count()
+
+    if report_file is None:
+        report = None
+    elif report_file == '-':
+        report = sys.stderr
+    else:
+        report = open(report_file, 'w')
+
+    results = []
+
+    def add_result(result):
+        results.append(result)
+
+        print('[{}/{}] {} {} {} ({:.1f}s)'.format(len(results), len(jobs),
+            result['status'], result['type'], result['input'], result['seconds']),
+            file=sys.stderr)
+        if result['status'] != 'ok':
+            print('  ', result['error'], file=sys.stderr)
+
+        if report is not None:
+            report.write(json.dumps(result) + '\n')
+            report.flush()
+
+    runnable = []
+
+    for (job, error) in zip(jobs, errors):
+        if error is None:
+            runnable += [job]
+        else:
+            add_result({'input': job[0], 'type': job[1], 'status': 'error',
+                'error': error, 'seconds': 0})
+
+    if num_workers == 1 or len(runnable) <= 1:
+        for job in runnable:
+            add_result(run_job(job))
+    else:
+        runnable = limit_workers(runnable)
+        pool = mpr.Pool(min(num_workers, len(runnable)))
+
+        try:
+            for result in pool.imap_unordered(run_job, runnable):
+                add_result(result)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    if report is not None and report is not sys.stderr:
+        report.close()
+
+    return results
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function
+
+import array
+import clodius.cli.utils as ccu
+import clodius.stats as cs
+import math
+import numpy as np
+import os
+import os.path as op
+import random
+import shutil
+import sys
+import tempfile
+
+def read_bed_columns(lines, chrom_info, importance_column, delimiter, offset, stats):
+    '''
+    Parse the lines of a bed file.
+
+    The entries are stored column by column rather than as one dict per
+    line, and the fields of each line are kept as a slice of one buffer.
+
+    :return: A (starts, ends, chr_offsets, importances, fields,
+        field_offsets) tuple of arrays, where the fields of the i'th line are
+        fields[field_offsets[i]:field_offsets[i+1]]
+    '''
+    starts = array.array('q')
+    ends = array.array('q')
+    chr_offsets = array.array('q')
+    importances = array.array('d')
+    fields = bytearray()
+    field_offsets = array.array('q', [0])
+
+    def add_line(line):
+        try:
+            start = int(line[1])
+            stop = int(line[2])
+        except ValueError:
+            raise ValueError("Error parsing the position, line: {}".format(line))
+
+        chrom = line[0]
+
+        if importance_column is None:
+            importance = stop - start
+        elif importance_column == 'random':
+            importance = random.random()
+        else:
+            importance = int(line[int(importance_column)-1])
+
+        # convert chromosome coordinates to genome coordinates
+        pos_offset = chrom_info.cum_chrom_lengths[chrom] + offset
+
+        starts.append(pos_offset + start)
+        ends.append(pos_offset + start)
+        chr_offsets.append(pos_offset)
+        importances.append(importance)
+
+        fields.extend('\t'.join(line).encode('utf-8'))
+        field_offsets.append(len(fields))
+
+    for line in lines:
+        stats.add(rows=1, bytes=len(line))
+        add_line(line.strip().split(delimiter))
+
+    return (np.frombuffer(starts, dtype=np.int64), np.frombuffer(ends, dtype=np.int64),
+            np.frombuffer(chr_offsets, dtype=np.int64),
+            np.frombuffer(importances, dtype=np.float64), fields,
+            np.frombuffer(field_offsets, dtype=np.int64))
+
+def read_chromosome_columns(partition):
+    '''
+    Parse the lines of one chromosome of a bed file in a worker process.
+
+    :param partition: A dictionary with the input file, the chromosome and
+        the arguments to read_bed_columns
+    '''
+    p = partition
+
+    # forked workers would otherwise all generate the same random
+    # importances
+    random.seed()
+
+    lines = ccu.read_chromosome_lines(p['filepath'], p['chromosome'], 1,
+            p['delimiter'], p['has_header'])
+
+    return read_bed_columns(lines, p['chrom_info'], p['importance_column'],
+            p['delimiter'], p['offset'], cs.AggregationStats('bedfile'))
+
+def concatenate_columns(columns):
+    '''
+    Join the columns (see read_bed_columns) read from several parts of a
+    bed file.
+    '''
+    field_offsets = [np.zeros(1, dtype=np.int64)]
+    num_bytes = 0
+
+    for c in columns:
+        field_offsets += [c[5][1:] + num_bytes]
+        num_bytes += len(c[4])
+
+    return tuple([np.concatenate([c[i] for c in columns]) for i in range(4)] +
+            [b''.join([bytes(c[4]) for c in columns]), np.concatenate(field_offsets)])
+
+def assign_zoom_level(columns, remaining, tile_width, max_per_tile):
+    '''
+    Choose the most important entries in each tile of one zoom level.
+
+    :param columns: The columns returned by read_bed_columns
+    :param remaining: The indices of the entries which haven't been
+        assigned to a zoom level yet, in the order in which they appear in
+        the file
+    :return: The indices of the chosen entries
+    '''
+    (starts, ends, chr_offsets, importances, fields, field_offsets) = columns
+
+    # sweep over the tiles from left to right, only visiting the ones
+    # that entries overlap
+    by_start = remaining[np.argsort(starts[remaining], kind='mergesort')]
+    sorted_starts = starts[by_start]
+    next_entry = 0
+    active = np.zeros(0, dtype=np.int64)
+    chosen = []
+
+    while next_entry < len(by_start) or len(active) > 0:
+        if len(active) == 0:
+            tile_num = starts[by_start[next_entry]] // tile_width
+        else:
+            tile_num += 1
+
+        from_value = tile_num * tile_width
+        to_value = (tile_num + 1) * tile_width
+
+        # add the entries that start in this tile and drop the ones
+        # that ended before it
+        num_new = np.searchsorted(sorted_starts, to_value, side='left') - next_entry
+        active = np.concatenate([active, by_start[next_entry:next_entry + num_new]])
+        next_entry += num_new
+        active = active[ends[active] > from_value]
+
+        if len(active) == 0:
+            continue
+
+        # take the most important entries, breaking ties by their
+        # position in the file
+        in_tile = np.lexsort((active, -importances[active]))[:max_per_tile]
+        chosen += [active[in_tile]]
+
+        # the rest stay active, in the same order
+        not_chosen = np.ones(len(active), dtype=bool)
+        not_chosen[in_tile] = False
+        active = active[not_chosen]
+
+    return np.concatenate(chosen) if len(chosen) > 0 else np.zeros(0, dtype=np.int64)
+
+def make_rows(columns, chosen, zoom_level, first_id, uid_type):
+    '''
+    The rows of the intervals table for the entries at one zoom level.
+    '''
+    (starts, ends, chr_offsets, importances, fields, field_offsets) = columns
+    rows = []
+
+    for (row_id, i) in enumerate(chosen, first_id):
+        line = bytes(fields[field_offsets[i]:field_offsets[i+1]])
+        rows += [(row_id, zoom_level, importances[i], starts[i], ends[i],
+            chr_offsets[i], ccu.make_uid(line, uid_type), line.decode('utf-8'))]
+
+    return rows
+
+def insert_rows(c, rows, layout):
+    c.executemany('INSERT INTO intervals VALUES (?,?,?,?,?,?,?,?)', rows)
+
+    if layout != 'sorted':
+        c.executemany('INSERT INTO position_index VALUES (?,?,?)',
+                [(row[0], row[3], row[4]) for row in rows])
+
+def select_columns(columns, indices):
+    '''
+    The columns (see read_bed_columns) of a subset of the entries.
+    '''
+    (starts, ends, chr_offsets, importances, fields, field_offsets) = columns
+    selected_fields = b''.join([bytes(fields[field_offsets[i]:field_offsets[i+1]])
+        for i in indices])
+    selected_offsets = np.concatenate([[0],
+        np.cumsum(field_offsets[indices + 1] - field_offsets[indices])])
+
+    return (starts[indices], ends[indices], chr_offsets[indices], importances[indices],
+            selected_fields, selected_offsets)
+
+def fill_partition_zoom_levels(partition):
+    '''
+    Assign the entries in one part of the genome to zoom levels in a worker
+    process, and store them in a database of their own.
+
+    :param partition: A dictionary with the columns of the entries, the
+        zoom levels to fill in and the database to write to
+    :return: The number of entries that were stored
+    '''
+    import sqlite3
+
+    p = partition
+    columns = p['columns']
+    remaining = np.arange(len(columns[0]))
+    counter = 0
+
+    sqlite3.register_adapter(np.int64, lambda val: int(val))
+    conn = sqlite3.connect(p['db_file'])
+    conn.execute(
+    '''
+    CREATE TABLE intervals
+    (
+        id int,
+        zoomLevel int,
+        importance real,
+        startPos int,
+        endPos int,
+        chrOffset int,
+        uid {},
+        fields text
+    )
+    '''.format(ccu.UID_TYPES[p['uid_type']]))
+
+    for curr_zoom in range(p['from_zoom'], p['max_zoom'] + 1):
+        if len(remaining) == 0:
+            break
+
+        tile_width = p['tile_size'] * 2 ** (p['max_zoom'] - curr_zoom)
+        chosen = assign_zoom_level(columns, remaining, tile_width, p['max_per_tile'])
+        rows = make_rows(columns, chosen, curr_zoom, counter + 1, p['uid_type'])
+
+        conn.executemany('INSERT INTO intervals VALUES (?,?,?,?,?,?,?,?)', rows)
+        counter += len(rows)
+        remaining = np.setdiff1d(remaining, chosen, assume_unique=True)
+
+    conn.commit()
+    conn.close()
+
+    return counter
+
+def assign_zoom_levels_in_parallel(conn, columns, remaining, from_zoom, max_zoom,
+        tile_size, max_per_tile, uid_type, layout, counter, output_file, num_workers,
+        stats):
+    '''
+    Assign the remaining entries to the zoom levels from from_zoom up to
+    max_zoom using several worker processes.
+
+    The genome is split into groups of tiles at from_zoom which no entry
+    crosses the boundaries between, so that each group can be filled in
+    independently. Each worker stores its entries in a temporary database,
+    which is then attached to the output and copied into it.
+
+    :return: The total number of entries stored in the output
+    '''
+    groups = ccu.partition_tiles(columns[0][remaining], columns[1][remaining],
+            tile_size * 2 ** (max_zoom - from_zoom))
+
+    tmp_dir = tempfile.mkdtemp(dir=op.dirname(op.abspath(output_file)))
+
+    try:
+        partitions = [{'columns': select_columns(columns, remaining[group]),
+            'db_file': op.join(tmp_dir, 'partition_{}.db'.format(i)),
+            'from_zoom': from_zoom, 'max_zoom': max_zoom, 'tile_size': tile_size,
+            'max_per_tile': max_per_tile, 'uid_type': uid_type}
+            for (i, group) in enumerate(groups)]
+
+        with stats.timer('zoom_levels'):
+            counts = ccu.map_partitions(fill_partition_zoom_levels, partitions, num_workers,
+                    sizes=[len(group) for group in groups])
+
+        # the ids in each partition start at 1, so they're offset by the
+        # number of entries stored before them
+        for (partition, count) in zip(partitions, counts):
+            with stats.timer('sqlite_insert'):
+                conn.execute('ATTACH DATABASE ? AS partition', (partition['db_file'],))
+                conn.execute('''
+                    INSERT INTO intervals
+                    SELECT id + ?, zoomLevel, importance, startPos, endPos,
+                        chrOffset, uid, fields
+                    FROM partition.intervals
+                    ''', (counter,))
+
+                if layout != 'sorted':
+                    conn.execute('''
+                        INSERT INTO position_index
+                        SELECT id + ?, startPos, endPos FROM partition.intervals
+                        ''', (counter,))
+
+                conn.commit()
+                conn.execute('DETACH DATABASE partition')
+
+            counter += count
+            stats.report(inserted=counter)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return counter
+
+def _bedfile(filepath, output_file, assembly, importance_column, has_header, 
+        chromosome, max_per_tile, tile_size, delimiter, chromsizes_filename,
+        offset, stats_file=None, num_workers=1, uid_type='slugid', layout='rtree'):
+    stats = cs.AggregationStats('bedfile', stats_file)
+
+    if output_file is None:
+        output_file = filepath + ".multires"
+    else:
+        output_file = output_file
+
+    if op.exists(output_file):
+        os.remove(output_file)
+
+    (chrom_info, chrom_names, chrom_sizes) = ccu.get_chrominfo(assembly, chromsizes_filename)
+
+    stats.log("chrom_names:", chrom_info.chrom_order)
+    stats.log("chrom_sizes:", chrom_sizes)
+
+
+    if num_workers > 1:
+        if not ccu.is_tabix_indexed(filepath):
+            print("Warning: {} isn't tabix indexed, so each worker will read all of it".format(
+                filepath), file=sys.stderr)
+
+        if chromosome is None:
+            # the same lines are rejected as when reading the whole file
+            ccu.check_chromosomes(filepath, chrom_info.chrom_order, 1, delimiter, has_header)
+
+        chroms = [chromosome] if chromosome is not None else chrom_info.chrom_order
+        partitions = [{'filepath': filepath, 'chromosome': chrom, 'has_header': has_header,
+            'chrom_info': chrom_info, 'importance_column': importance_column,
+            'delimiter': delimiter, 'offset': offset} for chrom in chroms]
+
+        with stats.timer('parse'):
+            columns = concatenate_columns(ccu.map_partitions(read_chromosome_columns,
+                partitions, num_workers, sizes=[chrom_info.chrom_lengths[c] for c in chroms]))
+
+        stats.add(rows=len(columns[0]))
+    else:
+        bed_file = ccu.read_chromosome_lines(filepath, chromosome, 1, delimiter, has_header)
+
+        with stats.timer('parse'):
+            columns = read_bed_columns(bed_file, chrom_info, importance_column,
+                    delimiter, offset, stats)
+
+    (starts, ends, chr_offsets, importances, fields, field_offsets) = columns
+
+    # We neeed chromosome information as well as the assembly size to properly
+    # tile this data
+    tile_size = tile_size
+
+    #if chromosome is None:
+    assembly_size = chrom_info.total_length+1
+    '''
+    else:
+        try:
+            assembly_size = chrom_info.chrom_lengths[chromosome]
+        except KeyError:
+            print("ERROR: Chromosome {} not found in assembly {}.".format(chromosome, assembly), file=sys.stderr)
+            return 1
+    '''
+
+    #max_zoom = int(math.ceil(math.log(assembly_size / min_feature_width) / math.log(2)))
+    max_zoom = int(math.ceil(math.log(assembly_size / tile_size) / math.log(2)))
+    '''
+    if max_zoom is not None and max_zoom < max_zoom:
+        max_zoom = max_zoom
+    '''
+
+    # this script stores data in a sqlite database
+    import sqlite3
+    sqlite3.register_adapter(np.int64, lambda val: int(val))
+    conn = sqlite3.connect(output_file)
+
+    # store some meta data
+    ccu.store_meta_data(conn, 1,
+            max_length = assembly_size,
+            assembly = assembly,
+            chrom_names = chrom_names,
+            chrom_sizes = chrom_sizes,
+            tile_size = tile_size,
+            max_zoom = max_zoom,
+            max_width = tile_size * 2 ** max_zoom)
+
+
+    c = conn.cursor()
+
+    if layout == 'sorted':
+        # the intervals are stored in order of their zoom level and start
+        # position, so that a tile can be read with one range scan per zoom
+        # level rather than by joining them with an rtree. The longest
+        # interval at each zoom level bounds where those scans have to start.
+        c.execute(
+        '''
+        CREATE TABLE intervals
+        (
+            id int,
+            zoomLevel int,
+            importance real,
+            startPos int,
+            endPos int,
+            chrOffset int,
+            uid {},
+            fields text,
+            PRIMARY KEY (zoomLevel, startPos, id)
+        ) WITHOUT ROWID
+        '''.format(ccu.UID_TYPES[uid_type]))
+
+        c.execute('''
+            CREATE TABLE zoom_levels
+            (
+                zoomLevel int PRIMARY KEY,
+                maxLength int
+            )
+            ''')
+    else:
+        c.execute(
+        '''
+        CREATE TABLE intervals
+        (
+            id int PRIMARY KEY,
+            zoomLevel int,
+            importance real,
+            startPos int,
+            endPos int,
+            chrOffset int,
+            uid {},
+            fields text
+        )
+        '''.format(ccu.UID_TYPES[uid_type]))
+
+        c.execute('''
+            CREATE VIRTUAL TABLE position_index USING rtree(
+                id,
+                rStartPos, rEndPos
+            )
+            ''')
+
+    curr_zoom = 0
+    counter = 0
+
+    # the entries which haven't been assigned to a zoom level yet, in the
+    # order in which they appear in the file
+    remaining = np.arange(len(starts))
+
+    # with several workers, only the first few zoom levels are filled in
+    # here and the rest are filled in one part of the genome at a time
+    last_zoom = max_zoom
+    if num_workers > 1:
+        last_zoom = ccu.get_partition_zoom(max_zoom, num_workers) - 1
+
+    while curr_zoom <= last_zoom and len(remaining) > 0:
+        # at each zoom level, add the top genes
+        tile_width = tile_size * 2 ** (max_zoom - curr_zoom)
+        chosen = assign_zoom_level(columns, remaining, tile_width, max_per_tile)
+        rows = make_rows(columns, chosen, curr_zoom, counter + 1, uid_type)
+
+        with stats.timer('sqlite_insert'):
+            insert_rows(c, rows, layout)
+
+        counter += len(rows)
+        remaining = np.setdiff1d(remaining, chosen, assume_unique=True)
+
+        stats.report(zoom_level=curr_zoom, inserted=counter)
+        curr_zoom += 1
+
+    if curr_zoom <= max_zoom and len(remaining) > 0:
+        conn.commit()
+        counter = assign_zoom_levels_in_parallel(conn, columns, remaining, curr_zoom,
+                max_zoom, tile_size, max_per_tile, uid_type, layout, counter,
+                output_file, num_workers, stats)
+
+    if layout == 'sorted':
+        c.execute('''
+            INSERT INTO zoom_levels
+            SELECT zoomLevel, max(endPos - startPos) FROM intervals GROUP BY zoomLevel
+            ''')
+
+    conn.commit()
+    conn.close()
+
+    stats.close(inserted=counter)
+
+    return
@@ -0,0 +1,575 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function
+
+import clodius.cli.checkpoint as ccc
+import clodius.cli.utils as ccu
+import clodius.genome_sort as cgs
+import clodius.stats as cs
+import clodius.tiles as ct
+import math
+import numpy as np
+import os
+import os.path as op
+import shutil
+import sys
+import tempfile
+import time
+
+def read_bedgraph_lines(f, chrom_info, chrom_col, from_pos_col, to_pos_col,
+        value_col, nan_value, stats):
+    '''
+    Parse the lines of a bedGraph file.
+
+    :return: A generator of (start genome position, end genome position,
+        value, nan count) tuples
+    '''
+    for line in f:
+        stats.add(rows=1, bytes=len(line))
+
+        # each line should indicate a chromsome, start position and end position
+        parts = line.strip().split()
+        chrom_start = chrom_info.cum_chrom_lengths[parts[chrom_col-1]]
+
+        # count how many nan values there are in the dataset
+        nan_count = 1 if parts[value_col-1] == nan_value else 0
+        value = float(parts[value_col-1]) if not nan_count else np.nan
+
+        yield (chrom_start + int(parts[from_pos_col-1]),
+                chrom_start + int(parts[to_pos_col-1]), value, nan_count)
+
+def read_sorted_records(filepath, skip, stats, from_pos=None, to_pos=None):
+    '''
+    Read the records of a file created by clodius.genome_sort.sort_records.
+
+    :return: A generator of (start genome position, end genome position,
+        value, nan count) tuples
+    '''
+    for (start, end, value) in cgs.iter_sorted_records(filepath, skip,
+            from_pos=from_pos, to_pos=to_pos):
+        stats.add(rows=1, bytes=cgs.RECORD_DTYPE.itemsize)
+
+        yield (start, end, value, 1 if value != value else 0)
+
+def fill_chromosome_values(partition):
+    '''
+    Fill in the highest resolution values of one chromosome of a bedGraph
+    file, the same way that _bedgraph does when reading the whole file.
+
+    The values are stored in a temporary HDF5 file of their own, which only
+    covers the chromosome. Regions without values are never written, so
+    they take up almost no space.
+
+    :param partition: A dictionary with the input file and its columns, the
+        chromosome and the file to store its values in (see
+        write_values_in_parallel)
+    :return: A (number of lines read, position up to which values were
+        filled in, max-position) tuple
+    '''
+    import h5py
+
+    p = partition
+    stats = cs.AggregationStats('bedgraph')
+    (chrom_start, chrom_end, chunk_size) = (p['chrom_start'], p['chrom_end'], p['chunk_size'])
+
+    if p['filepath'].endswith('.npy'):
+        records = read_sorted_records(p['filepath'], 0, stats, chrom_start, chrom_end)
+    else:
+        f = ccu.read_chromosome_lines(p['filepath'], p['chromosome'], p['chrom_col'],
+                has_header=p['has_header'])
+        records = read_bedgraph_lines(f, p['chrom_info'], p['chrom_col'],
+                p['from_pos_col'], p['to_pos_col'], p['value_col'], p['nan_value'], stats)
+
+    block = h5py.File(p['block_file'], 'w')
+    chunks = (max(1, min(chunk_size, chrom_end - chrom_start)),)
+    values = block.create_dataset('values', (chrom_end - chrom_start,), dtype='f',
+            chunks=chunks, compression='lzf', fillvalue=np.nan)
+    nan_values = block.create_dataset('nan_values', (chrom_end - chrom_start,), dtype='f',
+            chunks=chunks, compression='lzf', fillvalue=1)
+
+    # the values are collected one chunk at a time, the positions are
+    # relative to the start of the chromosome
+    buffer_values = np.full(chunk_size, np.nan, dtype=np.float32)
+    buffer_nan_values = np.ones(chunk_size, dtype=np.float32)
+    buffer_start = 0
+    buffer_used = False
+
+    def flush_buffer():
+        length = min(chunk_size, chrom_end - chrom_start - buffer_start)
+        values[buffer_start:buffer_start + length] = buffer_values[:length]
+        nan_values[buffer_start:buffer_start + length] = buffer_nan_values[:length]
+
+        buffer_values[:] = np.nan
+        buffer_nan_values[:] = 1
+
+    curr_genome_pos = chrom_start
+    max_position = 0
+    lines_read = 0
+
+    for (start_genome_pos, end_genome_pos, value, nan_count) in records:
+        lines_read += 1
+
+        # the gaps are already filled with nans
+        if start_genome_pos - curr_genome_pos > 1:
+            curr_genome_pos = start_genome_pos - 1
+
+        if p['transform'] == 'exp2':
+            value = 2 ** value
+
+        length = max(0, end_genome_pos - start_genome_pos)
+
+        # values past the end of the chromosome belong to the next one
+        pos = curr_genome_pos - chrom_start
+        end = min(pos + length, chrom_end - chrom_start)
+
+        while pos < end:
+            if pos >= buffer_start + chunk_size:
+                if buffer_used:
+                    flush_buffer()
+
+                buffer_start = pos // chunk_size * chunk_size
+                buffer_used = False
+
+            piece_end = min(end, buffer_start + chunk_size)
+            buffer_values[pos - buffer_start:piece_end - buffer_start] = value
+            buffer_nan_values[pos - buffer_start:piece_end - buffer_start] = nan_count
+            buffer_used = True
+
+            pos = piece_end
+
+        max_position = start_genome_pos + length
+        curr_genome_pos += length
+
+    if buffer_used:
+        flush_buffer()
+
+    block.close()
+
+    return (lines_read, min(curr_genome_pos, chrom_end), max_position)
+
+def read_blocks(blocks, name, start, end, fill_value):
+    '''
+    Read the values between two genome positions from the blocks written
+    by fill_chromosome_values.
+
+    :param blocks: A list of (chromosome start, chromosome end, open HDF5
+        file) tuples
+    :param name: The dataset to read
+    :param fill_value: The value of positions which aren't in any block
+    '''
+    values = np.full(end - start, fill_value, dtype=np.float32)
+
+    for (chrom_start, chrom_end, block) in blocks:
+        (overlap_start, overlap_end) = (max(start, chrom_start), min(end, chrom_end))
+
+        if overlap_start < overlap_end:
+            values[overlap_start - start:overlap_end - start] = \
+                block[name][overlap_start - chrom_start:overlap_end - chrom_start]
+
+    return values
+
+def write_values_in_parallel(filepath, output_file, dsets, nan_dsets, meta, chrom_info,
+        chrom_col, from_pos_col, to_pos_col, value_col, has_header, chromosome,
+        nan_value, transform, chunk_size, zoom_step, num_workers, stats):
+    '''
+    Read a bedGraph file one chromosome per worker process and store its
+    values at every zoom level.
+
+    Each worker writes the highest resolution values of its chromosome to
+    a temporary file next to the output file. These are then read back in
+    order and aggregated into the lower resolution zoom levels. The input
+    should either be tabix indexed or a sorted .npy file (see
+    clodius.genome_sort), otherwise every worker has to read the whole
+    file.
+
+    Each chromosome is read as if the one before it ended with a gap, so
+    its values start at the beginning of the chromosome. The partitions
+    are whole chromosomes rather than ranges of the genome, so that no
+    line spans two partitions and each worker needs a single tabix fetch.
+    '''
+    import h5py
+
+    tmp_dir = tempfile.mkdtemp(dir=op.dirname(op.abspath(output_file)))
+    blocks = []
+
+    try:
+        chroms = [chromosome] if chromosome is not None else chrom_info.chrom_order
+        partitions = []
+
+        if chromosome is None and not filepath.endswith('.npy'):
+            # the same lines are rejected as when reading the whole file
+            ccu.check_chromosomes(filepath, chrom_info.chrom_order, chrom_col,
+                    has_header=has_header)
+
+        for (i, chrom) in enumerate(chroms):
+            chrom_start = chrom_info.cum_chrom_lengths[chrom]
+
+            partitions += [{'filepath': filepath, 'chromosome': chrom,
+                'chrom_start': chrom_start,
+                'chrom_end': chrom_start + chrom_info.chrom_lengths[chrom],
+                'block_file': op.join(tmp_dir, 'chrom_{}.h5'.format(i)),
+                'chunk_size': chunk_size, 'chrom_info': chrom_info, 'chrom_col': chrom_col,
+                'from_pos_col': from_pos_col, 'to_pos_col': to_pos_col,
+                'value_col': value_col, 'has_header': has_header,
+                'nan_value': nan_value, 'transform': transform}]
+
+        with stats.timer('parse'):
+            results = ccu.map_partitions(fill_chromosome_values, partitions, num_workers,
+                    sizes=[chrom_info.chrom_lengths[chrom] for chrom in chroms])
+
+        stats.add(rows=sum([lines_read for (lines_read, end, max_position) in results]))
+
+        # the values end wherever the last chromosome with any values ends
+        filled = [result for result in results if result[0] > 0]
+        (end, max_position) = filled[-1][1:] if len(filled) > 0 else (0, 0)
+
+        meta.attrs['max-position'] = max_position
+
+        blocks = [(p['chrom_start'], p['chrom_end'], h5py.File(p['block_file'], 'r'))
+                for p in partitions]
+        (values, nan_values) = (None, None)
+
+        for z in range(len(dsets)):
+            next_values = []
+            next_nan_values = []
+
+            for i in range(0, end, chunk_size):
+                # the highest resolution values are merged from the blocks
+                if z == 0:
+                    curr_chunk = read_blocks(blocks, 'values', i, min(i + chunk_size, end),
+                            np.nan)
+                    nan_curr_chunk = read_blocks(blocks, 'nan_values', i,
+                            min(i + chunk_size, end), 1)
+                else:
+                    curr_chunk = values[i:min(i + chunk_size, end)]
+                    nan_curr_chunk = nan_values[i:min(i + chunk_size, end)]
+
+                with stats.timer('hdf5_write'):
+                    dsets[z][i:i + len(curr_chunk)] = curr_chunk
+                    nan_dsets[z][i:i + len(curr_chunk)] = nan_curr_chunk
+
+                with stats.timer('aggregate'):
+                    next_values += [ct.aggregate(curr_chunk, 2 ** zoom_step)]
+                    next_nan_values += [ct.aggregate(nan_curr_chunk, 2 ** zoom_step)]
+
+                stats.report(zoom_level=z, position=i)
+
+            values = np.concatenate(next_values or [np.zeros(0, dtype=np.float32)])
+            nan_values = np.concatenate(next_nan_values or [np.zeros(0, dtype=np.float32)])
+            end = len(values)
+    finally:
+        for (chrom_start, chrom_end, block) in blocks:
+            block.close()
+
+        shutil.rmtree(tmp_dir)
+
+def _bedgraph(filepath, output_file, assembly, chrom_col, 
+        from_pos_col, to_pos_col, value_col, has_header, 
+        chromosome, tile_size, chunk_size, method, nan_value,
+        transform, count_nan, chromsizes_filename, zoom_step, resume=False,
+        checkpoint_interval=600, stats_file=None, num_workers=1):
+    last_end = 0
+    data = []
+    stats = cs.AggregationStats('bedgraph', stats_file)
+
+    if output_file is None:
+        output_file = op.splitext(filepath)[0] + '.hitile'
+
+    stats.log("output file:", output_file)
+
+    if resume and filepath == '-':
+        raise ValueError("Can't resume when reading from stdin")
+
+    if num_workers > 1 and (resume or filepath == '-'):
+        raise ValueError("Can't resume or read from stdin with more than one worker")
+
+    (f, checkpoint) = ccc.open_output_file(output_file, resume)
+
+    # get the information about the chromosomes in this assembly
+    (chrom_info, chrom_order, chrom_sizes) = ccu.get_chrominfo(assembly, chromsizes_filename)
+    chrom_order = [a.encode('utf-8') for a in chrom_order]
+
+    assembly_size = chrom_info.total_length
+    stats.log('assembly_size:', assembly_size)
+
+    tile_size = tile_size
+    chunk_size = tile_size * 2**chunk_size     # how many values to read in at once while tiling
+
+    dsets = []     # data sets at each zoom level
+    nan_dsets = []  # store nan values
+
+    # initialize the arrays which will store the values at each stored zoom level
+    z = 0
+    positions = []   # store where we are at the current dataset
+    data_buffers = [[]]
+    nan_data_buffers = [[]]
+
+    while assembly_size / 2 ** z > tile_size:
+        dset_length = math.ceil(assembly_size / 2 ** z)
+
+        if chromosome is not None and num_workers == 1:
+            # the values before the chromosome aren't written (see below), so
+            # they're filled with what aggregating the missing values gives
+            dsets += [f.require_dataset('values_' + str(z), (dset_length,), dtype='f',
+                compression='gzip', fillvalue=np.nan)]
+            nan_dsets += [f.require_dataset('nan_values_' + str(z), (dset_length,), dtype='f',
+                compression='gzip', fillvalue=2 ** z)]
+        else:
+            dsets += [f.require_dataset('values_' + str(z), (dset_length,), dtype='f',compression='gzip')]
+            nan_dsets += [f.require_dataset('nan_values_' + str(z), (dset_length,), dtype='f',compression='gzip')]
+
+        data_buffers += [[]]
+        nan_data_buffers += [[]]
+
+        positions += [0]
+        z += zoom_step
+
+    #print("dsets[0][-10:]", dsets[0][-10:])
+
+    # load the bigWig file
+    #print("filepath:", filepath)
+
+    # store some meta data
+    d = f.require_dataset('meta', (1,), dtype='f')
+
+    stats.log("assembly:", assembly)
+    #print("chrom_info:", nc.get_chromorder(assembly))
+
+    d.attrs['zoom-step'] = zoom_step
+    d.attrs['max-length'] = assembly_size
+    d.attrs['assembly'] = assembly
+    d.attrs['chrom-names'] = chrom_order
+    d.attrs['chrom-sizes'] = chrom_sizes
+    d.attrs['chrom-order'] = chrom_order
+    d.attrs['tile-size'] = tile_size
+    d.attrs['max-zoom'] = max_zoom =  math.ceil(math.log(d.attrs['max-length'] / tile_size) / math.log(2))
+    d.attrs['max-width'] = tile_size * 2 ** max_zoom
+    d.attrs['max-position'] = 0
+
+    stats.log("assembly size (max-length)", d.attrs['max-length'])
+    stats.log("max-width", d.attrs['max-width'])
+    stats.log("max_zoom:", d.attrs['max-zoom'])
+    stats.log("chunk-size:", chunk_size)
+    stats.log("chrom-order", d.attrs['chrom-order'])
+
+    # are we reading the input from stdin, from a sorted binary file (see
+    # clodius.genome_sort) or from a text file?
+
+    sorted_input = filepath.endswith('.npy')
+
+    if num_workers > 1:
+        if not sorted_input and not ccu.is_tabix_indexed(filepath):
+            print("Warning: {} isn't tabix indexed, so each worker will read all of it".format(
+                filepath), file=sys.stderr)
+
+        write_values_in_parallel(filepath, output_file, dsets, nan_dsets, d, chrom_info,
+                chrom_col, from_pos_col, to_pos_col, value_col, has_header, chromosome,
+                nan_value, transform, chunk_size, zoom_step, num_workers, stats)
+
+        f.close()
+        stats.close()
+        return
+
+    if sorted_input:
+        f = None
+    else:
+        f = ccu.read_chromosome_lines(filepath, chromosome, chrom_col,
+                has_header=has_header)
+
+    curr_zoom = 0
+
+    def add_values_to_data_buffers(buffers_to_add, nan_buffers_to_add):
+        curr_zoom = 0
+
+        data_buffers[0] += buffers_to_add
+        nan_data_buffers[0] += nan_buffers_to_add
+
+        stats.report(position=positions[0], progress=positions[0] / float(assembly_size))
+
+        while len(data_buffers[curr_zoom]) >= chunk_size:
+            # get the current chunk and store it, converting nans to 0
+            curr_chunk = np.array(data_buffers[curr_zoom][:chunk_size])
+            nan_curr_chunk = np.array(nan_data_buffers[curr_zoom][:chunk_size])
+            #curr_chunk[np.isnan(curr_chunk)] = 0
+            '''
+            print("1cc:", sum(curr_chunk))
+            print("1db:", data_buffers[curr_zoom][:chunk_size])
+            print("1curr_chunk:", nan_curr_chunk)
+            '''
+            with stats.timer('hdf5_write'):
+                dsets[curr_zoom][positions[curr_zoom]:positions[curr_zoom]+chunk_size] = curr_chunk
+                nan_dsets[curr_zoom][positions[curr_zoom]:positions[curr_zoom]+chunk_size] = nan_curr_chunk
+
+            # aggregate nan values
+            #nan_curr_chunk[np.isnan(curr_chunk)] = 0
+            #print("1na_cc:", sum(nan_curr_chunk))
+
+            # aggregate and store aggregated values in the next zoom_level's data
+            with stats.timer('aggregate'):
+                data_buffers[curr_zoom+1] += list(ct.aggregate(curr_chunk, 2 ** zoom_step))
+                nan_data_buffers[curr_zoom+1] += list(ct.aggregate(nan_curr_chunk, 2 ** zoom_step))
+
+            data_buffers[curr_zoom] = data_buffers[curr_zoom][chunk_size:]
+            nan_data_buffers[curr_zoom] = nan_data_buffers[curr_zoom][chunk_size:]
+
+            data = data_buffers[curr_zoom+1]
+            nan_data = nan_data_buffers[curr_zoom+1]
+
+            # do the same for the nan values buffers
+
+            positions[curr_zoom] += chunk_size
+            curr_zoom += 1
+
+            if curr_zoom * zoom_step >= max_zoom:
+                break
+
+
+    values = []
+    nan_values = []
+
+    # the genome position up to which we've filled in values
+    curr_genome_pos = 0
+
+    # keep track of the previous value so that we can use it to fill in NAN values
+    prev_value = 0
+
+    # the number of lines that have been read
+    lines_read = 0
+
+    if checkpoint is not None:
+        (state, data_buffers[:], nan_data_buffers[:], arrays) = checkpoint
+        positions[:] = state['positions']
+        curr_genome_pos = state['curr_genome_pos']
+        d.attrs['max-position'] = state['max_position']
+
+        values = list(arrays['values'])
+        nan_values = list(arrays['nan_values'])
+
+        # skip the lines whose values are already in the checkpoint
+        if not sorted_input:
+            for i in range(state['lines_read']):
+                next(f)
+        lines_read = state['lines_read']
+    elif chromosome is not None:
+        # start as close to the chromosome as we can while keeping the
+        # positions at every zoom level aligned, rather than filling the
+        # gap from the start of the genome
+        alignment = 2 ** (zoom_step * len(dsets))
+        curr_genome_pos = max(0, (chrom_info.cum_chrom_lengths[chromosome] - 1)
+                // alignment * alignment)
+        positions[:] = [curr_genome_pos // 2 ** (i * zoom_step) for i in range(len(positions))]
+
+    if sorted_input:
+        if chromosome is not None:
+            chrom_start = chrom_info.cum_chrom_lengths[chromosome]
+            records = read_sorted_records(filepath, lines_read, stats, chrom_start,
+                    chrom_start + chrom_info.chrom_lengths[chromosome])
+        else:
+            records = read_sorted_records(filepath, lines_read, stats)
+    else:
+        records = read_bedgraph_lines(f, chrom_info, chrom_col, from_pos_col,
+                to_pos_col, value_col, nan_value, stats)
+
+    last_checkpoint = time.time()
+
+    # the time spent filling the buffers is counted as parsing, everything
+    # else is timed within add_values_to_data_buffers
+    with stats.timer('parse'):
+        for (start_genome_pos, end_genome_pos, value, nan_count) in records:
+            lines_read += 1
+
+            #print("len(values):", len(values), curr_genome_pos, start_genome_pos)
+            #print("line:", line)
+
+            # fill in the gap a chunk at a time, it can span a large part
+            # of a chromosome
+            while start_genome_pos - curr_genome_pos > 1:
+                gap_length = min(start_genome_pos - curr_genome_pos - 1, chunk_size)
+
+                values += [np.nan] * gap_length
+                nan_values += [1] * gap_length
+
+                curr_genome_pos += gap_length
+
+                while len(values) > chunk_size:
+                    add_values_to_data_buffers(values[:chunk_size], nan_values[:chunk_size])
+                    values = values[chunk_size:]
+                    nan_values = nan_values[chunk_size:]
+
+
+            # if the provided values are log2 transformed, we have to un-transform them
+            if transform == 'exp2':
+                value = 2 ** value
+
+            # we're going to add as many values are as specified in the bedfile line
+            values_to_add = [value] * (end_genome_pos - start_genome_pos)
+            nan_counts_to_add = [nan_count] * (end_genome_pos - start_genome_pos)
+        
+            values += values_to_add
+            nan_values += nan_counts_to_add
+
+            d.attrs['max-position'] = start_genome_pos + len(values_to_add) 
+
+            #print("values:", values[:30])
+
+            curr_genome_pos += len(values_to_add)
+
+            while len(values) > chunk_size:
+                add_values_to_data_buffers(values[:chunk_size], nan_values[:chunk_size])
+                values = values[chunk_size:]
+                nan_values = nan_values[chunk_size:]
+
+            if time.time() - last_checkpoint > checkpoint_interval:
+                ccc.save_checkpoint(output_file, dsets[0].file,
+                        {'lines_read': lines_read, 'curr_genome_pos': curr_genome_pos,
+                         'max_position': int(d.attrs['max-position']), 'positions': positions},
+                        data_buffers, nan_data_buffers, values=values, nan_values=nan_values)
+                last_checkpoint = time.time()
+
+
+    add_values_to_data_buffers(values, nan_values)
+
+    # store the remaining data
+    while True:
+        # get the current chunk and store it
+        chunk_size = len(data_buffers[curr_zoom])
+        curr_chunk = np.array(data_buffers[curr_zoom][:chunk_size])
+        nan_curr_chunk = np.array(nan_data_buffers[curr_zoom][:chunk_size])
+
+        '''
+        print("2curr_chunk", curr_chunk)
+        print("2curr_zoom:", curr_zoom)
+        print("2db", data_buffers[curr_zoom][:100])
+        '''
+
+        with stats.timer('hdf5_write'):
+            dsets[curr_zoom][positions[curr_zoom]:positions[curr_zoom]+chunk_size] = curr_chunk
+            nan_dsets[curr_zoom][positions[curr_zoom]:positions[curr_zoom]+chunk_size] = nan_curr_chunk
+
+        #print("chunk_size:", chunk_size, "len(curr_chunk):", len(curr_chunk), "len(nan_curr_chunk)", len(nan_curr_chunk))
+
+        # aggregate and store aggregated values in the next zoom_level's data
+        with stats.timer('aggregate'):
+            data_buffers[curr_zoom+1] += list(ct.aggregate(curr_chunk, 2 ** zoom_step))
+            nan_data_buffers[curr_zoom+1] += list(ct.aggregate(nan_curr_chunk, 2 ** zoom_step))
+
+        data_buffers[curr_zoom] = data_buffers[curr_zoom][chunk_size:]
+        nan_data_buffers[curr_zoom] = nan_data_buffers[curr_zoom][chunk_size:]
+
+        data = data_buffers[curr_zoom+1]
+        nan_data = nan_data_buffers[curr_zoom+1]
+
+        positions[curr_zoom] += chunk_size
+        curr_zoom += 1
+
+        # we've created enough tile levels to cover the entire maximum width
+        if curr_zoom * zoom_step >= max_zoom:
+            break
+
+    # the output is complete so there's nothing to resume
+    dsets[0].file.close()
+    if op.exists(ccc.get_checkpoint_filename(output_file)):
+        os.remove(ccc.get_checkpoint_filename(output_file))
+
+    stats.close()
+
+    # still need to take care of the last chunk
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function
+
+import clodius.cli.utils as ccu
+import clodius.stats as cs
+import collections as col
+import math
+import negspy.coordinates as nc
+import numpy as np
+import os
+import os.path as op
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+# the types that extra columns can be stored as
+COLUMN_TYPES = {'int': int, 'real': float, 'text': str}
+
+# values which are stored as NULL in numeric columns
+MISSING_VALUES = set(['', '.', 'NA', 'NaN', 'nan'])
+
+# the columns of the intervals table, which extra columns can't be named after
+INTERVAL_COLUMNS = ['id', 'zoomLevel', 'importance', 'fromX', 'toX', 'fromY',
+        'toY', 'chrOffset', 'uid', 'fields']
+
+def parse_column_value(value, column_type):
+    if column_type != 'text' and value in MISSING_VALUES:
+        return None
+
+    return COLUMN_TYPES[column_type](value)
+
+def read_bedpe_entries(lines, assembly, importance_column, columns, stats,
+        extra_columns=()):
+    '''
+    Parse the lines of a bedpe file.
+
+    :param columns: The (0-based) chr1, from1, to1, chr2, from2 and to2
+        columns
+    :param extra_columns: A list of (name, column (1-based), type) tuples
+        describing other columns to store
+    :return: A list of entry dictionaries
+    '''
+    (chr1_col, from1_col, to1_col, chr2_col, from2_col, to2_col) = columns
+
+    def line_to_dict(line):
+        parts = line.split()
+        d = {}
+        try:
+            d['xs'] = [nc.chr_pos_to_genome_pos(parts[chr1_col], int(parts[from1_col]), assembly), 
+                          nc.chr_pos_to_genome_pos(parts[chr1_col], int(parts[to1_col]), assembly)]
+            d['ys'] = [nc.chr_pos_to_genome_pos(parts[chr2_col], int(parts[from2_col]), assembly), 
+                        nc.chr_pos_to_genome_pos(parts[chr2_col], int(parts[to2_col]), assembly)]
+        except KeyError:
+            error_str = ("ERROR converting chromosome position to genome position. "
+                        "Please make sure you've specified the correct assembly "
+                        "using the --assembly option. "
+                        "Current assembly: {}, chromosomes: {},{}".format(assembly,
+                    parts[chr1_col], parts[chr2_col]))
+            raise(KeyError(error_str))
+
+        d['chrOffset'] = d['xs'][0] - int(parts[from1_col])
+
+        if importance_column is None:
+            d['importance'] = max(d['xs'][1] - d['xs'][0], d['ys'][1] - d['ys'][0]) 
+        elif importance_column == 'random':
+            d['importance'] = random.random()
+        else:
+            try:
+                d['importance'] = float(parts[int(importance_column)-1])
+            except ValueError:
+                raise ValueError("Couldn't convert the importance column ({}) to "
+                        "a number, line: {}".format(importance_column, line))
+
+        d['values'] = []
+        for (name, column, column_type) in extra_columns:
+            try:
+                d['values'] += [parse_column_value(parts[column-1], column_type)]
+            except ValueError:
+                raise ValueError("Couldn't convert column {} ({}) to {}, line: {}".format(
+                    column, name, column_type, line))
+
+        d['fields'] = line
+
+        return d
+
+    entries = []
+
+    for line in lines:
+        stats.add(rows=1, bytes=len(line))
+        entries += [line_to_dict(line.strip())]
+
+    return entries
+
+def read_chromosome_entries(partition):
+    '''
+    Parse the lines of a bedpe file whose first position is on one
+    chromosome, in a worker process.
+
+    :param partition: A dictionary with the input file, the chromosome and
+        the arguments to read_bedpe_entries
+    '''
+    p = partition
+
+    # forked workers would otherwise all generate the same random
+    # importances
+    random.seed()
+
+    lines = ccu.read_chromosome_lines(p['filepath'], p['chromosome'], p['columns'][0] + 1,
+            has_header=p['has_header'])
+
+    return read_bedpe_entries(lines, p['assembly'], p['importance_column'],
+            p['columns'], cs.AggregationStats('bedpe'), p['extra_columns'])
+
+def create_intervals_table(c, uid_type, extra_columns):
+    c.execute(
+    '''
+    CREATE TABLE intervals
+    (
+        id int PRIMARY KEY,
+        zoomLevel int,
+        importance real,
+        fromX int,
+        toX int,
+        fromY int,
+        toY int,
+        chrOffset int,
+        uid {},
+        fields text{}
+    )
+    '''.format(ccu.UID_TYPES[uid_type], ''.join([',\n        {} {}'.format(name, column_type)
+        for (name, column, column_type) in extra_columns])))
+
+def assign_zoom_levels(entries, tile_counts, from_zoom, to_zoom, max_zoom, tile_size,
+        max_per_tile, stats=None):
+    '''
+    Add each entry, from the most important to the least, to the first zoom
+    level between from_zoom and to_zoom where none of the tiles it's in are
+    full.
+
+    :param entries: The entries returned by read_bedpe_entries, sorted by
+        importance
+    :param tile_counts: The number of entries in each tile at each zoom
+        level, indexed by zoom level, x and y, which is updated as entries
+        are added
+    :return: A list of (zoom level, entry) tuples for the entries that were
+        added and a list of the ones that weren't
+    '''
+    added = []
+    remaining = []
+
+    for d in entries:
+        curr_zoom = from_zoom
+
+        if stats is not None:
+            stats.report(inserted=len(added))
+
+        while curr_zoom <= to_zoom:
+            tile_width = tile_size * 2 ** (max_zoom - curr_zoom)
+            #print("d:", d)
+            tile_from = list(map(lambda x: x / tile_width, [d['xs'][0], d['ys'][0]] ))
+            tile_to = list(map(lambda x: x / tile_width, [d['xs'][1], d['ys'][1]]))
+
+            empty_tiles = True
+
+            # go through and check if any of the tiles at this zoom level are full
+
+            for i in range(int(tile_from[0]), int(tile_to[0])+1):
+                if not empty_tiles:
+                    break
+
+                for j in range(int(tile_from[1]), int(tile_to[1])+1):
+                    if tile_counts[curr_zoom][i][j] > max_per_tile:
+
+                        empty_tiles = False
+                        break
+
+            if empty_tiles:
+                # they're all empty so add this interval to this zoom level
+                for i in range(int(tile_from[0]), int(tile_to[0])+1):
+                    for j in range(int(tile_from[1]), int(tile_to[1])+1):
+                        tile_counts[curr_zoom][i][j] += 1
+
+                added += [(curr_zoom, d)]
+                break
+
+            curr_zoom += 1
+        else:
+            remaining += [d]
+
+    return (added, remaining)
+
+def make_tile_counts():
+    return col.defaultdict(lambda: col.defaultdict(lambda: col.defaultdict(int)))
+
+def insert_entries(c, added, first_id, uid_type, extra_columns, position_index=True):
+    exec_statement = 'INSERT INTO intervals VALUES ({})'.format(
+            ','.join(['?'] * (len(INTERVAL_COLUMNS) + len(extra_columns))))
+    c.executemany(exec_statement,
+            [(row_id, curr_zoom, d['importance'], d['xs'][0], d['xs'][1],
+                d['ys'][0], d['ys'][1], d['chrOffset'],
+                ccu.make_uid(d['fields'], uid_type), d['fields']) + tuple(d['values'])
+                for (row_id, (curr_zoom, d)) in enumerate(added, first_id)])
+
+    if position_index:
+        #add counter as a primary key
+        c.executemany('INSERT INTO position_index VALUES (?,?,?,?,?)',
+                [(row_id, d['xs'][0], d['xs'][1], d['ys'][0], d['ys'][1])
+                    for (row_id, (curr_zoom, d)) in enumerate(added, first_id)])
+
+def fill_partition_zoom_levels(partition):
+    '''
+    Assign the entries in one part of the genome to zoom levels in a worker
+    process, and store them in a database of their own.
+
+    :param partition: A dictionary with the entries, the zoom levels to
+        fill in and the database to write to
+    :return: The number of entries that were stored
+    '''
+    p = partition
+    (added, remaining) = assign_zoom_levels(p['entries'], make_tile_counts(),
+            p['from_zoom'], p['max_zoom'], p['max_zoom'], p['tile_size'], p['max_per_tile'])
+
+    sqlite3.register_adapter(np.int64, lambda val: int(val))
+    conn = sqlite3.connect(p['db_file'])
+    create_intervals_table(conn, p['uid_type'], p['extra_columns'])
+    insert_entries(conn, added, 0, p['uid_type'], p['extra_columns'], position_index=False)
+    conn.commit()
+    conn.close()
+
+    return len(added)
+
+def assign_zoom_levels_in_parallel(conn, entries, from_zoom, max_zoom, tile_size,
+        max_per_tile, uid_type, extra_columns, counter, output_file, num_workers, stats):
+    '''
+    Assign the remaining entries to the zoom levels from from_zoom up to
+    max_zoom using several worker processes.
+
+    The genome is split into columns of tiles at from_zoom which no entry
+    crosses the boundaries between, so that each group of columns can be
+    filled in independently. Each worker stores its entries in a temporary
+    database, which is then attached to the output and copied into it.
+
+    :return: The total number of entries stored in the output
+    '''
+    groups = ccu.partition_tiles([d['xs'][0] for d in entries], [d['xs'][1] for d in entries],
+            tile_size * 2 ** (max_zoom - from_zoom), inclusive_end=True)
+
+    tmp_dir = tempfile.mkdtemp(dir=op.dirname(op.abspath(output_file)))
+    column_names = ', '.join(INTERVAL_COLUMNS[1:] + [name for (name, column, column_type)
+        in extra_columns])
+
+    try:
+        partitions = [{'entries': [entries[i] for i in group],
+            'db_file': op.join(tmp_dir, 'partition_{}.db'.format(i)),
+            'from_zoom': from_zoom, 'max_zoom': max_zoom, 'tile_size': tile_size,
+            'max_per_tile': max_per_tile, 'uid_type': uid_type,
+            'extra_columns': extra_columns}
+            for (i, group) in enumerate(groups)]
+
+        with stats.timer('zoom_levels'):
+            counts = ccu.map_partitions(fill_partition_zoom_levels, partitions, num_workers,
+                    sizes=[len(group) for group in groups])
+
+        # the ids in each partition start at 0, so they're offset by the
+        # number of entries stored before them
+        for (partition, count) in zip(partitions, counts):
+            with stats.timer('sqlite_insert'):
+                conn.execute('ATTACH DATABASE ? AS partition', (partition['db_file'],))
+                conn.execute('''
+                    INSERT INTO intervals
+                    SELECT id + ?, {}
+                    FROM partition.intervals
+                    '''.format(column_names), (counter,))
+                conn.execute('''
+                    INSERT INTO position_index
+                    SELECT id + ?, fromX, toX, fromY, toY FROM partition.intervals
+                    ''', (counter,))
+
+                conn.commit()
+                conn.execute('DETACH DATABASE partition')
+
+            counter += count
+            stats.report(inserted=counter)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return counter
+
+def _bedpe(filepath, output_file, assembly, importance_column, has_header, max_per_tile, 
+        tile_size, max_zoom=None, chromosome=None, 
+        chr1_col=0, from1_col=1, to1_col=2,
+        chr2_col=3, from2_col=4, to2_col=5, stats_file=None, num_workers=1,
+        uid_type='slugid', extra_columns=()):
+    stats = cs.AggregationStats('bedpe', stats_file)
+    stats.log('output_file:', output_file)
+    columns = (chr1_col, from1_col, to1_col, chr2_col, from2_col, to2_col)
+
+    for (name, column, column_type) in extra_columns:
+        if name.lower() in [c.lower() for c in INTERVAL_COLUMNS]:
+            raise ValueError("Can't store column {} as {}, which is already used".format(
+                column, name))
+
+    if output_file is None:
+        output_file = filepath + ".multires.db"
+    else:
+        output_file = output_file
+
+    if op.exists(output_file):
+        os.remove(output_file)
+
+    entries = []
+
+    # only the contacts whose first position is on the chromosome are kept
+    if num_workers > 1:
+        if not ccu.is_tabix_indexed(filepath):
+            print("Warning: {} isn't tabix indexed, so each worker will read all of it".format(
+                filepath), file=sys.stderr)
+
+        (chrom_info, _, _) = ccu.get_chrominfo(assembly)
+        chroms = [chromosome] if chromosome is not None else chrom_info.chrom_order
+
+        if chromosome is None:
+            # the same lines are rejected as when reading the whole file
+            ccu.check_chromosomes(filepath, chrom_info.chrom_order, chr1_col + 1,
+                    has_header=has_header)
+        partitions = [{'filepath': filepath, 'chromosome': chrom, 'has_header': has_header,
+            'assembly': assembly, 'importance_column': importance_column,
+            'columns': columns, 'extra_columns': extra_columns} for chrom in chroms]
+
+        with stats.timer('parse'):
+            for chrom_entries in ccu.map_partitions(read_chromosome_entries, partitions,
+                    num_workers, sizes=[chrom_info.chrom_lengths[c] for c in chroms]):
+                entries += chrom_entries
+
+        stats.add(rows=len(entries))
+    else:
+        f = ccu.read_chromosome_lines(filepath, chromosome, chr1_col + 1,
+                has_header=has_header)
+
+        # make sure that the first line isn't a header (if there are any lines
+        # on the chromosome)
+        first_line = next(f, None) if not has_header else None
+
+        if first_line is not None:
+            first_line = first_line.strip()
+            try:
+                parts = first_line.split()
+
+                '''
+                print("chr1_col", chr1_col, "chr2_col", chr2_col, 
+                      "from1_col:", from1_col, "from2_col", from2_col, 
+                      "to1_col", to1_col, "to2_col", to2_col)
+                '''
+
+                pos = int(parts[from1_col])
+                pos = int(parts[to1_col])
+                pos = int(parts[from2_col])
+                pos = int(parts[to2_col])
+            except ValueError as ve:
+                error_str = "Couldn't convert one of the bedpe coordinates to an integer. If the input file contains a header, make sure to indicate that with the --has-header option. Line: {}".format(first_line)
+                raise(ValueError(error_str))
+            entries = read_bedpe_entries([first_line], assembly, importance_column,
+                    columns, stats, extra_columns)
+
+        with stats.timer('parse'):
+            entries += read_bedpe_entries(f, assembly, importance_column, columns, stats,
+                    extra_columns)
+
+    # We neeed chromosome information as well as the assembly size to properly
+    # tile this data
+    tile_size = tile_size
+    (chrom_info, chrom_names, chrom_sizes) = ccu.get_chrominfo(assembly)
+    assembly_size = chrom_info.total_length+1
+    #max_zoom = int(math.ceil(math.log(assembly_size / min_feature_width) / math.log(2)))
+    max_zoom = int(math.ceil(math.log(assembly_size / tile_size) / math.log(2)))
+    '''
+    if max_zoom is not None and max_zoom < max_zoom:
+        max_zoom = max_zoom
+    '''
+
+    # this script stores data in a sqlite database
+    sqlite3.register_adapter(np.int64, lambda val: int(val))
+    conn = sqlite3.connect(output_file)
+
+    # store some meta data
+    ccu.store_meta_data(conn, 1, 
+            max_length = assembly_size,
+            assembly = assembly,
+            chrom_names = chrom_names,
+            chrom_sizes = chrom_sizes,
+            tile_size = tile_size,
+            max_zoom = max_zoom,
+            max_width = tile_size * 2 ** max_zoom)
+
+    max_width = tile_size * 2 ** max_zoom
+    uid_to_entry = {}
+
+    c = conn.cursor()
+    create_intervals_table(c, uid_type, extra_columns)
+
+    stats.log("creating rtree")
+    c.execute('''
+        CREATE VIRTUAL TABLE position_index USING rtree(
+            id,
+            rFromX, rToX,
+            rFromY, rToY
+        )
+        ''')
+
+    max_viewable_zoom = max_zoom
+
+    if max_zoom is not None and max_zoom < max_zoom:
+        max_viewable_zoom = max_zoom
+
+    entries = sorted(entries, key=lambda x: -x['importance'])
+
+    # with several workers, only the first few zoom levels are filled in
+    # here and the rest are filled in one part of the genome at a time
+    last_zoom = max_zoom
+    if num_workers > 1:
+        last_zoom = ccu.get_partition_zoom(max_zoom, num_workers) - 1
+
+    (added, entries) = assign_zoom_levels(entries, make_tile_counts(), 0, last_zoom,
+            max_zoom, tile_size, max_per_tile, stats)
+
+    with stats.timer('sqlite_insert'):
+        insert_entries(c, added, 0, uid_type, extra_columns)
+        conn.commit()
+
+    counter = len(added)
+
+    if len(entries) > 0 and last_zoom < max_zoom:
+        counter = assign_zoom_levels_in_parallel(conn, entries, last_zoom + 1, max_zoom,
+                tile_size, max_per_tile, uid_type, extra_columns, counter, output_file,
+                num_workers, stats)
+
+    conn.close()
+
+    stats.close(inserted=counter)
+
+    return
@@ -0,0 +1,595 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function
+
+import clodius.cli.checkpoint as ccc
+import clodius.cli.utils as ccu
+import clodius.stats as cs
+import clodius.tiles as ct
+import math
+import numpy as np
+import os
+import os.path as op
+import pyBigWig as pbw
+import time
+
+def get_bigwig_zoom_levels(filepath):
+    '''
+    Read the headers of the zoom level summaries stored in a bigWig file.
+
+    :param filepath: The path of a local bigWig file
+    :return: A (byte_order, compressed, levels) tuple where levels is a
+        list of (resolution, data_offset, index_offset) tuples, finest first
+    '''
+    import struct
+
+    with open(filepath, 'rb') as f:
+        header = f.read(64)
+
+        # bigWig files can be written in either byte order
+        byte_order = '<'
+        if struct.unpack('<I', header[:4])[0] != 0x888FFC26:
+            byte_order = '>'
+
+        num_zoom_levels = struct.unpack(byte_order + 'H', header[6:8])[0]
+        uncompress_buf_size = struct.unpack(byte_order + 'I', header[52:56])[0]
+        zoom_headers = f.read(24 * num_zoom_levels)
+
+    # each zoom header has its reduction level, a reserved field and where
+    # its records and their index start
+    levels = [struct.unpack(byte_order + 'IIQQ', zoom_headers[i*24:(i+1)*24])
+            for i in range(num_zoom_levels)]
+
+    return (byte_order, uncompress_buf_size > 0,
+            sorted([(level[0], level[2], level[3]) for level in levels]))
+
+def get_bigwig_zoom_resolutions(filepath):
+    '''
+    Get the resolutions (in bases) of the zoom level summaries stored
+    in a bigWig file.
+
+    :param filepath: The path of a local bigWig file
+    :return: A list of resolutions, finest first
+    '''
+    return [level[0] for level in get_bigwig_zoom_levels(filepath)[2]]
+
+def read_bigwig_zoom_records(filepath, resolution, read_size=2**24):
+    '''
+    Read the records of one of the zoom level summaries of a bigWig file.
+
+    :param filepath: The path of a local bigWig file
+    :param resolution: The resolution of the zoom level to read
+    :param read_size: How many bytes to read from the file at once
+    :return: An iterator over arrays of records, each of which has the
+        chromosome id, start and end of the record, along with the number
+        of bases with a value and the sum of their values
+    '''
+    import zlib
+
+    (byte_order, compressed, levels) = get_bigwig_zoom_levels(filepath)
+    (data_offset, index_offset) = dict([(l[0], l[1:]) for l in levels])[resolution]
+
+    record_dtype = np.dtype([('chrom', byte_order + 'u4'), ('start', byte_order + 'u4'),
+        ('end', byte_order + 'u4'), ('valid_count', byte_order + 'u4'),
+        ('min', byte_order + 'f4'), ('max', byte_order + 'f4'),
+        ('sum', byte_order + 'f4'), ('sum_squares', byte_order + 'f4')])
+
+    with open(filepath, 'rb') as f:
+        # the records follow the number of records
+        f.seek(data_offset + 4)
+        remaining = index_offset - data_offset - 4
+        decompressor = zlib.decompressobj()
+        data = b''
+
+        while remaining > 0:
+            chunk = f.read(min(read_size, remaining))
+            remaining -= len(chunk)
+
+            if not compressed:
+                data += chunk
+            else:
+                # every block of records is compressed separately
+                while len(chunk) > 0:
+                    data += decompressor.decompress(chunk)
+
+                    if not decompressor.eof:
+                        break
+
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj()
+
+            num_records = len(data) // record_dtype.itemsize
+            yield np.frombuffer(data[:num_records * record_dtype.itemsize], dtype=record_dtype)
+            data = data[num_records * record_dtype.itemsize:]
+
+def get_zoom_summary_bins(bwf, filepath, resolution, chroms, chrom_lengths, bin_size,
+        num_bins):
+    '''
+    Get the sum of the values and the number of bases without a value in
+    consecutive bins from one of the zoom level summaries of a bigWig
+    file rather than from its base-level values. The records which cross
+    a bin boundary are split using the base-level values, so the result
+    is the same as aggregating the base-level values.
+
+    :param bwf: The open bigWig file
+    :param filepath: The path of the bigWig file
+    :param resolution: The resolution of the zoom level summary to use
+    :param chroms: The chromosomes to get the values for, in order
+    :param chrom_lengths: A dictionary of chromosome lengths
+    :param bin_size: The width of each bin
+    :param num_bins: The number of bins
+    :return: A (sums, nan_counts, covered) tuple of arrays
+    '''
+    # the chromosome ids used in the records are in the order of the
+    # bigWig's chromosome list
+    bw_chroms = list(bwf.chroms())
+    bw_chrom_ends = np.array(list(bwf.chroms().values()), dtype=np.int64)
+    chrom_offsets = np.full(len(bw_chroms), -1, dtype=np.int64)
+    chrom_ends = np.zeros(len(bw_chroms), dtype=np.int64)
+    chrom_start = 0
+
+    for chrom in chroms:
+        if chrom in bwf.chroms():
+            chrom_offsets[bw_chroms.index(chrom)] = chrom_start
+            chrom_ends[bw_chroms.index(chrom)] = chrom_lengths[chrom]
+
+        chrom_start += chrom_lengths[chrom]
+
+    sums = np.zeros(num_bins)
+    covered = np.zeros(num_bins)
+
+    for records in read_bigwig_zoom_records(filepath, resolution):
+        offsets = chrom_offsets[records['chrom']]
+        ends = chrom_ends[records['chrom']]
+        # only the chromosomes that are being aggregated are kept
+        kept = (offsets >= 0) & (records['start'] < ends)
+        (records, offsets, ends) = (records[kept], offsets[kept], ends[kept])
+
+        # the records that cross a bin boundary are recalculated, along
+        # with the ones libBigWig sometimes writes a wrong sum for: the last
+        # record of a chromosome and records whose sum can't come from
+        # their minimum and maximum
+        valid_count = records['valid_count'].astype(float)
+        tolerance = 1e-3 * np.maximum(np.abs(records['min']), np.abs(records['max'])) * valid_count
+        first_bins = (offsets + records['start']) // bin_size
+        inside = ((first_bins == (offsets + records['end'] - 1) // bin_size) &
+                (records['end'] <= ends) &
+                (records['end'] + resolution <= bw_chrom_ends[records['chrom']]) &
+                (records['sum'] >= records['min'] * valid_count - tolerance) &
+                (records['sum'] <= records['max'] * valid_count + tolerance))
+
+        sums += np.bincount(first_bins[inside], weights=records['sum'][inside],
+                minlength=num_bins)
+        covered += np.bincount(first_bins[inside], weights=records['valid_count'][inside],
+                minlength=num_bins)
+
+        for (record, offset, chrom_end) in zip(records[~inside], offsets[~inside], ends[~inside]):
+            (start, end) = (int(record['start']), min(int(record['end']), int(chrom_end)))
+            intervals = bwf.intervals(bw_chroms[record['chrom']], start, end)
+
+            if not intervals:
+                continue
+
+            intervals = np.array(intervals, dtype=float)
+            (piece_sums, piece_covered) = intervals_to_bins(
+                    np.maximum(intervals[:,0], start).astype(np.int64) + offset,
+                    np.minimum(intervals[:,1], end).astype(np.int64) + offset,
+                    intervals[:,2], bin_size, (offset + start) // bin_size,
+                    (offset + end - 1) // bin_size + 1)
+            first_bin = (offset + start) // bin_size
+
+            sums[first_bin:first_bin + len(piece_sums)] += piece_sums
+            covered[first_bin:first_bin + len(piece_sums)] += piece_covered
+
+    bin_edges = np.minimum(np.arange(num_bins + 1) * bin_size, chrom_start)
+
+    return (sums, np.diff(bin_edges) - covered, covered)
+
+def get_bigwig_intervals(bwf, chroms, chrom_lengths):
+    '''
+    Get all of the intervals with values in a bigWig file, with their
+    positions translated so that the given chromosomes follow each other.
+
+    :param bwf: An open pyBigWig file
+    :param chroms: The chromosomes to get the intervals for, in order
+    :param chrom_lengths: A dictionary of chromosome lengths
+    :return: A (starts, ends, values) tuple of arrays, sorted by position
+    '''
+    starts = []
+    ends = []
+    values = []
+    chrom_start = 0
+
+    for chrom in chroms:
+        intervals = None
+        if chrom in bwf.chroms():
+            intervals = bwf.intervals(chrom)
+
+        # chromosomes without any values don't need anything stored
+        if intervals:
+            intervals = np.array(intervals, dtype=float)
+
+            starts += [intervals[:,0].astype(int) + chrom_start]
+            ends += [intervals[:,1].astype(int) + chrom_start]
+            values += [intervals[:,2]]
+
+        chrom_start += chrom_lengths[chrom]
+
+    if len(starts) == 0:
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0))
+
+    return (np.concatenate(starts), np.concatenate(ends), np.concatenate(values))
+
+def intervals_to_bins(starts, ends, values, bin_size, first_bin, last_bin):
+    '''
+    Calculate the sum of the values and the number of bases covered by
+    a set of non-overlapping intervals in consecutive bins.
+
+    :param starts: The sorted start positions of the intervals
+    :param ends: The end positions of the intervals
+    :param values: The value of each base in each interval
+    :param bin_size: The width of each bin
+    :param first_bin: The first bin to calculate values for
+    :param last_bin: The bin after the last one to calculate values for
+    :return: A (sums, covered) tuple of arrays
+    '''
+    num_bins = last_bin - first_bin
+    window_start = first_bin * bin_size
+    window_end = last_bin * bin_size
+
+    lo = np.searchsorted(ends, window_start, side='right')
+    hi = np.searchsorted(starts, window_end, side='left')
+
+    starts = np.maximum(starts[lo:hi], window_start)
+    ends = np.minimum(ends[lo:hi], window_end)
+    values = values[lo:hi]
+
+    if bin_size == 1:
+        # every interval is a slice of the window
+        covered = np.zeros(num_bins + 1)
+        np.add.at(covered, starts - window_start, 1)
+        np.add.at(covered, ends - window_start, -1)
+        covered = np.cumsum(covered[:-1])
+
+        sums = np.zeros(num_bins)
+        sums[covered > 0] = np.repeat(values, ends - starts)
+
+        return (sums, covered)
+
+    # split the intervals at the bin boundaries
+    pieces_per_interval = (ends - 1) // bin_size - starts // bin_size + 1
+    piece_offsets = (np.arange(pieces_per_interval.sum()) -
+            np.repeat(np.cumsum(pieces_per_interval) - pieces_per_interval, pieces_per_interval))
+    piece_bins = np.repeat(starts // bin_size, pieces_per_interval) + piece_offsets
+
+    piece_widths = (np.minimum(np.repeat(ends, pieces_per_interval), (piece_bins + 1) * bin_size) -
+            np.maximum(np.repeat(starts, pieces_per_interval), piece_bins * bin_size))
+
+    sums = np.bincount(piece_bins - first_bin,
+            weights=piece_widths * np.repeat(values, pieces_per_interval), minlength=num_bins)
+    covered = np.bincount(piece_bins - first_bin, weights=piece_widths, minlength=num_bins)
+
+    return (sums, covered)
+
+def _bigwig(filepath, chunk_size=14, zoom_step=8, tile_size=1024, output_file=None, assembly='hg19', 
+        chromsizes_filename=None, chromosome=None, use_zoom_summaries=False, use_intervals=False,
+        resume=False, checkpoint_interval=600, stats_file=None, skip_fine_levels=False):
+    last_end = 0
+    data = []
+    stats = cs.AggregationStats('bigwig', stats_file)
+
+    if output_file is None:
+        if chromosome is None:
+            output_file = op.splitext(filepath)[0] + '.hitile'
+        else:
+            output_file = op.splitext(filepath)[0] + '.' + chromosome + '.hitile'
+
+    (f, checkpoint) = ccc.open_output_file(output_file, resume)
+
+    (chrom_info, chrom_order, chrom_sizes) = ccu.get_chrominfo(assembly, chromsizes_filename)
+
+    stats.log("chrom_order:", chrom_order)
+    assembly_size = chrom_info.total_length
+
+    tile_size = tile_size
+    chunk_size = tile_size * 2**chunk_size     # how many values to read in at once while tiling
+
+    dsets = []     # data sets at each zoom level
+    nan_dsets = []
+
+    # initialize the arrays which will store the values at each stored zoom level
+    z = 0
+    positions = []   # store where we are at the current dataset
+    data_buffers = [[]]
+    nan_data_buffers = [[]]
+
+    while assembly_size / 2 ** z > tile_size:
+        dset_length = math.ceil(assembly_size / 2 ** z)
+
+        if use_intervals or skip_fine_levels:
+            # regions without any intervals (or levels which aren't
+            # calculated) are never written
+            dsets += [f.require_dataset('values_' + str(z), (dset_length,), dtype='f',compression='gzip',
+                fillvalue=np.nan)]
+            nan_dsets += [f.require_dataset('nan_values_' + str(z), (dset_length,), dtype='f',compression='gzip',
+                fillvalue=2 ** z)]
+        else:
+            dsets += [f.require_dataset('values_' + str(z), (dset_length,), dtype='f',compression='gzip')]
+            nan_dsets += [f.require_dataset('nan_values_' + str(z), (dset_length,), dtype='f',compression='gzip')]
+
+        data_buffers += [[]]
+        nan_data_buffers += [[]]
+
+        positions += [0]
+        z += zoom_step
+
+
+    # load the bigWig file
+    bwf = pbw.open(filepath)
+
+    # the number of stored zoom levels which are calculated by aggregating
+    # the base-level values, the remaining ones come from the bigWig's own
+    # zoom level summaries
+    num_exact_levels = len(dsets)
+    first_summary_level = len(dsets)
+
+    # the resolution of the zoom level summary used for each level
+    summary_resolutions = {}
+
+    if use_zoom_summaries:
+        zoom_resolutions = get_bigwig_zoom_resolutions(filepath)
+
+        # a level can only be calculated from a summary whose resolution
+        # divides its bin size, the coarsest such summary is used
+        for level in range(len(dsets)):
+            dividing = [r for r in zoom_resolutions if (2 ** (level * zoom_step)) % r == 0]
+
+            if len(dividing) > 0:
+                summary_resolutions[level] = max(dividing)
+
+        if len(summary_resolutions) > 0:
+            # levels finer than that have to be calculated from the
+            # base-level values, unless they're skipped altogether
+            first_summary_level = min(summary_resolutions)
+            num_exact_levels = 0 if skip_fine_levels else max(1, first_summary_level)
+            first_summary_level = max(first_summary_level, num_exact_levels)
+            stats.log("using zoom summaries for levels:", list(range(first_summary_level, len(dsets))))
+
+    if skip_fine_levels and num_exact_levels > 0:
+        raise ValueError("--skip-fine-levels needs --use-zoom-summaries and a bigWig "
+                "file with zoom level summaries")
+
+    # store some meta data
+    d = f.require_dataset('meta', (1,), dtype='f')
+
+    if chromosome is not None:
+        d.attrs['min-pos'] = chrom_info.cum_chrom_lengths[chromosome]
+        d.attrs['max-pos'] = chrom_info.cum_chrom_lengths[chromosome] + bwf.chroms()[chromosome]
+    else:
+        d.attrs['min-pos'] = 0
+        d.attrs['max-pos'] = assembly_size
+
+    '''
+    stats.log("chroms.keys:", bwf.chroms().keys())
+    stats.log("chroms.values:", bwf.chroms().values())
+    '''
+
+    d.attrs['zoom-step'] = zoom_step
+    d.attrs['max-length'] = assembly_size
+    d.attrs['assembly'] = assembly
+    d.attrs['chrom-names'] = [a.encode('utf-8') for a in chrom_order]
+    d.attrs['chrom-sizes'] = chrom_sizes
+    d.attrs['chrom-order'] = [a.encode('utf-8') for a in chrom_order]
+    d.attrs['tile-size'] = tile_size
+    d.attrs['max-zoom'] = max_zoom =  math.ceil(math.log(d.attrs['max-length'] / tile_size) / math.log(2))
+    d.attrs['max-width'] = tile_size * 2 ** max_zoom
+    d.attrs['max-position'] = 0
+
+    stats.log("assembly size (max-length)", d.attrs['max-length'])
+    stats.log("max-width", d.attrs['max-width'])
+    stats.log("max_zoom:", d.attrs['max-zoom'])
+    stats.log("chunk-size:", chunk_size)
+    stats.log("chrom-order", d.attrs['chrom-order'])
+
+    curr_zoom = 0
+
+    def add_values_to_data_buffers(buffers_to_add, nan_buffers_to_add):
+        curr_zoom = 0
+
+        data_buffers[0] += buffers_to_add
+        nan_data_buffers[0] += nan_buffers_to_add
+
+        stats.report(position=positions[0], progress=positions[0] / float(assembly_size))
+
+        while len(data_buffers[curr_zoom]) >= chunk_size:
+            # get the current chunk and store it, converting nans to 0
+            curr_chunk = np.array(data_buffers[curr_zoom][:chunk_size])
+            nan_curr_chunk = np.array(nan_data_buffers[curr_zoom][:chunk_size])
+            #curr_chunk[np.isnan(curr_chunk)] = 0
+            '''
+            print("1cc:", sum(curr_chunk))
+            print("1db:", data_buffers[curr_zoom][:chunk_size])
+            print("1curr_chunk:", nan_curr_chunk)
+            '''
+            with stats.timer('hdf5_write'):
+                dsets[curr_zoom][positions[curr_zoom]:positions[curr_zoom]+chunk_size] = curr_chunk
+                nan_dsets[curr_zoom][positions[curr_zoom]:positions[curr_zoom]+chunk_size] = nan_curr_chunk
+
+            # aggregate nan values
+            #nan_curr_chunk[np.isnan(curr_chunk)] = 0
+            #print("1na_cc:", sum(nan_curr_chunk))
+
+            # aggregate and store aggregated values in the next zoom_level's data
+            if curr_zoom + 1 < num_exact_levels:
+                with stats.timer('aggregate'):
+                    data_buffers[curr_zoom+1] += list(ct.aggregate(curr_chunk, 2 ** zoom_step))
+                    nan_data_buffers[curr_zoom+1] += list(ct.aggregate(nan_curr_chunk, 2 ** zoom_step))
+
+            data_buffers[curr_zoom] = data_buffers[curr_zoom][chunk_size:]
+            nan_data_buffers[curr_zoom] = nan_data_buffers[curr_zoom][chunk_size:]
+
+            data = data_buffers[curr_zoom+1]
+            nan_data = nan_data_buffers[curr_zoom+1]
+
+            # do the same for the nan values buffers
+
+            positions[curr_zoom] += chunk_size
+            curr_zoom += 1
+
+            if curr_zoom * zoom_step >= max_zoom or curr_zoom >= num_exact_levels:
+                break
+
+    # Do we only want values from a single chromosome?
+    if chromosome is not None:
+        chroms_to_use = [chromosome]
+    else:
+        chroms_to_use = chrom_order
+
+    # where in the input to start reading values
+    (start_chrom_index, start_counter) = (0, 0)
+
+    if checkpoint is not None:
+        (state, data_buffers[:], nan_data_buffers[:], _) = checkpoint
+        positions[:] = state['positions']
+        (start_chrom_index, start_counter) = (state['chrom_index'], state['counter'])
+
+    last_checkpoint = time.time()
+
+    for (chrom_index, chrom) in enumerate(chroms_to_use):
+        '''
+        if chrom not in bwf.chroms():
+            print("skipping chrom (not in bigWig file):",
+            chrom, chrom_info.chrom_lengths[chrom])
+            continue
+        '''
+
+        counter = 0
+        # chrom_size = bwf.chroms()[chrom]
+        chrom_size = chrom_info.chrom_lengths[chrom]
+
+        # print("chrom_size:", chrom_size, bwf.chroms()[chrom])
+        d.attrs['max-position'] += chrom_size
+
+        if use_intervals or num_exact_levels == 0 or chrom_index < start_chrom_index:
+            # the intervals are read all at once below and the values
+            # before the checkpoint have already been stored
+            continue
+
+        if chrom_index == start_chrom_index:
+            counter = start_counter
+
+        while counter < chrom_size:
+            remaining = min(chunk_size, chrom_size - counter)
+
+            with stats.timer('read'):
+                if chrom not in bwf.chroms():
+                    values = [np.nan] * remaining
+                    nan_values = [1] * remaining
+                else:
+                    values = bwf.values(chrom, counter, counter + remaining)
+                    nan_values = np.isnan(values).astype('i4')
+            stats.add(rows=remaining)
+
+            # print("counter:", counter, "remaining:", remaining,
+            # "counter + remaining:", counter + remaining)
+            counter += remaining
+            curr_zoom = 0
+
+            add_values_to_data_buffers(list(values), list(nan_values))
+
+            if time.time() - last_checkpoint > checkpoint_interval:
+                ccc.save_checkpoint(output_file, f,
+                        {'chrom_index': chrom_index, 'counter': counter, 'positions': positions},
+                        data_buffers, nan_data_buffers)
+                last_checkpoint = time.time()
+
+    if use_intervals:
+        with stats.timer('read'):
+            (starts, ends, values) = get_bigwig_intervals(bwf, chroms_to_use, chrom_info.chrom_lengths)
+        stats.add(rows=len(starts))
+
+        for level in range(num_exact_levels):
+            bin_size = 2 ** (level * zoom_step)
+            num_bins = len(dsets[level])
+
+            for first_bin in range(0, num_bins, chunk_size):
+                last_bin = min(num_bins, first_bin + chunk_size)
+
+                # skip windows without any values, except for the last one
+                # which may have a partial bin
+                if (last_bin < num_bins and
+                        np.searchsorted(ends, first_bin * bin_size, side='right') ==
+                        np.searchsorted(starts, last_bin * bin_size, side='left')):
+                    continue
+
+                with stats.timer('aggregate'):
+                    (sums, covered) = intervals_to_bins(starts, ends, values,
+                            bin_size, first_bin, last_bin)
+                    bin_edges = np.minimum(np.arange(first_bin, last_bin + 1) * bin_size, assembly_size)
+
+                with stats.timer('hdf5_write'):
+                    dsets[level][first_bin:last_bin] = np.where(covered > 0, sums, np.nan)
+                    nan_dsets[level][first_bin:last_bin] = np.diff(bin_edges) - covered
+
+    # the buffers are only used when reading every value
+    while not use_intervals and num_exact_levels > 0:
+        # get the current chunk and store it
+        chunk_size = len(data_buffers[curr_zoom])
+        curr_chunk = np.array(data_buffers[curr_zoom][:chunk_size])
+        nan_curr_chunk = np.array(nan_data_buffers[curr_zoom][:chunk_size])
+
+        with stats.timer('hdf5_write'):
+            dsets[curr_zoom][positions[curr_zoom]:positions[curr_zoom]+chunk_size] = curr_chunk
+            nan_dsets[curr_zoom][positions[curr_zoom]:positions[curr_zoom]+chunk_size] = nan_curr_chunk
+
+        # aggregate and store aggregated values in the next zoom_level's data
+        if curr_zoom + 1 < num_exact_levels:
+            with stats.timer('aggregate'):
+                data_buffers[curr_zoom+1] += list(ct.aggregate(curr_chunk, 2 ** zoom_step))
+                nan_data_buffers[curr_zoom+1] += list(ct.aggregate(nan_curr_chunk, 2 ** zoom_step))
+
+        data_buffers[curr_zoom] = data_buffers[curr_zoom][chunk_size:]
+        nan_data_buffers[curr_zoom] = nan_data_buffers[curr_zoom][chunk_size:]
+
+        data = data_buffers[curr_zoom+1]
+        nan_data = nan_data_buffers[curr_zoom+1]
+
+        positions[curr_zoom] += chunk_size
+        curr_zoom += 1
+
+        # we've created enough tile levels to cover the entire maximum width
+        if curr_zoom * zoom_step >= max_zoom or curr_zoom >= num_exact_levels:
+            break
+
+    # fill in the coarser levels using the bigWig's zoom level summaries
+    for level in range(first_summary_level, len(dsets)):
+        if level not in summary_resolutions:
+            # there's no summary to use, so aggregate the level below
+            with stats.timer('aggregate'):
+                values = ct.aggregate(dsets[level - 1][:], 2 ** zoom_step)
+                nan_counts = ct.aggregate(nan_dsets[level - 1][:], 2 ** zoom_step)
+
+            with stats.timer('hdf5_write'):
+                dsets[level][:] = values[:len(dsets[level])]
+                nan_dsets[level][:] = nan_counts[:len(dsets[level])]
+            continue
+
+        with stats.timer('read_summaries'):
+            (sums, nan_counts, covered) = get_zoom_summary_bins(bwf, filepath,
+                    summary_resolutions[level], chroms_to_use, chrom_info.chrom_lengths,
+                    2 ** (level * zoom_step), len(dsets[level]))
+
+        with stats.timer('hdf5_write'):
+            dsets[level][:] = np.where(covered > 0, sums, np.nan)
+            nan_dsets[level][:] = nan_counts
+
+    # the output is complete so there's nothing to resume
+    f.close()
+    if op.exists(ccc.get_checkpoint_filename(output_file)):
+        os.remove(ccc.get_checkpoint_filename(output_file))
+
+    stats.close()
+
+    # still need to take care of the last chunk
+
+    data = np.array(data)
+    pass
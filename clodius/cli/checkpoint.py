@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function
+
+import h5py
+import json
+import numpy as np
+import os
+import os.path as op
+
+def get_checkpoint_filename(output_file):
+    '''
+    The name of the file used to store checkpoints while creating
+    output_file.
+    '''
+    return output_file + '.checkpoint'
+
+def save_checkpoint(output_file, hdf_file, state, data_buffers, nan_data_buffers, **arrays):
+    '''
+    Save the progress of an aggregation so that it can be resumed later.
+
+    :param output_file: The hitile file being created
+    :param hdf_file: The open output file, flushed so that it's consistent
+        with the checkpoint
+    :param state: A JSON serializable dictionary describing how far along
+        the input we are
+    :param data_buffers: The values which haven't been stored yet at each
+        zoom level
+    :param nan_data_buffers: The nan counts which haven't been stored yet at
+        each zoom level
+    :param arrays: Any other arrays that need to be saved
+    '''
+    hdf_file.flush()
+
+    for (i, (data_buffer, nan_data_buffer)) in enumerate(zip(data_buffers, nan_data_buffers)):
+        arrays['data_buffer_{}'.format(i)] = np.array(data_buffer, dtype=float)
+        arrays['nan_data_buffer_{}'.format(i)] = np.array(nan_data_buffer, dtype=float)
+
+    state = dict(state, num_buffers=len(data_buffers))
+
+    # write to a temporary file first so that a crash while saving
+    # doesn't clobber the previous checkpoint
+    checkpoint_file = get_checkpoint_filename(output_file)
+    with open(checkpoint_file + '.tmp', 'wb') as f:
+        np.savez(f, state=np.array(json.dumps(state)), **arrays)
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+def load_checkpoint(output_file):
+    '''
+    Load the last checkpoint saved while creating output_file.
+
+    :param output_file: The hitile file being created
+    :return: A (state, data_buffers, nan_data_buffers, arrays) tuple, or
+        None if there's nothing to resume from
+    '''
+    checkpoint_file = get_checkpoint_filename(output_file)
+
+    if not op.exists(checkpoint_file) or not op.exists(output_file):
+        return None
+
+    with np.load(checkpoint_file) as checkpoint:
+        arrays = {k: checkpoint[k] for k in checkpoint.files}
+
+    state = json.loads(str(arrays.pop('state')))
+    num_buffers = state.pop('num_buffers')
+
+    data_buffers = [list(arrays.pop('data_buffer_{}'.format(i))) for i in range(num_buffers)]
+    nan_data_buffers = [list(arrays.pop('nan_data_buffer_{}'.format(i))) for i in range(num_buffers)]
+
+    return (state, data_buffers, nan_data_buffers, arrays)
+
+def open_output_file(output_file, resume):
+    '''
+    Open the hitile file to aggregate into.
+
+    :param output_file: The name of the output file
+    :param resume: Continue from the last checkpoint, if there is one
+    :return: A (h5py.File, checkpoint) tuple where checkpoint is the
+        value returned by load_checkpoint or None when starting over
+    '''
+    checkpoint = None
+
+    if resume:
+        checkpoint = load_checkpoint(output_file)
+
+        if checkpoint is None:
+            print("no checkpoint found, starting from the beginning")
+
+    if checkpoint is not None:
+        print("resuming from checkpoint:", get_checkpoint_filename(output_file))
+        return (h5py.File(output_file, 'r+'), checkpoint)
+
+    # Override the output file if it existts
+    if op.exists(output_file):
+        os.remove(output_file)
+    if op.exists(get_checkpoint_filename(output_file)):
+        os.remove(get_checkpoint_filename(output_file))
+
+    return (h5py.File(output_file, 'w'), None)
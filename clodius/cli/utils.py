@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function
+
+import gzip
+import hashlib
+import multiprocessing as mpr
+import negspy.coordinates as nc
+import numpy as np
+import os.path as op
+import slugid
+import sys
+
+# the chromosome information that has already been loaded, keyed by the
+# chromsizes file or the assembly it came from
+chrominfo_cache = {}
+
+def get_chrominfo(assembly=None, chromsizes_filename=None):
+    '''
+    Get the chromosome information for a chromsizes file or, if no file
+    is given, for an assembly. It's only read once per process, so the
+    worker processes forked after loading it share the same copy.
+
+    :param assembly: The name of an assembly known to negspy
+    :param chromsizes_filename: A file listing the chromosomes and their
+        sizes, used instead of the assembly
+    :return: A (chrom_info, chrom_order, chrom_sizes) tuple
+    '''
+    key = ('file', chromsizes_filename) if chromsizes_filename is not None else ('assembly', assembly)
+
+    if key not in chrominfo_cache:
+        if chromsizes_filename is not None:
+            chrominfo_cache[key] = nc.get_chrominfo_from_file(chromsizes_filename)
+        else:
+            chrominfo_cache[key] = nc.get_chrominfo(assembly)
+
+    chrom_info = chrominfo_cache[key]
+    chrom_order = list(chrom_info.chrom_order)
+
+    return (chrom_info, chrom_order, [chrom_info.chrom_lengths[c] for c in chrom_order])
+
+def store_meta_data(cursor, zoom_step, max_length, assembly, chrom_names, 
+        chrom_sizes, tile_size, max_zoom, max_width):
+    cursor.execute('''
+        CREATE TABLE tileset_info
+        (
+            zoom_step INT,
+            max_length INT,
+            assembly text,
+            chrom_names text,
+            chrom_sizes text,
+            tile_size REAL,
+            max_zoom INT,
+            max_width REAL
+        )
+        ''')
+
+    cursor.execute('INSERT INTO tileset_info VALUES (?,?,?,?,?,?,?,?)',
+            (zoom_step, max_length, assembly, 
+                "\t".join(chrom_names), "\t".join(map(str,chrom_sizes)),
+                tile_size, max_zoom, max_width))
+    cursor.commit()
+
+    pass
+
+# all entries are broked up into ((tile_pos), [entry]) tuples
+# we just need to reduce the tiles so that no tile contains more than
+# max_entries_per_tile entries
+# (notice that [entry] is an array), this format will be important when
+# reducing to the most important values
+def reduce_values_by_importance(entry1, entry2, max_entries_per_tile=100, reverse_importance=False):
+    def extract_key(entries):
+        return [(e[-2], e) for e in entries]
+    by_uid = dict(extract_key(entry1) + extract_key(entry2))
+    combined_by_uid = by_uid.values()
+
+    if reverse_importance:
+        combined_entries = sorted(combined_by_uid,
+                key=lambda x: float(x[-1]))
+    else:
+        combined_entries = sorted(combined_by_uid,
+                key=lambda x: -float(x[-1]))
+
+    byKey = {}
+
+    return combined_entries[:max_entries_per_tile]
+
+# the ways of identifying features in a .multires.db file, and the type of
+# the uid column for each of them
+UID_TYPES = {'slugid': 'text', 'hash': 'int'}
+
+def make_uid(fields, uid_type='slugid'):
+    '''
+    Create the uid that a feature is stored with.
+
+    :param fields: The feature's line (as text or utf-8 bytes)
+    :param uid_type: Either 'slugid' for a random slugid (which changes
+        every time the file is aggregated) or 'hash' for a 63 bit integer
+        hash of the line, which stays the same as long as the line does.
+        Identical lines get the same uid.
+    '''
+    if uid_type == 'hash':
+        if not isinstance(fields, bytes):
+            fields = fields.encode('utf-8')
+
+        digest = hashlib.blake2b(fields, digest_size=8).digest()
+        return int.from_bytes(digest, 'little') >> 1
+
+    return slugid.nice().decode('utf-8')
+
+def is_tabix_indexed(filepath):
+    return filepath.endswith('.gz') and op.exists(filepath + '.tbi')
+
+def read_chromosome_lines(filepath, chromosome=None, chrom_col=1, delimiter=None,
+        has_header=False):
+    '''
+    Iterate over the lines of a text file, optionally only keeping the ones
+    on a single chromosome.
+
+    Bgzipped files with a tabix index (filepath + '.tbi') are read by
+    seeking straight to the chromosome's blocks. Otherwise every line is
+    read, but lines on other chromosomes are skipped without being split
+    whenever the chromosome is in the first column.
+
+    :param filepath: The file to read (optionally gzipped), '-' for stdin
+    :param chromosome: The chromosome to keep the lines of (None for all
+        of them)
+    :param chrom_col: The column (1-based) containing the chromosome
+    :param delimiter: The column delimiter (None for any whitespace)
+    :param has_header: Skip the first line of the file
+    :return: A generator of lines
+    '''
+    if chromosome is not None and is_tabix_indexed(filepath):
+        import pysam
+
+        tbx = pysam.TabixFile(filepath)
+
+        try:
+            # the header isn't part of the index
+            if chromosome in tbx.contigs:
+                for line in tbx.fetch(chromosome):
+                    yield line
+        finally:
+            tbx.close()
+
+        return
+
+    if filepath == '-':
+        f = sys.stdin
+    elif filepath.endswith('.gz'):
+        f = gzip.open(filepath, 'rt')
+    else:
+        f = open(filepath, 'r')
+
+    if chromosome is None:
+        def matches(line):
+            return True
+    elif chrom_col == 1:
+        name_length = len(chromosome)
+
+        def matches(line):
+            if not line.startswith(chromosome):
+                return False
+
+            if delimiter is None:
+                return line[name_length:name_length+1].isspace()
+            return line[name_length:name_length+len(delimiter)] == delimiter
+    else:
+        def matches(line):
+            parts = line.split(delimiter, chrom_col)
+            return len(parts) >= chrom_col and parts[chrom_col-1].strip() == chromosome
+
+    try:
+        if has_header:
+            f.readline()
+
+        for line in f:
+            if matches(line):
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def map_partitions(function, partitions, num_workers=1, sizes=None):
+    '''
+    Call a function on each partition of an input using a pool of worker
+    processes.
+
+    :param function: A module level function taking a partition
+    :param partitions: The list of partitions (e.g. chromosomes)
+    :param num_workers: The number of worker processes. Everything is run
+        in this process if there's only one
+    :param sizes: The size of each partition, used to start with the
+        largest ones so that the workers finish at about the same time
+    :return: The list of results, in the same order as the partitions
+    '''
+    order = list(range(len(partitions)))
+    if sizes is not None:
+        order.sort(key=lambda i: -sizes[i])
+
+    results = [None] * len(partitions)
+
+    if num_workers <= 1 or len(partitions) <= 1:
+        for i in order:
+            results[i] = function(partitions[i])
+
+        return results
+
+    pool = mpr.Pool(min(num_workers, len(partitions)))
+
+    try:
+        for (i, result) in zip(order, pool.imap(function, [partitions[i] for i in order])):
+            results[i] = result
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return results
+
+def partition_tiles(starts, ends, tile_width, inclusive_end=False):
+    '''
+    Split entries into groups of consecutive tiles which no entry crosses
+    the boundaries between. The tiles of one group, and the tiles at higher
+    zoom levels within them, don't share any entries with the other groups,
+    so they can be filled independently.
+
+    :param starts: The start position of each entry
+    :param ends: The end position of each entry
+    :param tile_width: The width of the tiles to group
+    :param inclusive_end: Whether an entry which ends on a tile boundary
+        is in the tile after it
+    :return: A list of arrays with the (sorted) indices of the entries in
+        each group
+    '''
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+
+    first_tiles = starts // tile_width
+    if inclusive_end:
+        last_tiles = ends // tile_width
+    else:
+        last_tiles = np.maximum(first_tiles, (ends - 1) // tile_width)
+
+    order = np.argsort(first_tiles, kind='mergesort')
+
+    if len(order) == 0:
+        return []
+
+    # a group ends at a tile that none of the entries before it extend past
+    reach = np.maximum.accumulate(last_tiles[order])
+    group_starts = np.flatnonzero(first_tiles[order][1:] > reach[:-1]) + 1
+
+    return [np.sort(group) for group in np.split(order, group_starts)]
+
+def get_partition_zoom(max_zoom, num_workers):
+    '''
+    The zoom level whose tiles are split between worker processes, with a
+    few tiles per worker so that they can be balanced.
+    '''
+    return min(max_zoom, (num_workers - 1).bit_length() + 2)
+
+def check_chromosomes(filepath, chromosomes, chrom_col=1, delimiter=None,
+        has_header=False):
+    '''
+    Make sure that all of the lines of a file are on known chromosomes.
+    Reading a file one chromosome at a time would otherwise silently skip
+    the others, rather than failing like reading the whole file does.
+
+    :param chromosomes: The names of the known chromosomes
+    :raises KeyError: If there are lines on any other chromosome
+    '''
+    if is_tabix_indexed(filepath):
+        import pysam
+
+        tbx = pysam.TabixFile(filepath)
+        names = tbx.contigs
+        tbx.close()
+    else:
+        names = set([line.split(delimiter, chrom_col)[chrom_col-1].strip()
+            for line in read_chromosome_lines(filepath, None, chrom_col, delimiter, has_header)
+            if line.strip()])
+
+    known = set(chromosomes)
+    unknown = sorted([name for name in names if name not in known])
+
+    if len(unknown) > 0:
+        raise KeyError("Chromosome {} isn't in the assembly".format(unknown[0]))
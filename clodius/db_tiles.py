@@ -1,5 +1,4 @@
 import collections as col
-import math
 import sqlite3
 
 def get_tileset_info(db_file):
@@ -44,7 +43,133 @@ def get_2d_tileset_info(db_file):
 
     return tileset_info
 
-def get_tiles(db_file, zoom, tile_x_pos, num_tiles=1):
+def get_selected_columns(c, columns, position_columns, include_fields):
+    '''
+    The columns of the intervals table to retrieve, checking that any
+    extra columns exist.
+    '''
+    table_columns = [row[1] for row in c.execute('PRAGMA table_info(intervals)')]
+
+    for column in columns:
+        if column not in table_columns:
+            raise ValueError('No such column: {}'.format(column))
+
+    return (position_columns + ['chrOffset', 'importance', 'uid'] +
+            (['fields'] if include_fields else []) + list(columns))
+
+def get_zoom_lengths(c, zoom):
+    '''
+    The length of the longest interval at each zoom level up to zoom, for
+    files which store their intervals sorted by zoom level and position
+    (`clodius aggregate bedfile --layout sorted`).
+
+    :return: A list of (zoom level, max length) tuples, or None if the
+        intervals are indexed with an rtree instead
+    '''
+    layout = c.execute("SELECT name FROM sqlite_master WHERE name='zoom_levels'").fetchone()
+
+    if layout is None:
+        return None
+
+    return c.execute('SELECT zoomLevel, maxLength FROM zoom_levels WHERE zoomLevel <= ?',
+            (zoom,)).fetchall()
+
+def query_intervals(c, selected_columns, zoom, bounds, min_importance, max_importance,
+        limit=None, zoom_lengths=None):
+    '''
+    Retrieve the intervals that overlap a region.
+
+    :param bounds: A list of (from column, to column, start, end) tuples,
+        one for each dimension. An interval is in the region if it starts
+        before the end and ends at or after the start. The position_index
+        columns are named after the intervals columns (e.g. startPos and
+        rStartPos).
+    :param limit: Only return the limit most important intervals
+    :param zoom_lengths: The result of get_zoom_lengths, if the intervals
+        are sorted rather than indexed with an rtree
+    :return: A list of dictionaries, indexed by the selected columns
+    '''
+    if zoom_lengths is not None:
+        # the intervals at each zoom level that overlap the region start
+        # within one range, which can be read straight from the table's
+        # primary key
+        (from_column, to_column, start, end) = bounds[0]
+
+        if len(zoom_lengths) == 0:
+            return []
+
+        tables = 'intervals'
+        conditions = ['(' + ' or '.join(['(zoomLevel = ? and {0} >= ? and {0} < ?)'.format(
+            from_column)] * len(zoom_lengths)) + ')', '{} >= ?'.format(to_column)]
+        params = []
+
+        for (zoom_level, max_length) in zoom_lengths:
+            params += [zoom_level, start - max_length, end]
+        params += [start]
+    else:
+        tables = 'intervals,position_index'
+        conditions = ['intervals.id=position_index.id', 'zoomLevel <= ?']
+        params = [zoom]
+
+        for (from_column, to_column, start, end) in bounds:
+            # the rtree's bounds are only approximate, so they're used to find
+            # the candidate intervals, which are then checked exactly
+            conditions += ['r{} >= ?'.format(to_column[0].upper() + to_column[1:]),
+                    'r{} <= ?'.format(from_column[0].upper() + from_column[1:]),
+                    '{} < ?'.format(from_column), '{} >= ?'.format(to_column)]
+            params += [start, end, end, start]
+
+    if min_importance is not None:
+        conditions += ['importance >= ?']
+        params += [min_importance]
+    if max_importance is not None:
+        conditions += ['importance <= ?']
+        params += [max_importance]
+
+    query = '''
+    SELECT {} from {}
+    where
+    {}
+    '''.format(', '.join(selected_columns), tables, ' and '.join(conditions))
+
+    if limit is not None:
+        query += 'ORDER BY importance DESC, intervals.id LIMIT ?'
+        params += [limit]
+
+    rows = c.execute(query, params).fetchall()
+
+    return [dict(zip(selected_columns, row)) for row in rows]
+
+def format_interval(r, positions, columns):
+    '''
+    Convert a row returned by query_intervals into the interval that's
+    served.
+
+    :param positions: A list of (row column, served name) pairs for the
+        position columns
+    :param columns: The extra columns that were retrieved
+    '''
+    interval = dict([(name, r[column]) for (column, name) in positions])
+
+    interval['chrOffset'] = r['chrOffset']
+    interval['importance'] = r['importance']
+
+    # uids are either text or integers, but are always served as text
+    try:
+        interval['uid'] = r['uid'].decode('utf-8')
+    except AttributeError:
+        interval['uid'] = str(r['uid'])
+
+    for column in columns:
+        interval[column] = r[column]
+
+    if 'fields' in r:
+        interval['fields'] = r['fields'].split('\t')
+
+    return interval
+
+def get_tiles(db_file, zoom, tile_x_pos, num_tiles=1, min_importance=None,
+        max_importance=None, max_per_tile=None, include_fields=True, columns=()):
     '''
     Retrieve a contiguous set of tiles from a db tile file.
 
@@ -58,7 +183,17 @@ def get_tiles(db_file, zoom, tile_x_pos, num_tiles=1):
         The position of the first tile
     num_tiles: int
         The number of tiles to retrieve
-
+    min_importance: float
+        Only return the intervals at least this important
+    max_importance: float
+        Only return the intervals at most this important
+    max_per_tile: int
+        Only return the most important intervals in each tile
+    include_fields: bool
+        Return the fields of each interval
+    columns: [str]
+        Other columns of the intervals table to return (e.g. ones stored
+        with `clodius aggregate bedpe --column`)
     Returns
     -------
     tiles: {pos: tile_value}
@@ -70,51 +205,47 @@ def get_tiles(db_file, zoom, tile_x_pos, num_tiles=1):
     c = conn.cursor()
 
     tile_width = tileset_info['max_width'] / 2 ** zoom
+    selected_columns = get_selected_columns(c, columns, ['startPos', 'endPos'],
+            include_fields)
+    zoom_lengths = get_zoom_lengths(c, zoom)
 
-    tile_start_pos = tile_width * tile_x_pos
-    tile_end_pos = tile_start_pos + num_tiles * tile_width
-
-    query = '''
-    SELECT startPos, endPos, chrOffset, importance, fields, uid from intervals,position_index 
-    where 
-    intervals.id=position_index.id and zoomLevel <= {} and rEndPos >= {} and rStartPos <= {}
-    '''.format(zoom, tile_start_pos, tile_end_pos)
-
-    rows = c.execute(query).fetchall()
+    # with a limit on the number of intervals per tile, each tile has to be
+    # retrieved separately
+    if max_per_tile is None:
+        queries = [(tile_x_pos, num_tiles)]
+    else:
+        queries = [(i, 1) for i in range(tile_x_pos, tile_x_pos + num_tiles)]
 
     new_rows = col.defaultdict(list)
 
-    for r in rows:
-        try:
-            uid = r[5].decode('utf-8')
-        except AttributeError:
-            uid = r[5]
+    for (first_tile, query_tiles) in queries:
+        tile_start_pos = tile_width * first_tile
+        tile_end_pos = tile_start_pos + query_tiles * tile_width
 
-        tile_pos = tile_x_pos +  math.floor((r[0] - tile_start_pos) / tile_width)
-        #print("tile_pos:", tile_pos)
+        rows = query_intervals(c, selected_columns, zoom,
+                [('startPos', 'endPos', tile_start_pos, tile_end_pos)],
+                min_importance, max_importance, max_per_tile, zoom_lengths)
 
-        x_start = r[0]
-        x_end = r[1]
+        for r in rows:
+            x_start = r['startPos']
+            x_end = r['endPos']
 
-        for i in range(tile_x_pos, tile_x_pos + num_tiles):
-            tile_x_start = i * tile_width
-            tile_x_end = (i+1) * tile_width
-            tile_pos = i
+            for i in range(first_tile, first_tile + query_tiles):
+                tile_x_start = i * tile_width
+                tile_x_end = (i+1) * tile_width
+                tile_pos = i
 
-            if x_start < tile_x_end and x_end >= tile_x_start:
-                new_rows[tile_pos] += [
+                if x_start < tile_x_end and x_end >= tile_x_start:
                     # add the position offset to the returned values
-                    {'xStart': r[0],
-                     'xEnd': r[1],
-                     'chrOffset': r[2],
-                     'importance': r[3],
-                     'uid': uid,
-                     'fields': r[4].split('\t')}]
+                    new_rows[tile_pos] += [format_interval(r,
+                        [('startPos', 'xStart'), ('endPos', 'xEnd')], columns)]
     conn.close()
 
     return new_rows
 
-def get_2d_tiles(db_file, zoom, tile_x_pos, tile_y_pos, numx=1, numy=1):
+def get_2d_tiles(db_file, zoom, tile_x_pos, tile_y_pos, numx=1, numy=1,
+        min_importance=None, max_importance=None, max_per_tile=None,
+        include_fields=True, columns=()):
     '''
     Retrieve a contiguous set of tiles from a 2D db tile file.
 
@@ -132,7 +263,17 @@ def get_2d_tiles(db_file, zoom, tile_x_pos, tile_y_pos, numx=1, numy=1):
         The width of the block of tiles to retrieve
     numy: int
         The height of the block of tiles to retrieve
-
+    min_importance: float
+        Only return the intervals at least this important
+    max_importance: float
+        Only return the intervals at most this important
+    max_per_tile: int
+        Only return the most important intervals in each tile
+    include_fields: bool
+        Return the fields of each interval
+    columns: [str]
+        Other columns of the intervals table to return (e.g. ones stored
+        with `clodius aggregate bedpe --column`)
     Returns
     -------
     tiles: {pos: tile_value}
@@ -144,55 +285,52 @@ def get_2d_tiles(db_file, zoom, tile_x_pos, tile_y_pos, numx=1, numy=1):
 
     c = conn.cursor()
     tile_width = tileset_info['max_width'] / 2 ** zoom
+    selected_columns = get_selected_columns(c, columns, ['fromX', 'toX', 'fromY', 'toY'],
+            include_fields)
 
-    tile_x_start_pos = tile_width * tile_x_pos
-    tile_x_end_pos = tile_x_start_pos + (numx * tile_width)
+    # with a limit on the number of intervals per tile, each tile has to be
+    # retrieved separately
+    if max_per_tile is None:
+        queries = [(tile_x_pos, tile_y_pos, numx, numy)]
+    else:
+        queries = [(i, j, 1, 1) for i in range(tile_x_pos, tile_x_pos + numx)
+                for j in range(tile_y_pos, tile_y_pos + numy)]
 
-    tile_y_start_pos = tile_width * tile_y_pos
-    tile_y_end_pos = tile_y_start_pos + (numy * tile_width)
-    
-    query = '''
-    SELECT fromX, toX, fromY, toY, chrOffset, importance, fields, uid from intervals,position_index 
-    where 
-    intervals.id=position_index.id and zoomLevel <= {} and rToX >= {} and rFromX <= {} and rToY >= {} and rFromY <= {}
-    '''.format(zoom, tile_x_start_pos, tile_x_end_pos, tile_y_start_pos, tile_y_end_pos)
+    new_rows = col.defaultdict(list)
 
-    rows = c.execute(query).fetchall()
+    for (first_x, first_y, query_x, query_y) in queries:
+        tile_x_start_pos = tile_width * first_x
+        tile_x_end_pos = tile_x_start_pos + (query_x * tile_width)
 
-    new_rows = col.defaultdict(list)
+        tile_y_start_pos = tile_width * first_y
+        tile_y_end_pos = tile_y_start_pos + (query_y * tile_width)
 
-    for r in rows:
-        try:
-            uid = r[7].decode('utf-8')
-        except AttributeError:
-            uid = r[7]
+        rows = query_intervals(c, selected_columns, zoom,
+                [('fromX', 'toX', tile_x_start_pos, tile_x_end_pos),
+                 ('fromY', 'toY', tile_y_start_pos, tile_y_end_pos)],
+                min_importance, max_importance, max_per_tile)
 
-        x_start = r[0]
-        x_end = r[1]
-        y_start = r[2]
-        y_end = r[3]
+        for r in rows:
+            x_start = r['fromX']
+            x_end = r['toX']
+            y_start = r['fromY']
+            y_end = r['toY']
 
-        for i in range(tile_x_pos, tile_x_pos + numx):
-            for j in range(tile_y_pos, tile_y_pos + numy):
-                tile_x_start = i * tile_width
-                tile_x_end = (i+1) * tile_width
+            for i in range(first_x, first_x + query_x):
+                for j in range(first_y, first_y + query_y):
+                    tile_x_start = i * tile_width
+                    tile_x_end = (i+1) * tile_width
 
-                tile_y_start = j * tile_width
-                tile_y_end = (j+1) * tile_width
+                    tile_y_start = j * tile_width
+                    tile_y_end = (j+1) * tile_width
 
-                if (x_start < tile_x_end and x_end >= tile_x_start 
-                    and y_start < tile_y_end and y_end >= tile_y_start):
+                    if (x_start < tile_x_end and x_end >= tile_x_start 
+                        and y_start < tile_y_end and y_end >= tile_y_start):
 
-                    # add the position offset to the returned values
-                    new_rows[(i,j)] += [
-                        {'xStart': r[0],
-                         'xEnd': r[1],
-                         'yStart': r[2],
-                         'yEnd': r[3],
-                         'chrOffset': r[4],
-                         'importance': r[5],
-                         'uid': uid ,
-                         'fields': r[6].split('\t')}]
+                        # add the position offset to the returned values
+                        new_rows[(i,j)] += [format_interval(r,
+                            [('fromX', 'xStart'), ('toX', 'xEnd'),
+                             ('fromY', 'yStart'), ('toY', 'yEnd')], columns)]
     conn.close()
 
     return new_rows
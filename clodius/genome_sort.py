@@ -0,0 +1,319 @@
+from __future__ import division, print_function
+
+import numpy as np
+import os.path as op
+import shutil
+import sys
+import tempfile
+
+# the sorted intermediate files are .npy files containing one of these
+# records per interval, in genome coordinates
+RECORD_DTYPE = np.dtype([('start', '<i8'), ('end', '<i8'), ('value', '<f8')])
+
+def get_chrom_offsets(chroms, chrom_info):
+    '''
+    Look up the genome position at which each chromosome starts.
+
+    :param chroms: An array of chromosome names
+    :param chrom_info: A negspy ChromosomeInfo
+    :return: An int64 array with the offset of each chromosome, or -1 for
+        chromosomes that aren't in the assembly
+    '''
+    (names, inverse) = np.unique(np.asarray(chroms), return_inverse=True)
+    offsets = np.array([chrom_info.cum_chrom_lengths.get(name, -1) for name in names],
+            dtype=np.int64)
+
+    return offsets[inverse.ravel()]
+
+def make_records(chroms, starts, ends, values, chrom_info):
+    '''
+    Convert chromosome coordinates to genome coordinates.
+
+    :param chroms: The chromosome of each interval
+    :param starts: The start of each interval within its chromosome
+    :param ends: The end of each interval within its chromosome
+    :param values: The value of each interval
+    :param chrom_info: A negspy ChromosomeInfo
+    :return: A tuple of (RECORD_DTYPE array, number of intervals that were
+        dropped because their chromosome isn't in the assembly)
+    '''
+    offsets = get_chrom_offsets(chroms, chrom_info)
+    known = offsets >= 0
+
+    records = np.empty(int(known.sum()), dtype=RECORD_DTYPE)
+    records['start'] = offsets[known] + np.asarray(starts, dtype=np.int64)[known]
+    records['end'] = offsets[known] + np.asarray(ends, dtype=np.int64)[known]
+    records['value'] = np.asarray(values, dtype=np.float64)[known]
+
+    return (records, len(known) - len(records))
+
+def read_bedgraph(filepath, chrom_info, chrom_col=1, from_pos_col=2, to_pos_col=3,
+        value_col=4, has_header=False, nan_value=None, chunk_size=2**20):
+    '''
+    Read a bedGraph file in chunks of genome coordinate records.
+
+    :param filepath: The bedGraph file (optionally gzipped), '-' for stdin
+    :param chrom_info: A negspy ChromosomeInfo
+    :param chrom_col: The column with the chromosome names (1-based), as
+        are the other column numbers
+    :param nan_value: The string representing missing values
+    :param chunk_size: The number of lines to parse at once
+    :return: A generator of RECORD_DTYPE arrays
+    '''
+    import pandas as pd
+
+    columns = [chrom_col - 1, from_pos_col - 1, to_pos_col - 1, value_col - 1]
+    reader = pd.read_csv(sys.stdin if filepath == '-' else filepath,
+            sep=r'\s+', header=None, usecols=columns,
+            skiprows=1 if has_header else 0, chunksize=chunk_size,
+            dtype={chrom_col - 1: str},
+            na_values=[nan_value] if nan_value is not None else None)
+    dropped = 0
+
+    for chunk in reader:
+        (records, num_dropped) = make_records(chunk[chrom_col - 1].values,
+                chunk[from_pos_col - 1].values, chunk[to_pos_col - 1].values,
+                chunk[value_col - 1].values, chrom_info)
+        dropped += num_dropped
+
+        yield records
+
+    if dropped > 0:
+        print("Skipped {} lines on chromosomes which aren't in the assembly".format(dropped),
+                file=sys.stderr)
+
+def read_bigwig(filepath, chrom_info, window_size=10 ** 7):
+    '''
+    Read the intervals of a bigWig file in chunks of genome coordinate
+    records.
+
+    :param filepath: The bigWig file
+    :param chrom_info: A negspy ChromosomeInfo
+    :param window_size: The number of bases to read the intervals of at once
+    :return: A generator of RECORD_DTYPE arrays
+    '''
+    import pyBigWig as pbw
+
+    bwf = pbw.open(filepath)
+
+    for (chrom, length) in bwf.chroms().items():
+        if chrom not in chrom_info.cum_chrom_lengths:
+            print("Skipping chromosome {} which isn't in the assembly".format(chrom),
+                    file=sys.stderr)
+            continue
+
+        for window_start in range(0, length, window_size):
+            intervals = bwf.intervals(chrom, window_start, min(length, window_start + window_size))
+
+            if intervals is None or len(intervals) == 0:
+                continue
+
+            intervals = np.array(intervals, dtype=np.float64)
+
+            # intervals which overlap the start of the window were read
+            # along with the previous window
+            intervals = intervals[intervals[:, 0] >= window_start]
+
+            (records, num_dropped) = make_records(np.repeat(chrom, len(intervals)),
+                    intervals[:, 0], intervals[:, 1], intervals[:, 2], chrom_info)
+
+            yield records
+
+    bwf.close()
+
+def sort_in_memory(records):
+    return records[np.lexsort((records['end'], records['start']))]
+
+def merge_runs(runs, output, block_size):
+    '''
+    Merge sorted runs of records into one sorted array.
+
+    Rather than comparing records one at a time, a block is taken from each
+    run and everything up to the smallest of the blocks' last records is
+    sorted and written at once. None of the records that haven't been read
+    yet can come before that.
+
+    :param runs: A list of sorted RECORD_DTYPE arrays
+    :param output: The array to write the merged records to
+    :param block_size: The number of records to take from each run at once
+    '''
+    offsets = [0] * len(runs)
+    output_pos = 0
+
+    while True:
+        active = [i for i in range(len(runs)) if offsets[i] < len(runs[i])]
+
+        if len(active) == 0:
+            break
+
+        blocks = [runs[i][offsets[i]:offsets[i] + block_size] for i in active]
+        (last_start, last_end) = min([(b['start'][-1], b['end'][-1]) for b in blocks])
+
+        merged = []
+        for (i, block) in zip(active, blocks):
+            # the blocks are sorted, so this selects a prefix of each
+            num_selected = int(((block['start'] < last_start) |
+                ((block['start'] == last_start) & (block['end'] <= last_end))).sum())
+
+            merged += [block[:num_selected]]
+            offsets[i] += num_selected
+
+        merged = sort_in_memory(np.concatenate(merged))
+        output[output_pos:output_pos + len(merged)] = merged
+        output_pos += len(merged)
+
+def sort_records(chunks, output_file, max_records=2**24, tmp_dir=None):
+    '''
+    Sort records by their genome position using a bounded amount of memory
+    and store them in a .npy file.
+
+    Up to max_records records are sorted in memory at a time and written
+    to temporary files, which are then merged.
+
+    :param chunks: An iterable of RECORD_DTYPE arrays (e.g. from
+        read_bedgraph or read_bigwig)
+    :param output_file: The .npy file to write the sorted records to
+    :param max_records: The maximum number of records to keep in memory
+    :param tmp_dir: Where to store the sorted runs (default: the system's
+        temporary directory)
+    :return: The number of records written
+    '''
+    run_dir = tempfile.mkdtemp(dir=tmp_dir)
+    run_files = []
+    buffered = []
+    num_buffered = 0
+
+    def write_run():
+        run_file = op.join(run_dir, 'run_{}.npy'.format(len(run_files)))
+        np.save(run_file, sort_in_memory(np.concatenate(buffered)))
+        run_files.append(run_file)
+
+    try:
+        for chunk in chunks:
+            buffered += [chunk]
+            num_buffered += len(chunk)
+
+            if num_buffered >= max_records:
+                write_run()
+                buffered = []
+                num_buffered = 0
+
+        if len(run_files) == 0:
+            # everything fit in memory
+            records = sort_in_memory(np.concatenate(buffered or [np.empty(0, dtype=RECORD_DTYPE)]))
+            np.save(output_file, records)
+
+            return len(records)
+
+        if num_buffered > 0:
+            write_run()
+
+        runs = [np.load(run_file, mmap_mode='r') for run_file in run_files]
+        num_records = sum([len(run) for run in runs])
+
+        output = np.lib.format.open_memmap(output_file, mode='w+',
+                dtype=RECORD_DTYPE, shape=(num_records,))
+        merge_runs(runs, output, max(1, max_records // (len(runs) + 1)))
+        output.flush()
+
+        del output
+        del runs
+
+        return num_records
+    finally:
+        shutil.rmtree(run_dir)
+
+def iter_sorted_records(filepath, skip=0, block_size=2**16, from_pos=None, to_pos=None):
+    '''
+    Iterate over the records in a sorted .npy file.
+
+    :param filepath: A file written by sort_records
+    :param skip: The number of records to skip
+    :param from_pos: Only return the records starting at or after this
+        genome position
+    :param to_pos: Only return the records starting before this genome
+        position
+    :return: A generator of (start, end, value) tuples
+    '''
+    records = np.load(filepath, mmap_mode='r')
+    (first, last) = (0, len(records))
+
+    # the records are sorted, so the ones in range can be found without
+    # reading the others
+    if from_pos is not None:
+        first = int(np.searchsorted(records['start'], from_pos, side='left'))
+    if to_pos is not None:
+        last = int(np.searchsorted(records['start'], to_pos, side='left'))
+
+    for i in range(first + skip, last, block_size):
+        block = records[i:min(i + block_size, last)]
+
+        for record in zip(block['start'].tolist(), block['end'].tolist(),
+                block['value'].tolist()):
+            yield record
+
+def write_text(records_file, output, block_size=2**16):
+    '''
+    Write sorted records as whitespace separated genome start, end and
+    value lines.
+
+    :param records_file: A file written by sort_records
+    :param output: A file object opened for writing text
+    '''
+    records = np.load(records_file, mmap_mode='r')
+
+    for i in range(0, len(records), block_size):
+        block = records[i:i + block_size]
+
+        output.write(''.join(['{}\t{}\t{}\n'.format(start, end, value)
+            for (start, end, value) in zip(block['start'].tolist(),
+                block['end'].tolist(), block['value'].tolist())]))
+
+def get_columns(array):
+    '''
+    The columns of an array loaded from a .npy file, which can either be a
+    record array (like the ones written by sort_records) or a two
+    dimensional array of numbers.
+    '''
+    if array.dtype.names is not None:
+        return [array[name] for name in array.dtype.names]
+    if array.ndim == 1:
+        return [array]
+
+    return [array[:, i] for i in range(array.shape[1])]
+
+def iter_sorted_rows(filepath, sort_cols, triangular=False, block_size=2**16):
+    '''
+    Iterate over the rows of a .npy file, reading it in large blocks and
+    checking that it's sorted as we go.
+
+    :param filepath: The .npy file
+    :param sort_cols: The (0-based) columns that the rows should be sorted
+        by. Only the first one is checked unless triangular is set
+    :param triangular: Check that the rows are sorted by the smallest of the
+        sort columns instead
+    :return: A generator of tuples, one per row
+    '''
+    columns = get_columns(np.load(filepath, mmap_mode='r'))
+    prev_key = None
+
+    for i in range(0, len(columns[0]), block_size):
+        block = [np.asarray(column[i:i + block_size]) for column in columns]
+
+        if triangular:
+            key = np.min([block[c] for c in sort_cols], axis=0)
+        else:
+            key = block[sort_cols[0]]
+
+        if prev_key is not None:
+            key = np.concatenate([[prev_key], key])
+
+        unsorted = np.flatnonzero(np.diff(key) < 0)
+        if len(unsorted) > 0:
+            raise ValueError('{} is not sorted, at row {}'.format(filepath,
+                i + unsorted[0] + (0 if prev_key is not None else 1)))
+
+        prev_key = key[-1]
+
+        for row in zip(*[column.tolist() for column in block]):
+            yield row
@@ -1,6 +1,15 @@
 import clodius.tiles as ct
+import h5py
 import math
 import numpy as np
+import os
+
+# memory maps of contiguously stored datasets, keyed by
+# (filename, dataset name, modification time)
+memmap_cache = {}
+
+# start positions of the entries in discrete files, keyed the same way
+discrete_index_cache = {}
 
 def get_tileset_info(hdf_file):
     '''
@@ -29,6 +38,120 @@ def get_tileset_info(hdf_file):
                 "tile_size": d.attrs['tile-size']
             }
 
+def drop_stale_entries(cache, key):
+    '''
+    Remove the entries for an older version of a file from one of the
+    caches, once a (filename, name, modification time) key for its
+    current version is about to be added.
+    '''
+    for stale_key in [k for k in cache if k[:2] == key[:2] and k != key]:
+        del cache[stale_key]
+
+def get_values_array(hdf_file, name):
+    '''
+    Get one of the arrays stored in an hdf_tile file. Uncompressed,
+    contiguously stored datasets are memory mapped so that slicing them
+    doesn't require any copying, all others are read through h5py.
+
+    :param hdf_file: A file handle for an HDF5 file (h5py.File('...'))
+    :param name: The name of the dataset (e.g. 'values_0')
+    :return: An array-like object which can be sliced
+    '''
+    dset = hdf_file[name]
+
+    if dset.chunks is not None or dset.compression is not None:
+        return dset
+
+    offset = dset.id.get_offset()
+    if offset is None:
+        # nothing has been written to this dataset
+        return dset
+
+    filename = hdf_file.filename
+    key = (filename, name, os.path.getmtime(filename))
+
+    if key not in memmap_cache:
+        drop_stale_entries(memmap_cache, key)
+
+        # copy-on-write so that the mapped values can be passed to
+        # functions which expect writeable arrays
+        memmap_cache[key] = np.memmap(filename, dtype=dset.dtype, mode='c',
+                offset=offset, shape=dset.shape)
+
+    return memmap_cache[key]
+
+def write_uncompressed_hitile(in_filename, out_filename, block_size=2**22):
+    '''
+    Copy an hdf_tile file, storing all of its datasets contiguously and
+    without compression so that they can be memory mapped when
+    retrieving tiles.
+
+    :param in_filename: The hdf_tile file to copy
+    :param out_filename: Where to store the uncompressed copy
+    :param block_size: The number of values to copy at once
+    '''
+    with h5py.File(in_filename, 'r') as f_in, h5py.File(out_filename, 'w') as f_out:
+        for name in f_in:
+            dset_in = f_in[name]
+
+            if dset_in.shape == ():
+                dset = f_out.create_dataset(name, data=dset_in[()])
+            else:
+                dset = f_out.create_dataset(name, shape=dset_in.shape, dtype=dset_in.dtype)
+
+                # genome-sized datasets don't fit in memory all at once
+                for i in range(0, dset_in.shape[0], block_size):
+                    dset[i:i + block_size] = dset_in[i:i + block_size]
+
+            for (key, value) in dset_in.attrs.items():
+                dset.attrs[key] = value
+
+def get_discrete_index(hdf_file, z):
+    '''
+    Get the start positions of the entries at one zoom level of a discrete
+    hdf_tile file. These are stored in a 'starts_<z>' dataset if the file
+    was indexed using add_discrete_index and are otherwise parsed from the
+    first column of the entries. Either way, they're only loaded once.
+
+    :param hdf_file: A file handle for an HDF5 file (h5py.File('...'))
+    :param z: The zoom level
+    :return: A sorted array of start positions
+    '''
+    filename = hdf_file.filename
+    key = (filename, str(z), os.path.getmtime(filename))
+
+    if key not in discrete_index_cache:
+        drop_stale_entries(discrete_index_cache, key)
+
+        if 'starts_' + str(z) in hdf_file:
+            starts = hdf_file['starts_' + str(z)][:]
+        else:
+            starts = hdf_file[str(z)][:,0].astype(np.int64)
+
+        discrete_index_cache[key] = starts
+
+    return discrete_index_cache[key]
+
+def add_discrete_index(hdf_file):
+    '''
+    Store the start positions of the entries at each zoom level of a
+    discrete hdf_tile file as numbers so that they don't have to be parsed
+    when the file is opened.
+
+    :param hdf_file: A writeable file handle for an HDF5 file
+    '''
+    max_zoom = int(hdf_file['meta'].attrs['max-zoom'])
+
+    for z in range(max_zoom + 1):
+        if str(z) not in hdf_file:
+            continue
+
+        if 'starts_' + str(z) in hdf_file:
+            del hdf_file['starts_' + str(z)]
+
+        hdf_file.create_dataset('starts_' + str(z),
+                data=hdf_file[str(z)][:,0].astype(np.int64))
+
 def bisect_left(a, x, lo=0, hi=None, comparator=None):
     '''Bisect_left with with an additional comparator.
 
@@ -130,16 +253,11 @@ def get_discrete_data(hdf_file, z, x):
     tile_start = x * tile_width
     tile_end = tile_start + tile_width
 
-    # We need a way to compare data points that aren't numbers
-    # (e.g. the arrays that are in f)
-    def comparator_start(a,b):
-        return int(a[0]) - int(b[0])
-
-    def comparator_end(a,b):
-        return int(a[1]) - int(b[1])
+    # the entries are sorted by their start positions
+    starts = get_discrete_index(hdf_file, z)
 
-    tile_data_start = bisect_left(f, [tile_start], comparator=comparator_start)
-    tile_data_end = bisect_right(f, [tile_end], comparator=comparator_start)
+    tile_data_start = np.searchsorted(starts, tile_start, side='left')
+    tile_data_end = np.searchsorted(starts, tile_end, side='right')
 
     return f[tile_data_start:tile_data_end]
 
@@ -207,7 +325,7 @@ def get_data(hdf_file, z, x):
     print("max_position:", int(max_position))
     '''
 
-    f = hdf_file['values_' + str(int(next_stored_zoom))]
+    f = get_values_array(hdf_file, 'values_' + str(int(next_stored_zoom)))
 
 
     if start_pos > max_position:
@@ -216,7 +334,8 @@ def get_data(hdf_file, z, x):
         a.fill(np.nan)
         ret_array = ct.aggregate(a, int(num_to_agg))
     elif start_pos < max_position and max_position < end_pos:
-        a = f[start_pos:end_pos][:]
+        # copy because the slice may be a view of a memory mapped file
+        a = np.array(f[start_pos:end_pos])
         a[max_position+1:end_pos] = np.nan
         ret_array = ct.aggregate(a, int(num_to_agg))
     else:
@@ -233,7 +352,7 @@ def get_data(hdf_file, z, x):
 
     f_nan = None
     if "nan_values_" + str(int(next_stored_zoom)) in hdf_file:
-        f_nan = hdf_file['nan_values_' + str(int(next_stored_zoom))]
+        f_nan = get_values_array(hdf_file, 'nan_values_' + str(int(next_stored_zoom)))
         nan_array = ct.aggregate(f_nan[start_pos:end_pos], int(num_to_agg))
         num_aggregated = 2 ** (max_zoom - z)
 
@@ -5,24 +5,199 @@ import numpy as np
 import pandas as pd
 import cooler
 import h5py
+import negspy.coordinates as nc
 import time
 
 TILESIZE = 256
 
-where = np.flatnonzero
-chromsizes = cooler.read_chromsizes('http://s3.amazonaws.com/pkerp/data/mm9/chromInfo.txt')  # defaults to reading chr#,X,Y,M
-chromosomes = list(chromsizes.keys())
-chromid_map = dict(zip(chromosomes, range(len(chromosomes))))
-cumul_lengths = np.r_[0, np.cumsum(chromsizes)]
-
-def absCoord2bin(c, pos):
-    try:
-        cid = where(cumul_lengths > pos)[0] - 1
-    except IndexError:
-        return c.info['nbins']
-    chrom = chromosomes[cid]
-    relPos = pos - cumul_lengths[cid]
-    return  c.offset( (chrom, relPos, chromsizes[chrom]) )
+# chromosome information that has already been loaded in this process,
+# keyed by assembly name, chromsizes filename or cooler filename
+chrominfo_cache = {}
+
+def get_cooler_chrom_offsets(c):
+    '''
+    Get the names of the chromosomes in a cooler and the index of the
+    first bin of each.
+
+    :param c: A cooler.Cooler
+    :return: A (names, offsets) tuple, where offsets has one more entry
+        than names: the total number of bins
+    '''
+    names = np.asarray(c.chroms()[:]['name'])
+
+    with c.open('r') as h5:
+        offsets = h5['indexes/chrom_offset'][:].astype(np.int64)
+
+    return (names, offsets)
+
+class ChromInfo(object):
+    '''
+    The order and sizes of the chromosomes in an assembly, along with
+    everything needed to translate between genome coordinates and
+    cooler bins.
+    '''
+    def __init__(self, chromosomes, chromsizes):
+        self.chromosomes = list(chromosomes)
+        self.chromsizes = pd.Series(np.asarray(chromsizes, dtype=np.int64),
+                                    index=self.chromosomes)
+        self.cumul_lengths = np.r_[0, np.cumsum(self.chromsizes.values)]
+        self.total_length = int(self.cumul_lengths[-1])
+
+        # the bins of every chromosome, keyed by cooler
+        self.bin_offsets = {}
+
+    def get_bin_offsets(self, c):
+        '''
+        Get the range of bins which each chromosome covers in a cooler. They
+        are looked up by name in the cooler's own index, so the cooler can
+        leave out some of the chromosomes.
+
+        :param c: A cooler.Cooler at some resolution
+        :return: A (starts, ends) tuple of arrays with the first bin of each
+            chromosome and the bin after its last one. Chromosomes which
+            aren't in the cooler have no bins (their start is the start of
+            the next chromosome which is)
+        '''
+        key = (c.filename, c.root)
+
+        if key not in self.bin_offsets:
+            (names, offsets) = get_cooler_chrom_offsets(c)
+            cooler_ids = pd.Series(np.arange(len(names)), index=names)
+
+            present = [cooler_ids[chrom] for chrom in self.chromosomes if chrom in cooler_ids]
+            if np.any(np.diff(present) < 0):
+                raise ValueError("The chromosomes in {} are in a different order than in "
+                        "the assembly".format(c.filename))
+
+            starts = np.zeros(len(self.chromosomes), dtype=np.int64)
+            ends = np.zeros(len(self.chromosomes), dtype=np.int64)
+            next_start = offsets[-1]
+
+            for i in reversed(range(len(self.chromosomes))):
+                chrom = self.chromosomes[i]
+
+                if chrom in cooler_ids:
+                    next_start = offsets[cooler_ids[chrom]]
+                    (starts[i], ends[i]) = (next_start, offsets[cooler_ids[chrom] + 1])
+                else:
+                    (starts[i], ends[i]) = (next_start, next_start)
+
+            self.bin_offsets[key] = (names, offsets, starts, ends)
+
+        return self.bin_offsets[key][2:]
+
+    def chrom_codes(self, chroms, ignore_missing=False):
+        '''
+        Convert a column of chromosome names to their index in the
+        list of chromosomes.
+
+        :param chroms: An array or pandas column of chromosome names
+        :param ignore_missing: Give chromosomes which aren't in the
+            assembly an index of -1 rather than raising a KeyError
+        :return: An array of chromosome indices
+        '''
+        codes = pd.Index(self.chromosomes).get_indexer(np.asarray(chroms))
+
+        if not ignore_missing and np.any(codes < 0):
+            raise KeyError("Chromosome {} isn't in the assembly".format(
+                np.asarray(chroms)[np.flatnonzero(codes < 0)[0]]))
+
+        return codes
+
+    def bin_to_abs_coord(self, bins, c):
+        '''
+        Get the genome position where each bin starts. This is the inverse
+        of absCoord2bin.
+
+        :param bins: An array of bin indices
+        :param c: The cooler.Cooler that the bins are in
+        :return: An array of genome positions
+        '''
+        self.get_bin_offsets(c)
+        (names, offsets) = self.bin_offsets[(c.filename, c.root)][:2]
+
+        cooler_cid = np.searchsorted(offsets, bins, side='right') - 1
+        cid = self.chrom_codes(names[cooler_cid])
+
+        return self.cumul_lengths[cid] + (bins - offsets[cooler_cid]) * int(c.info['bin-size'])
+
+def get_chrominfo(c=None, assembly=None, chromsizes_filename=None):
+    '''
+    Get the chromosome sizes for a dataset. They are loaded the first
+    time they are requested and cached for the rest of the process.
+
+    The sizes come from a chromsizes file if one is given, otherwise from
+    the negspy assembly and otherwise from the cooler's own chroms table.
+
+    :param c: A cooler.Cooler
+    :param assembly: The name of a negspy assembly (e.g. 'mm9')
+    :param chromsizes_filename: A tab-separated file of chromosome names
+        and sizes
+    :return: A ChromInfo
+    '''
+    if chromsizes_filename is not None:
+        key = ('file', chromsizes_filename)
+    elif assembly is not None:
+        key = ('assembly', assembly)
+    elif c is not None:
+        key = ('cooler', c.filename)
+    else:
+        raise ValueError("Need a cooler, an assembly or a chromsizes file "
+                         "to get the chromosome sizes")
+
+    if key not in chrominfo_cache:
+        if c is not None and chromsizes_filename is None and assembly is None:
+            chroms = c.chroms()[:]
+            chrominfo_cache[key] = ChromInfo(chroms['name'], chroms['length'])
+        else:
+            if chromsizes_filename is not None:
+                chrom_info = nc.get_chrominfo_from_file(chromsizes_filename)
+            else:
+                chrom_info = nc.get_chrominfo(assembly)
+
+            chrominfo_cache[key] = ChromInfo(chrom_info.chrom_order,
+                [chrom_info.chrom_lengths[x] for x in chrom_info.chrom_order])
+
+    return chrominfo_cache[key]
+
+def absCoord2bin(c, pos, chrominfo=None):
+    '''
+    Convert absolute genome positions to bin indices in a cooler.
+
+    :param c: A cooler.Cooler at some resolution
+    :param pos: A genome position or an array of genome positions
+    :param chrominfo: The ChromInfo that the genome positions refer to
+        (taken from the cooler if not specified)
+    :return: The index of the bin containing each position. Positions
+        past the end of the genome map to the number of bins.
+    '''
+    if chrominfo is None:
+        chrominfo = get_chrominfo(c)
+
+    num_chroms = len(chrominfo.chromosomes)
+    cumul_lengths = chrominfo.cumul_lengths
+    binsize = int(c.info['bin-size'])
+    (starts, ends) = chrominfo.get_bin_offsets(c)
+
+    pos = np.maximum(np.asarray(pos), 0)
+    cid = np.searchsorted(cumul_lengths, pos, side='right') - 1
+    past_end = cid >= num_chroms
+    cid = np.minimum(cid, num_chroms - 1)
+
+    # positions past the end of the cooler's chromosome (or on chromosomes
+    # which the cooler doesn't have) don't spill into the next one
+    bins = np.minimum(starts[cid] + (pos - cumul_lengths[cid]) // binsize, ends[cid])
+    bins = np.where(past_end, c.info['nbins'], bins).astype(np.int64)
+
+    return bins[()]
+
+def get_bin_ranges(c, startPos1, endPos1, startPos2, endPos2, chrominfo=None):
+    '''
+    Convert a query window in genome coordinates to the bin ranges
+    (i0, i1, j0, j1) that it covers in a cooler.
+    '''
+    return tuple(absCoord2bin(c, [startPos1, endPos1, startPos2, endPos2],
+                              chrominfo))
 
 def getData(FILEPATH, zoomLevel, startPos1, endPos1, startPos2, endPos2):
 
@@ -30,11 +205,8 @@ def getData(FILEPATH, zoomLevel, startPos1, endPos1, startPos2, endPos2):
 
     with h5py.File(FILEPATH, 'r') as f:
         c = cooler.Cooler(f[groupname])
-        
-        i0 = absCoord2bin(c, startPos1)
-        i1 = absCoord2bin(c, endPos1)
-        j0 = absCoord2bin(c, startPos2)
-        j1 = absCoord2bin(c, endPos2)
+
+        i0, i1, j0, j1 = get_bin_ranges(c, startPos1, endPos1, startPos2, endPos2)
         mat = c.matrix(balance=True)[i0:i1, j0:j1]
 
     flat = list(mat.toarray().ravel())
@@ -46,21 +218,20 @@ def getData2(cooler_matrix, zoomLevel, startPos1, endPos1, startPos2, endPos2):
 
     c = cooler_matrix['cooler']
     matrix = cooler_matrix['matrix']
+    chrominfo = cooler_matrix.get('chrominfo') or get_chrominfo(c)
 
-    i0 = absCoord2bin(c, startPos1)
-    i1 = absCoord2bin(c, endPos1)
-    j0 = absCoord2bin(c, startPos2)
-    j1 = absCoord2bin(c, endPos2)
+    i0, i1, j0, j1 = get_bin_ranges(c, startPos1, endPos1, startPos2, endPos2,
+                                    chrominfo)
     
     if (i1-i0) == 0 or (j1-j0) == 0:
         return pd.DataFrame(columns=['genome_start', 'genome_end', 'balanced'])
     
     t1 = time.time()
     pixels = matrix[i0:i1, j0:j1]
-    cid1 = pixels['chrom1'].apply(chromid_map.get)
-    cid2 = pixels['chrom2'].apply(chromid_map.get)
-    pixels['genome_start'] = cumul_lengths[cid1] + pixels['start1']
-    pixels['genome_end'] = cumul_lengths[cid2] + pixels['end2']
+    cid1 = chrominfo.chrom_codes(pixels['chrom1'])
+    cid2 = chrominfo.chrom_codes(pixels['chrom2'])
+    pixels['genome_start'] = chrominfo.cumul_lengths[cid1] + pixels['start1']
+    pixels['genome_end'] = chrominfo.cumul_lengths[cid2] + pixels['end2']
 
     print("z:", zoomLevel, "t:", time.time() - t1)
     return pixels[['genome_start', 'genome_end', 'balanced']]
@@ -68,11 +239,10 @@ def getData2(cooler_matrix, zoomLevel, startPos1, endPos1, startPos2, endPos2):
 def getData3(cooler_matrix, zoomLevel, startPos1, endPos1, startPos2, endPos2):
     t1 = time.time()
     c = cooler_matrix['cooler']
+    chrominfo = cooler_matrix.get('chrominfo') or get_chrominfo(c)
 
-    i0 = absCoord2bin(c, startPos1)
-    i1 = absCoord2bin(c, endPos1)
-    j0 = absCoord2bin(c, startPos2)
-    j1 = absCoord2bin(c, endPos2)
+    i0, i1, j0, j1 = get_bin_ranges(c, startPos1, endPos1, startPos2, endPos2,
+                                    chrominfo)
 
 
     if (i1-i0) == 0 or (j1-j0) == 0:
@@ -83,22 +253,91 @@ def getData3(cooler_matrix, zoomLevel, startPos1, endPos1, startPos2, endPos2):
     if not len(pixels):
         return pd.DataFrame(columns=['genome_start', 'genome_end', 'balanced'])
 
-    lo = min(i0, j0)
-    hi = max(i1, j1)
+    return annotatePixels(c, pixels, min(i0, j0), max(i1, j1), chrominfo)
+
+def annotatePixels(c, pixels, lo, hi, chrominfo):
+    '''
+    Add the genome positions and balanced values to a table of cooler
+    pixels.
+
+    The cooler can have chromosomes which aren't in the assembly. Pixels
+    on those have no genome positions, so they're left out.
+
+    :param c: The cooler.Cooler that the pixels are from
+    :param pixels: A dataframe with bin1_id, bin2_id and count columns
+    :param lo: The first bin that the pixels can be in
+    :param hi: The bin after the last one that the pixels can be in
+    :param chrominfo: The ChromInfo to get the genome positions from
+    :return: A dataframe with genome_start, genome_end and balanced columns
+    '''
     bins = c.bins()[['chrom', 'start', 'end', 'weight']][lo:hi]
-    bins['chrom'] = bins['chrom'].cat.codes
+    bins['chrom'] = chrominfo.chrom_codes(bins['chrom'], ignore_missing=True)
     pixels = cooler.annotate(pixels, bins)
-    pixels['genome_start'] = cumul_lengths[pixels['chrom1']] + pixels['start1']
-    pixels['genome_end']   = cumul_lengths[pixels['chrom2']] + pixels['end2']
+
+    pixels = pixels[(pixels['chrom1'] >= 0) & (pixels['chrom2'] >= 0)].copy()
+    pixels['genome_start'] = chrominfo.cumul_lengths[pixels['chrom1']] + pixels['start1']
+    pixels['genome_end']   = chrominfo.cumul_lengths[pixels['chrom2']] + pixels['end2']
     pixels['balanced']     = pixels['count'] * pixels['weight1'] * pixels['weight2']
 
     return pixels[['genome_start', 'genome_end', 'balanced']]
 
+def getTileBins(cooler_matrix, zoomLevel, startPos1, endPos1, startPos2, endPos2,
+        bins_per_dimension):
+    '''
+    Get the balanced values in a tile as COO arrays.
+
+    The tile spans [startPos1, endPos1) x [startPos2, endPos2) and is
+    divided into bins_per_dimension bins along each dimension.
 
-def getInfo(FILEPATH):
+    :return: (i, j, v) where i and j are the positions of the bins within
+        the tile and v are their balanced values (NaNs replaced with 0)
+    '''
+    c = cooler_matrix['cooler']
+    chrominfo = cooler_matrix.get('chrominfo') or get_chrominfo(c)
+
+    i0, i1, j0, j1 = get_bin_ranges(c, startPos1, endPos1, startPos2, endPos2,
+                                    chrominfo)
+
+    if (i1-i0) == 0 or (j1-j0) == 0:
+        return (np.array([], dtype=np.int64), np.array([], dtype=np.int64),
+                np.array([], dtype=np.float32))
+
+    tile_binsize = (endPos1 - startPos1) / bins_per_dimension
+
+    mat = c.matrix(balance=True, sparse=True)[i0:i1, j0:j1]
+
+    # position of each pixel within the tile
+    i = (chrominfo.bin_to_abs_coord(mat.row + i0, c) - startPos1) // tile_binsize
+    j = (chrominfo.bin_to_abs_coord(mat.col + j0, c) - startPos2) // tile_binsize
+    i = i.astype(np.int64)
+    j = j.astype(np.int64)
+
+    in_tile = (i >= 0) & (i < bins_per_dimension) & (j >= 0) & (j < bins_per_dimension)
+
+    return (i[in_tile], j[in_tile],
+            np.nan_to_num(mat.data[in_tile]).astype(np.float32))
+
+def binsToDenseTile(i, j, v, bins_per_dimension):
+    '''
+    Scatter the COO arrays returned by getTileBins into a dense tile.
+
+    :return: A flat float32 array of bins_per_dimension ** 2 values,
+        laid out the same way as TileSaver.save_dense_tile
+    '''
+    dense = np.zeros(bins_per_dimension ** 2, dtype=np.float32)
+    # add rather than assign, so that values which fall in the same bin
+    # are summed
+    np.add.at(dense, i + j * bins_per_dimension, v)
+
+    return dense
+
+def getInfo(FILEPATH, chrominfo=None):
 
     with h5py.File(FILEPATH, 'r') as f:
-        total_length = int(cumul_lengths[-1])
+        if chrominfo is None:
+            chrominfo = get_chrominfo(cooler.Cooler(f['0']))
+
+        total_length = chrominfo.total_length
         binsize = int(f['0'].attrs['bin-size'])
         binsize = 1000
         n_tiles = total_length / binsize / TILESIZE
@@ -6,8 +6,8 @@ try:
 except ImportError:
     import io as csio
 
+import base64
 import gzip
-import itertools as it
 import json
 import numpy as np
 import os
@@ -19,7 +19,7 @@ import signal
 import slugid
 import sys
 import time
-import itertools
+import warnings
 
 from time import gmtime, strftime
 
@@ -27,6 +27,67 @@ def handle_exception(exc_type, exc_value, exc_traceback):
     print("".join(traceback.format_exception(exc_type, exc_value, exc_traceback)))
     os._exit(1)
 
+# the ways in which the values of dense tiles can be stored
+DENSE_ENCODINGS = ['json', 'float32', 'float16', 'fixed']
+
+# the largest magnitude a float16 can store
+FLOAT16_MAX = 65504.
+
+def encode_dense_values(values, encoding='json'):
+    '''
+    Encode the values of a dense tile.
+
+    The 'json' encoding stores a list of values rounded to 5 decimal
+    places. The others store a base64 string of little-endian values:
+    'float32' and 'float16' are the raw floats, while 'fixed' is a
+    uint16 fixed-point encoding spanning [min, max] of the finite values
+    (value = min + q * (max - min) / 65534, with 65535 marking NaN).
+
+    float16 can't store magnitudes above 65504, so larger finite values
+    are clipped to +/-65504 (with a warning) rather than becoming inf.
+
+    :param values: An array of values
+    :param encoding: One of DENSE_ENCODINGS
+    :return: A dictionary with the encoded values stored under 'dense',
+        along with anything needed to decode them
+    '''
+    if encoding == 'json':
+        return {'dense': np.round(np.asarray(values, dtype=float), 5).tolist()}
+
+    values = np.asarray(values, dtype=np.float32)
+
+    if encoding == 'float32':
+        return {'dense': base64.b64encode(values.astype('<f4').tobytes()).decode('utf-8'),
+                'dtype': 'float32'}
+
+    if encoding == 'float16':
+        too_large = np.isfinite(values) & (np.abs(values) > FLOAT16_MAX)
+
+        if too_large.any():
+            warnings.warn("{} values are outside the float16 range and were clipped to "
+                    "+/-{}".format(np.sum(too_large), FLOAT16_MAX))
+            values = np.where(too_large, np.sign(values) * FLOAT16_MAX, values)
+
+        return {'dense': base64.b64encode(values.astype('<f2').tobytes()).decode('utf-8'),
+                'dtype': 'float16'}
+
+    if encoding == 'fixed':
+        finite = np.isfinite(values)
+        min_value = float(np.min(values[finite])) if finite.any() else 0.
+        max_value = float(np.max(values[finite])) if finite.any() else 0.
+        scale = (max_value - min_value) / 65534. if max_value > min_value else 1.
+
+        fixed = np.full(len(values), 65535, dtype='<u2')
+        fixed[finite] = np.round((values[finite] - min_value) / scale)
+
+        return {'dense': base64.b64encode(fixed.tobytes()).decode('utf-8'),
+                'dtype': 'fixed16',
+                'fixed_min': min_value,
+                'fixed_max': max_value}
+
+    raise ValueError("Unknown dense tile encoding: {} (must be one of {})".format(
+        encoding, ", ".join(DENSE_ENCODINGS)))
+
 def tile_saver_worker(q, tile_saver, finished):
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
@@ -48,7 +109,8 @@ def tile_saver_worker(q, tile_saver, finished):
     tile_saver.flush()
 
 class TileSaver(object):
-    def __init__(self, max_data_in_sparse, bins_per_dimension, num_dimensions, print_status=False, initial_value=0.0):
+    def __init__(self, max_data_in_sparse, bins_per_dimension, num_dimensions, print_status=False, initial_value=0.0,
+            encoding='json'):
         self.max_data_in_sparse = max_data_in_sparse
 
         #self.max_data_in_sparse = 0
@@ -57,6 +119,9 @@ class TileSaver(object):
         self.print_status = print_status
         self.initial_value = initial_value
 
+        # how the values of dense tiles are stored (see encode_dense_values)
+        self.encoding = encoding
+
         pass
 
     def save_tile(self, tile):
@@ -73,22 +138,54 @@ class TileSaver(object):
 
         self.save_tile(tile)
 
+    def assemble_dense_tile(self, bin_positions, values):
+        '''
+        Scatter the values of a tile's bins into an array containing
+        every bin in the tile. Bins without a value are set to
+        initial_value.
+
+        :param bin_positions: An (n, num_dimensions) array with the position of
+                              each bin within the tile
+        :param values: An (n, num_values) array with the values in each bin
+        :return: A (bins_per_dimension ** num_dimensions, num_values) array
+                 where the first dimension varies fastest
+        '''
+        initial_value = np.atleast_1d(np.asarray(self.initial_value, dtype=float))
+        dense = np.empty((self.bins_per_dimension ** self.num_dimensions,
+                          len(initial_value)))
+        dense[:] = initial_value
+
+        if len(values) > 0:
+            index = np.ravel_multi_index(
+                    np.asarray(bin_positions, dtype=np.int64).T,
+                    (self.bins_per_dimension,) * self.num_dimensions,
+                    order='F')
+            dense[index] = np.asarray(values).reshape(len(index), -1)
+
+        return dense
+
     def save_dense_tile(self, zoom_level, tile_position, tile_bins, 
             min_value, max_value):
-        initial_values = [self.initial_value] * (self.bins_per_dimension ** self.num_dimensions)
-
-        for (bin_pos, val) in tile_bins.items():
-            index = int(sum([bp * self.bins_per_dimension ** i for i,bp in enumerate(bin_pos)]))
-            initial_values[index] = val
+        '''
+        Save a tile with a value for every bin.
 
-        if len(self.initial_value) == 1:
-            self.make_and_save_tile(zoom_level, tile_position, {"dense": 
-                [round(v[0], 5) for v in initial_values],
-                'min_value': min_value, 'max_value': max_value })
+        :param tile_bins: Either a dictionary of {bin_position: value} or a
+                          (bin_positions, values) tuple of arrays as accepted
+                          by assemble_dense_tile
+        '''
+        if isinstance(tile_bins, tuple):
+            (bin_positions, values) = tile_bins
         else:
-            self.make_and_save_tile(zoom_level, tile_position, {"dense": 
-                list(it.chain.from_iterable([[round(y, 5) for y in v] for v in initial_values])),
-                'min_value': min_value, 'max_value': max_value })
+            bin_positions = list(tile_bins.keys())
+            values = list(tile_bins.values())
+
+        dense = self.assemble_dense_tile(bin_positions, values)
+
+        tile_value = encode_dense_values(dense.ravel(), self.encoding)
+        tile_value['min_value'] = min_value
+        tile_value['max_value'] = max_value
+
+        self.make_and_save_tile(zoom_level, tile_position, tile_value)
 
 
     def save_sparse_tile(self, zoom_level, tile_position, tile_bins, 
@@ -103,6 +200,36 @@ class TileSaver(object):
         self.make_and_save_tile(zoom_level, tile_position, {"sparse": shown,
             'min_value': min_value, 'max_value': max_value })
 
+    def save_coo_tile(self, zoom_level, tile_position, bin_positions, values,
+            min_value=None, max_value=None):
+        '''
+        Save a sparse tile whose bins are given as COO arrays
+
+        :param zoom_level: An integer zoom_level (0 for zoomed all the way out)
+        :param tile_position: An n-dimensional array, where n is the number of dimensions
+                              in the dataset.
+        :param bin_positions: An (n, num_dimensions) array with the position of
+                              each bin within the tile
+        :param values: An (n,) or (n, num_values) array with the values in each bin
+        :param min_value: The minimum of each column of values (calculated from
+                          the values if not given)
+        :param max_value: The maximum of each column of values
+        '''
+        values = np.asarray(values, dtype=float)
+        values = values.reshape(len(values), -1)
+
+        if min_value is None:
+            min_value = list(np.min(values, axis=0))
+        if max_value is None:
+            max_value = list(np.max(values, axis=0))
+
+        positions = np.asarray(bin_positions, dtype=float).reshape(len(values), -1).tolist()
+        shown = [[pos, val[0] if len(val) == 1 else val]
+                 for (pos, val) in zip(positions, values.tolist())]
+
+        self.make_and_save_tile(zoom_level, tile_position, {"sparse": shown,
+            'min_value': min_value, 'max_value': max_value })
+
     def save_tile_array(self, zoom_level, tile_position, tile_data):
         '''
         Save a tile that has all of its data in one long array
@@ -112,41 +239,72 @@ class TileSaver(object):
                               in the dataset.
         :param tile_data: The data in the tile.
         '''
-        min_value = min(tile_data)
-        max_value = max(tile_data)
+        tile_value = encode_dense_values(tile_data, self.encoding)
+        tile_value['min_value'] = float(np.min(tile_data))
+        tile_value['max_value'] = float(np.max(tile_data))
 
-        self.make_and_save_tile(zoom_level, tile_position, {'dense':
-            [round(v, 5) for v in tile_data],
-            'min_value': min_value, 'max_value': max_value})
+        self.make_and_save_tile(zoom_level, tile_position, tile_value)
 
     def save_binned_tile(self, zoom_level, tile_position, tile_bins):
-        max_value = list(np.max(np.array(list(tile_bins.values())), axis=0))
-        min_value = list(np.min(np.array(list(tile_bins.values())), axis=0))
+        '''
+        Save a tile, choosing between a sparse and a dense representation.
+        Tiles with fewer than max_data_in_sparse bins are saved as sparse
+        tiles.
+
+        :param tile_bins: Either a dictionary of {bin_position: value}, a
+            (bin_positions, values) tuple of COO arrays laid out as in
+            assemble_dense_tile (one row per bin) or an already assembled
+            dense array
+        '''
+        if isinstance(tile_bins, np.ndarray):
+            self.save_tile_array(zoom_level, tile_position, tile_bins)
+            return
 
-        if len(tile_bins) < self.max_data_in_sparse:
-            self.save_sparse_tile(zoom_level, tile_position, tile_bins, 
-                                  min_value=min_value, max_value=max_value)
+        if isinstance(tile_bins, tuple):
+            (bin_positions, values) = tile_bins
         else:
-            self.save_dense_tile(zoom_level, tile_position, tile_bins,
+            bin_positions = list(tile_bins.keys())
+            values = list(tile_bins.values())
+
+        # convert the values to an array once and use it for everything
+        values = np.asarray(values, dtype=float)
+        values = values.reshape(len(values), -1)
+
+        max_value = list(np.max(values, axis=0))
+        min_value = list(np.min(values, axis=0))
+
+        if len(values) < self.max_data_in_sparse:
+            if isinstance(tile_bins, tuple):
+                self.save_coo_tile(zoom_level, tile_position, bin_positions, values,
+                                   min_value=min_value, max_value=max_value)
+            else:
+                self.save_sparse_tile(zoom_level, tile_position, tile_bins,
+                                      min_value=min_value, max_value=max_value)
+        else:
+            self.save_dense_tile(zoom_level, tile_position,
+                                 (bin_positions, values),
                                  min_value=min_value, max_value=max_value)
 
     def flush():
         return
 
 class EmptyTileSaver(TileSaver):
-    def __init__(self, max_data_in_sparse, bins_per_dimension, num_dimensions):
+    def __init__(self, max_data_in_sparse, bins_per_dimension, num_dimensions,
+            encoding='json'):
         super(EmptyTileSaver, self).__init__(max_data_in_sparse, 
                                              bins_per_dimension,
-                                             num_dimensions)
+                                             num_dimensions,
+                                             encoding=encoding)
 
 class ColumnFileTileSaver(TileSaver):
     def __init__(self, max_data_in_sparse, bins_per_dimension, num_dimensions,
-            file_path, log_file, print_status, initial_value):
+            file_path, log_file, print_status, initial_value, encoding='json'):
         super(ColumnFileTileSaver, self).__init__(max_data_in_sparse, 
                                              bins_per_dimension,
                                              num_dimensions,
                                              print_status,
-                                             initial_value)
+                                             initial_value,
+                                             encoding)
         self.file_path = file_path
         self.bulk_txt = csio.StringIO()
         self.bulk_txt_len = 0
@@ -224,12 +382,14 @@ class ColumnFileTileSaver(TileSaver):
 
 class ElasticSearchTileSaver(TileSaver):
     def __init__(self, max_data_in_sparse=None, bins_per_dimension=None, num_dimensions=None,
-            es_path=None, log_file=None, print_status=False, initial_value=None):
+            es_path=None, log_file=None, print_status=False, initial_value=None,
+            encoding='json'):
         super(ElasticSearchTileSaver, self).__init__(max_data_in_sparse, 
                                              bins_per_dimension,
                                              num_dimensions,
                                              print_status,
-                                             initial_value)
+                                             initial_value,
+                                             encoding)
         self.es_path = es_path
         self.bulk_txt = csio.StringIO()
         self.bulk_txt_len = 0
@@ -377,7 +537,7 @@ def save_to_elasticsearch(url, data, print_status=False):
                 print("Slept too long, returning", file=sys.stderr)
                 raise
 
-def save_tile(tile, output_dir, gzip_output):
+def save_tile(tile, output_dir, gzip_output, encoding='json'):
     '''
     Save a tile to a particular base directory.
 
@@ -386,10 +546,17 @@ def save_tile(tile, output_dir, gzip_output):
 
     They key should be in the format (zoom_level, pos1, pos2...)
     e.g. (5,4,5)
+
+    The values of dense tiles are stored using the given encoding
+    (see encode_dense_values).
     '''
     key = tile[0]
     tile_value = tile[1]
 
+    if 'dense' in tile_value and encoding != 'json':
+        tile_value = dict(tile_value)
+        tile_value.update(encode_dense_values(tile_value['dense'], encoding))
+
     outpath = op.join(output_dir, '.'.join(map(str, key)))
     outdir = op.dirname(outpath)
 
@@ -0,0 +1,279 @@
+from __future__ import division, print_function
+
+import collections as col
+import contextlib
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+def get_peak_rss():
+    '''
+    The peak resident set size of this process, in bytes, or None if
+    it can't be determined.
+
+    On linux this is the high water mark of the current address space, so
+    unlike ru_maxrss it doesn't include the memory of the process that
+    started this one.
+    '''
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+
+    if resource is None:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # linux reports kilobytes and mac os reports bytes
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+
+    return peak_rss
+
+# the profiler started by `clodius --profile`, if any
+profiler = None
+
+class Profiler(object):
+    '''
+    Profile a command with either cProfile or tracemalloc.
+
+    By default the whole command is profiled. If stages are given, cProfile
+    only profiles the time spent in those stages (as timed by
+    AggregationStats) and tracemalloc takes a snapshot at the end of them,
+    at most once every `interval` seconds.
+    '''
+    def __init__(self, method, output_file, stages=None, interval=10):
+        '''
+        :param method: 'cprofile' or 'tracemalloc'
+        :param output_file: Where to write the pstats or the final
+            allocation snapshot. Per-stage snapshots are written to
+            `output_file.<stage>.<n>`
+        :param stages: A list of stage names to restrict profiling to
+        :param interval: The minimum number of seconds between per-stage
+            tracemalloc snapshots
+        '''
+        if method not in ['cprofile', 'tracemalloc']:
+            raise ValueError('Unknown profiling method: {}'.format(method))
+
+        self.method = method
+        self.output_file = output_file
+        self.stages = stages or []
+        self.interval = interval
+
+        self.stage_depth = 0
+        self.snapshots = col.defaultdict(int)
+        self.last_snapshot = col.defaultdict(float)
+
+    def start(self):
+        global profiler
+        profiler = self
+
+        if self.method == 'cprofile':
+            import cProfile
+
+            self.profile = cProfile.Profile()
+
+            if len(self.stages) == 0:
+                self.profile.enable()
+        else:
+            import tracemalloc
+
+            tracemalloc.start(25)
+
+    def stop(self):
+        '''
+        Stop profiling and write the results.
+        '''
+        global profiler
+        profiler = None
+
+        if self.method == 'cprofile':
+            self.profile.disable()
+            self.profile.dump_stats(self.output_file)
+        else:
+            import tracemalloc
+
+            tracemalloc.take_snapshot().dump(self.output_file)
+            tracemalloc.stop()
+
+    def enter_stage(self, stage):
+        if stage not in self.stages:
+            return
+
+        self.stage_depth += 1
+
+        if self.method == 'cprofile' and self.stage_depth == 1:
+            self.profile.enable()
+
+    def exit_stage(self, stage):
+        if stage not in self.stages:
+            return
+
+        self.stage_depth -= 1
+
+        if self.method == 'cprofile':
+            if self.stage_depth == 0:
+                self.profile.disable()
+        elif time.time() - self.last_snapshot[stage] >= self.interval:
+            import tracemalloc
+
+            tracemalloc.take_snapshot().dump('{}.{}.{}'.format(
+                self.output_file, stage, self.snapshots[stage]))
+
+            self.snapshots[stage] += 1
+            self.last_snapshot[stage] = time.time()
+
+class AggregationStats(object):
+    '''
+    Keep track of how long each stage of an aggregation takes and how
+    much data passes through it, and periodically report it as JSON lines.
+
+    Nothing is reported unless a stats file is given, so it can always be
+    used.
+    '''
+    def __init__(self, command, stats_file=None, interval=10):
+        '''
+        :param command: The name of the aggregation (e.g. 'bigwig')
+        :param stats_file: The file to write the stats to, '-' for stderr
+            or None to not report anything
+        :param interval: The minimum number of seconds between reports
+        '''
+        self.command = command
+        self.interval = interval
+
+        self.timers = col.defaultdict(float)
+        self.counts = col.defaultdict(int)
+
+        self.stages = []
+        self.start_time = self.stage_start = self.last_report = time.time()
+
+        if stats_file is None:
+            self.output = None
+        elif stats_file == '-':
+            self.output = sys.stderr
+        else:
+            self.output = open(stats_file, 'w')
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        '''
+        Time a stage of the aggregation. Stages can be nested, in which
+        case the time spent in the inner stage isn't counted towards the
+        outer one.
+
+        :param stage: The name of the stage (e.g. 'parse', 'hdf5_write')
+        '''
+        now = time.time()
+        if len(self.stages) > 0:
+            self.timers[self.stages[-1]] += now - self.stage_start
+
+        self.stages.append(stage)
+        self.stage_start = now
+
+        if profiler is not None:
+            profiler.enter_stage(stage)
+
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.exit_stage(stage)
+
+            now = time.time()
+            self.timers[self.stages.pop()] += now - self.stage_start
+            self.stage_start = now
+
+    def add(self, rows=0, bytes=0):
+        '''
+        Count the amount of input that has been processed.
+
+        :param rows: The number of lines or records
+        :param bytes: The size of the input
+        '''
+        self.counts['rows'] += rows
+        self.counts['bytes'] += bytes
+
+    def get_stats(self, **extra):
+        '''
+        The stats collected so far.
+
+        :param extra: Any other values to include
+        :return: A dictionary
+        '''
+        now = time.time()
+        elapsed = now - self.start_time
+
+        stages = dict(self.timers)
+        if len(self.stages) > 0:
+            stages[self.stages[-1]] = stages.get(self.stages[-1], 0) + now - self.stage_start
+
+        # time spent outside of any of the timed stages
+        stages['other'] = max(0, elapsed - sum(stages.values()))
+
+        stats = {
+                'command': self.command,
+                'elapsed': elapsed,
+                'stages': stages,
+                'rows': self.counts['rows'],
+                'bytes': self.counts['bytes'],
+                'rows_per_second': self.counts['rows'] / elapsed if elapsed > 0 else 0,
+                'bytes_per_second': self.counts['bytes'] / elapsed if elapsed > 0 else 0,
+                'peak_rss': get_peak_rss()
+                }
+        stats.update(extra)
+
+        return stats
+
+    def report(self, force=False, **extra):
+        '''
+        Write the current stats if enough time has passed since the last
+        report.
+
+        :param force: Write them regardless of the time
+        :param extra: Any other values to include (e.g. the position)
+        '''
+        if self.output is None:
+            return
+
+        if not force and time.time() - self.last_report < self.interval:
+            return
+
+        self.output.write(json.dumps(self.get_stats(**extra)) + '\n')
+        self.output.flush()
+        self.last_report = time.time()
+
+    def log(self, *args):
+        '''
+        Report a diagnostic message (e.g. the chromosome order) as a
+        JSON line alongside the stats, so that a run without a stats file
+        stays quiet.
+
+        :param args: The parts of the message, joined like print does
+        '''
+        if self.output is None:
+            return
+
+        self.output.write(json.dumps({
+            'command': self.command,
+            'message': ' '.join(str(a) for a in args)
+            }) + '\n')
+        self.output.flush()
+
+    def close(self, **extra):
+        '''
+        Write the final stats and close the stats file.
+        '''
+        self.report(force=True, finished=True, **extra)
+
+        if self.output is not None and self.output is not sys.stderr:
+            self.output.close()
@@ -8,7 +8,7 @@ import time
 import clodius.fast as cf
 
 def aggregate(in_array, num_to_agg):
-    return cf.aggregate(in_array.astype(np.float32), num_to_agg)
+    return cf.aggregate(np.asarray(in_array, dtype=np.float32), num_to_agg)
 
 def load_entries_from_file(sc, filename, column_names=None, delimiter=None, 
         elasticsearch_path=None):
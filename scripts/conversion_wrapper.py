@@ -1,7 +1,7 @@
 from __future__ import print_function
 
 import argparse
-import clodius.cli.aggregate as cca
+import clodius.cli.aggregate_bigwig as ccab
 import os
 import os.path as op
 import sys
@@ -62,7 +62,7 @@ def main():
         sys.stdout.write("Output to stdout")
 
     if filetype in ["bigwig", "hitile"]:
-        cca._bigwig(filepath=input_file, output_file=output_file, assembly=assembly)
+        ccab._bigwig(filepath=input_file, output_file=output_file, assembly=assembly)
 
     if filetype == "cooler":
         from cooler.contrib import recursive_agg_onefile
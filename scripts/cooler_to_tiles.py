@@ -13,7 +13,8 @@ import time
 
 import multiprocessing as mpr
 
-def recursive_generate_tiles(tile_positions, coolers_matrix, info, resolution, max_zoom_to_generate, queue = None, max_queue_size=10000):
+def recursive_generate_tiles(tile_positions, coolers_matrix, info, resolution, max_zoom_to_generate, queue = None, max_queue_size=10000,
+        max_data_in_sparse=0):
     '''
     Recursively generate tiles from a cooler file.
 
@@ -23,9 +24,11 @@ def recursive_generate_tiles(tile_positions, coolers_matrix, info, resolution, m
     :param resolution: The resolution of the data in the smallest tiles (in nucleotides)
     :param max_zoom_to_generate: The maximum zoom level to create tiles for
     :param max_queue_size: The maximum size of the queue (sleep until it shrinks)
+    :param max_data_in_sparse: Tiles with fewer values than this are saved as sparse tiles
     '''
     total_put = 0
     start_time = time.time()
+    bins_per_dimension = info['bins_per_dimension']
 
     while len(tile_positions) > 0:
         tile_position = tile_positions.popleft()
@@ -43,30 +46,24 @@ def recursive_generate_tiles(tile_positions, coolers_matrix, info, resolution, m
         end2 = (y_pos + 1) * info['max_width'] / divisor
 
         t1 = time.time()
-        print("st:", start1, end1-1, start2, end2-1)
+        print("st:", start1, end1, start2, end2)
         try:
-            data = chg.getData3(coolers_matrix[zoom_level], zoom_level, start1, end1-1, start2, end2-1)
+            (i, j, v) = chg.getTileBins(coolers_matrix[zoom_level], zoom_level,
+                                        start1, end1, start2, end2, bins_per_dimension)
         except ValueError as ve:
             print("ERROR ve:", ve, file=sys.stderr)
+            continue
 
         data_time = time.time() - t1
+        data_length = len(v)
 
-        if len(data) == 0:
+        if data_length == 0:
             continue
 
-        df = data[data['genome_start'] >= start1]
-        binsize = 2 ** (info['max_zoom'] - zoom_level) * resolution
-
-        i = (df['genome_start'].values - start1) // binsize
-        j = (df['genome_end'].values - start2) // binsize
-        v = np.nan_to_num(df['balanced'].values)
-        m = (end1 - start1) // binsize
-        n =  (end2 - start2) // binsize
-
-        zi = zip(zip(i,j),v)
-        tile_bins = dict(zi)
-
-        data_length = len(data)
+        if data_length >= max_data_in_sparse:
+            tile_bins = chg.binsToDenseTile(i, j, v, bins_per_dimension)
+        else:
+            tile_bins = (np.column_stack([i, j]), v)
 
         if queue is not None:
             total_put += 1
@@ -76,7 +73,7 @@ def recursive_generate_tiles(tile_positions, coolers_matrix, info, resolution, m
                   "time_per_put: {:.2f}".format((time.time() -  start_time) / total_put),
                   "data_time: {:.2f}".format(data_time),
                   "tile_size:", data_length,
-                  "call: ({}, {}, {}, {}, {})".format(zoom_level, start1, end1-1, start2, end2-1),
+                  "call: ({}, {}, {}, {}, {})".format(zoom_level, start1, end1, start2, end2),
                   'qsize:', queue.qsize())
             queue.put((tile_position[0], tile_position[1:], tile_bins))
             while queue.qsize() > max_queue_size:
@@ -124,12 +121,22 @@ def main():
                         help="The path to the column file where to save the tiles")
     parser.add_argument('--assembly', default=None)
     parser.add_argument('--log-file', default=None)
+    parser.add_argument('--encoding', default='json', choices=cst.DENSE_ENCODINGS,
+                        help="How to store the values of dense tiles (float16 clips "
+                        "values beyond +/-65504)")
     parser.add_argument('--resolution', default=1000)
     parser.add_argument('--max-zoom', default=None, type=int)
     parser.add_argument('--num-threads', default=4, type=int)
 
     args = parser.parse_args()
-    tileset_info = chg.getInfo(args.filepath)
+
+    # without an assembly, the chromosome sizes come from the cooler file
+    if args.assembly is not None:
+        chrominfo = chg.get_chrominfo(assembly=args.assembly)
+    else:
+        chrominfo = None
+
+    tileset_info = chg.getInfo(args.filepath, chrominfo)
 
     num_dimensions = 2
     bins_per_dimension = tileset_info['bins_per_dimension']
@@ -140,13 +147,15 @@ def main():
                                                 bins_per_dimension,
                                                 es_path = args.elasticsearch_url,
                                                 log_file = args.log_file,
-                                                num_dimensions=num_dimensions)
+                                                num_dimensions=num_dimensions,
+                                                encoding=args.encoding)
     else:
         tile_saver = cst.ColumnFileTileSaver(max_data_in_sparse,
                                                 bins_per_dimension,
                                                 file_path = args.columnfile_path,
                                                 log_file = args.log_file,
-                                                num_dimensions=num_dimensions)
+                                                num_dimensions=num_dimensions,
+                                                encoding=args.encoding)
 
     ############################################################################
 
@@ -184,10 +193,12 @@ def main():
                 c = cooler.Cooler(f[str(i)])
                 matrix = c.matrix(balance=True, as_pixels=True, join=True)
 
-                coolers_matrix[i] = {'cooler': c, 'matrix': matrix}
+                coolers_matrix[i] = {'cooler': c, 'matrix': matrix,
+                                     'chrominfo': chrominfo}
 
             recursive_generate_tiles(col.deque([(0,0,0)]), coolers_matrix, tileset_info, 
-                    args.resolution, max_zoom_to_generate, queue)
+                    args.resolution, max_zoom_to_generate, queue,
+                    max_data_in_sparse=max_data_in_sparse)
     except KeyboardInterrupt:
         print("kb interrupt:")
         for (ts, p) in tilesaver_processes:
@@ -0,0 +1,36 @@
+#!/usr/bin/python
+
+from __future__ import print_function
+
+import clodius.hdf_tiles as hdft
+import argparse
+import h5py
+import shutil
+
+def main():
+    parser = argparse.ArgumentParser(description="""
+
+    python index_hibed.py input.hibed [--output-file indexed.hibed]
+
+    Store the start positions of the entries at each zoom level of a
+    discrete hdf_tile (hibed) file, so that they don't have to be parsed
+    from the entries when the file is first opened to retrieve tiles.
+""")
+
+    parser.add_argument('input_file')
+    parser.add_argument('-o', '--output-file', default=None,
+            help="Write the indexed file here instead of adding the index "
+            "to the input file")
+
+    args = parser.parse_args()
+
+    output_file = args.input_file
+    if args.output_file is not None:
+        shutil.copyfile(args.input_file, args.output_file)
+        output_file = args.output_file
+
+    with h5py.File(output_file, 'r+') as f:
+        hdft.add_discrete_index(f)
+
+if __name__ == '__main__':
+    main()
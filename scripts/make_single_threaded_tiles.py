@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import argparse
+import clodius.genome_sort as cgs
 import clodius.save_tiles as cst
 import functools as ft
 import itertools as it
@@ -22,7 +23,7 @@ sys.excepthook = cst.handle_exception
 def default_tile(length):
     return np.zeros(length)
 
-def create_tiles(q, first_lines, input_source, position_cols, value_pos, max_zoom, 
+def create_tiles(q, entries, position_cols, value_pos, max_zoom, 
         bins_per_dimension, tile_saver, expand_range, ignore_0, tileset_info, max_width,
         triangular=False, max_queue_size = 40000, print_status=False):
     active_tiles = col.defaultdict(sco.SortedList)
@@ -77,20 +78,19 @@ def create_tiles(q, first_lines, input_source, position_cols, value_pos, max_zoo
                 print("tile_mod_pos:", tile_mod_pos, tile_position)
                 raise
 
-    for line_num,line in enumerate(it.chain(first_lines, input_source)):
+    # each entry is a list of the values in one line (or row) of the input
+    for line_num,line_parts in enumerate(entries):
         # see if we have to expand any coordinate ranges
         # bedFiles are examples
         # chr1 100 102 0.5
         # means that we need to expand that to
         # chr1 100 101 0.5
         # chr1 101 102 0.5
-        all_line_parts = []
-
-        all_line_parts = [[p for p in line.strip().split()]]
+        all_line_parts = [line_parts]
 
         for line_parts in all_line_parts:
             if ignore_0:
-                if line_parts[value_pos][0] == "0":
+                if float(line_parts[value_pos[0]]) == 0:
                     continue
             value = [float(line_parts[vp]) for vp in value_pos]
             #print "entry_pos:", entry_pos, value
@@ -267,8 +267,15 @@ def main():
     parser.add_argument('-n', '--num-threads', default=4, type=int)
     parser.add_argument('--triangular', default=False, action='store_true')
     parser.add_argument('--log-file', default=None)
+    parser.add_argument('--encoding', default='json', choices=cst.DENSE_ENCODINGS,
+                        help="How to store the values of dense tiles (float16 clips "
+                        "values beyond +/-65504)")
     parser.add_argument('--max-queue-size', default=40000, type=int)
     parser.add_argument('--print-status', default=None, type=int)
+    parser.add_argument('-i', '--input-file', default=None,
+                        help="Read the input from this file rather than stdin. "
+                        ".npy files (e.g. from process_file.py) are read as "
+                        "binary columns and checked for sortedness as they're read")
 
     args = parser.parse_args()
 
@@ -276,9 +283,17 @@ def main():
         print >>sys.stderr, "One of --resolution and --max-zoom must be set"
         sys.exit(1)
 
-    first_line = sys.stdin.readline()
-    first_line_parts = first_line.strip().split()
-    if len(first_line_parts) == 0:
+    binary_input = args.input_file is not None and args.input_file.endswith('.npy')
+
+    if binary_input:
+        num_columns = len(cgs.get_columns(np.load(args.input_file, mmap_mode='r')))
+    else:
+        input_source = sys.stdin if args.input_file is None else open(args.input_file, 'r')
+
+        first_line = input_source.readline()
+        num_columns = len(first_line.strip().split())
+
+    if num_columns == 0:
         print("ERROR: no input")
         return
 
@@ -289,7 +304,7 @@ def main():
 
     # if specific position columns aren't specified, use all but the last column
     if position_cols is None:
-        position_cols = list(range(1,len(first_line_parts)))
+        position_cols = list(range(1,num_columns))
 
     if args.assembly is not None:
         mins = [1 for p in position_cols]
@@ -329,7 +344,7 @@ def main():
 
     # if there's not column designated as the value column, use the last column
     if value_pos is None:
-        value_pos = [len(first_line_parts)-1]
+        value_pos = [num_columns-1]
     else:
         value_pos = [int(vp) - 1 for vp in value_pos.split(',')]
 
@@ -361,7 +376,8 @@ def main():
                                                 args.elasticsearch_url,
                                                 args.log_file,
                                                 args.print_status,
-                                                initial_value = [0. for vp in value_pos])
+                                                initial_value = [0. for vp in value_pos],
+                                                encoding = args.encoding)
     else:
         tile_saver = cst.ColumnFileTileSaver(max_data_in_sparse,
                                                 args.bins_per_dimension,
@@ -369,7 +385,8 @@ def main():
                                                 args.columnfile_path,
                                                 args.log_file,
                                                 args.print_status,
-                                                initial_value = [0. for vp in value_pos])
+                                                initial_value = [0. for vp in value_pos],
+                                                encoding = args.encoding)
 
     for i in range(args.num_threads):
         p = mpr.Process(target=cst.tile_saver_worker, args=(q, tile_saver, finished))
@@ -391,8 +408,14 @@ def main():
                           'tile_value': tileset_info})
     tile_saver.flush()
 
+    if binary_input:
+        entries = cgs.iter_sorted_rows(args.input_file, [p-1 for p in position_cols],
+                args.triangular)
+    else:
+        entries = (line.strip().split() for line in it.chain([first_line], input_source))
+
     try:
-        tileset_info = create_tiles(q, [first_line], sys.stdin, position_cols, value_pos, 
+        tileset_info = create_tiles(q, entries, position_cols, value_pos, 
                 max_zoom, args.bins_per_dimension, tile_saver, expand_range,
                 args.ignore_0, tileset_info, max_width, args.triangular, args.max_queue_size,
                 print_status=args.print_status)
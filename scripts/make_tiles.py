@@ -86,6 +86,9 @@ def main():
             default=None)
     parser.add_argument('--gzip', help='Compress the output JSON files using gzip', 
             action='store_true')
+    parser.add_argument('--encoding', default='json', choices=cst.DENSE_ENCODINGS,
+            help="How to store the values of dense tiles (float16 clips "
+            "values beyond +/-65504)")
     parser.add_argument('--output-format', 
             help='The format for the output matrix, can be either "dense" or "sparse"',
             default='sparse')
@@ -216,7 +219,8 @@ def main():
         # dump tiles to a directory structure
         all_tiles.foreach(ft.partial(cst.save_tile,
                                      output_dir=args.output_dir, 
-                                     gzip_output=args.gzip))
+                                     gzip_output=args.gzip,
+                                     encoding=args.encoding))
 
         dataset_info = cdd.describe_dataset(sys.argv, args)
 
@@ -1,89 +1,77 @@
 from __future__ import print_function
 
 import argparse
-import os.path as op
-import subprocess as sp
+import clodius.genome_sort as cgs
+import gzip
+import negspy.coordinates as nc
+import os
 import sys
-import tempfile as tf
+import tempfile
 
 def main():
     usage = """
-    python make_tiles.py input_file
+    python process_file.py input_file
 
-    Create tiles for all of the entries in the JSON file.
+    Convert a bedGraph or bigWig file to genome coordinates sorted by
+    position. The output is stored in a binary input_file.genome.sorted.npy
+    file, which can be passed to `clodius aggregate bedgraph` directly, as
+    gzipped text (start, end, value) lines with --text, or as plain text
+    lines on stdout with --stdout.
     """
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(usage=usage)
 
     parser.add_argument('filepath')
     parser.add_argument('-a', '--assembly', default='hg19')
-    parser.add_argument('-t', '--type', default='bedgraph')
+    parser.add_argument('--chromsizes-filename', default=None,
+                        help="A file containing chromosome sizes and order, "
+                        "instead of the assembly")
+    parser.add_argument('-t', '--type', default='bedgraph',
+                        choices=['bedgraph', 'bigwig'])
+    parser.add_argument('-o', '--output-file', default=None,
+                        help="The file to write the sorted positions to")
+    parser.add_argument('--text', default=False, action='store_true',
+                        help="Write gzipped text rather than binary records")
+    parser.add_argument('--max-records', default=2**24, type=int,
+                        help="The maximum number of records to sort in memory")
+    parser.add_argument('--tmp-dir', default=None,
+                        help="Where to store partially sorted data")
     parser.add_argument('--stdout', default=False, action='store_true',
-                        help="Dump output to stdout (not implemented yet)")
+                        help="Write the sorted (start, end, value) lines to "
+                        "stdout instead of a file")
 
     args = parser.parse_args()
 
-    filedir = op.dirname(args.filepath)
-    outfile = open(args.filepath + '.genome.sorted.gz', 'w')
-
-    tempfile = tf.TemporaryFile('w+b')
+    if args.chromsizes_filename is not None:
+        chrom_info = nc.get_chrominfo_from_file(args.chromsizes_filename)
+    else:
+        chrom_info = nc.get_chrominfo(args.assembly)
 
     if args.type == 'bigwig':
-        tempfile1 = tf.TemporaryFile()
-
-        p05 = sp.Popen(['bigWigToBedGraph', args.filepath, '/dev/fd/1'],
-                        stdout = tempfile1)
-        p05.wait()
-        tempfile1.seek(0)
-
-        p0 = sp.Popen(['pv', '-f', '-'], 
-                        stdin=tempfile1,
-                        stdout=sp.PIPE, 
-                        stderr=sp.PIPE, 
-                        universal_newlines=True)
-        pn = p0
-    elif args.type == 'bedgraph':
-        p0 = sp.Popen(['pv', '-f', args.filepath], 
-                        stdout=sp.PIPE, 
-                        stderr=sp.PIPE, 
-                        universal_newlines=True)
-        pn = p0
-
-    p1 = sp.Popen(["awk", "{print $1, $2, $1, $3, $4 }"],  
-                    stdin = pn.stdout,
-                   stdout=sp.PIPE)
-    p2 = sp.Popen(['chr_pos_to_genome_pos.py', '-e 5', '-a', '{}'.format(args.assembly)],
-                    stdin = p1.stdout,
-                    stdout=sp.PIPE)
-    p3 = sp.Popen(['sort', '-k1,1n', '-k2,2n', '-'],
-                    stdin = p2.stdout, 
-                    stdout=tempfile)
-
-    for line in iter(p0.stderr.readline, ""):
-        print("line:", line.strip())
-
-    p0.wait()
-    p1.wait()
-    p2.wait()
-    p3.wait()
-
-    tempfile.flush()
-    print("tell:", tempfile.tell())
-    tempfile.seek(0)
-
-    p35 = sp.Popen(['pv', '-f', '-'],
-                    stdin = tempfile,
-                    stdout = sp.PIPE,
-                    stderr = sp.PIPE,
-                    universal_newlines=True)
-    p4 = sp.Popen(['gzip'],
-                    stdin = p35.stdout, stdout=outfile)
-    for line in iter(p35.stderr.readline, ""):
-        print("line:", line.strip())
-
-    p35.wait()
-    p4.wait()
-
-    print("filedir:", filedir)
+        chunks = cgs.read_bigwig(args.filepath, chrom_info)
+    else:
+        chunks = cgs.read_bedgraph(args.filepath, chrom_info)
+
+    output_file = args.output_file
+    if output_file is None:
+        output_file = args.filepath + ('.genome.sorted.gz' if args.text else '.genome.sorted.npy')
+
+    if args.stdout:
+        (fd, records_file) = tempfile.mkstemp(suffix='.npy', dir=args.tmp_dir)
+        os.close(fd)
+    else:
+        records_file = output_file + '.npy' if args.text else output_file
+
+    num_records = cgs.sort_records(chunks, records_file, args.max_records, args.tmp_dir)
+    print("sorted records:", num_records, file=sys.stderr)
+
+    if args.stdout:
+        cgs.write_text(records_file, sys.stdout)
+        os.remove(records_file)
+    elif args.text:
+        with gzip.open(output_file, 'wt') as f:
+            cgs.write_text(records_file, f)
+
+        os.remove(records_file)
 
 if __name__ == '__main__':
     main()
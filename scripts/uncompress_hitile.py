@@ -0,0 +1,25 @@
+#!/usr/bin/python
+
+from __future__ import print_function
+
+import clodius.hdf_tiles as hdft
+import argparse
+
+def main():
+    parser = argparse.ArgumentParser(description="""
+
+    python uncompress_hitile.py input.hitile output.hitile
+
+    Store all of the values in a hitile file contiguously and without
+    compression so that tiles can be served from memory mapped arrays.
+""")
+
+    parser.add_argument('input_file')
+    parser.add_argument('output_file')
+
+    args = parser.parse_args()
+
+    hdft.write_uncompressed_hitile(args.input_file, args.output_file)
+
+if __name__ == '__main__':
+    main()
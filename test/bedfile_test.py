@@ -3,9 +3,13 @@ from __future__ import print_function
 import click.testing as clt
 import clodius.cli.aggregate as cca
 import clodius.db_tiles as cdt
+import clodius.hdf_tiles as cht
+import h5py
 import os
 import os.path as op
+import pytest
 import sqlite3
+import subprocess
 import sys
 import tempfile
 
@@ -108,6 +112,30 @@ def test_chromosome_limit():
 
     os.remove(f.name)
     pass
+
+def test_discrete_index():
+    f = tempfile.NamedTemporaryFile(delete=False, suffix='.hibed')
+    f.close()
+
+    # index a copy of the file, the way scripts/index_hibed.py does
+    subprocess.check_call([sys.executable, 'scripts/index_hibed.py',
+        'test/sample_data/cnv.hibed', '--output-file', f.name],
+        env=dict(os.environ, PYTHONPATH='.'))
+
+    with h5py.File('test/sample_data/cnv.hibed', 'r') as f_in:
+        with h5py.File(f.name, 'r') as f_out:
+            assert('starts_22' in f_out)
+
+            for (z, x) in [(0, 0), (11, 5), (11, 6), (22, 48), (22, 50)]:
+                data = cht.get_discrete_data(f_in, z, x)
+                indexed_data = cht.get_discrete_data(f_out, z, x)
+
+                assert(data.tolist() == indexed_data.tolist())
+                assert(all([int(d[0]) <= (x + 1) * 1024 * 2 ** (22 - z) for d in data]))
+
+            assert(len(cht.get_discrete_data(f_out, 0, 0)) == 100)
+
+    os.remove(f.name)
 """
 def test_get_tiles():
     f = h5py.File('test/sample_data/cnv.hibed')
@@ -171,3 +199,236 @@ def test_tile_ranges():
 def test_limit_by_chromosome():
 
 """
+
+def test_num_workers():
+    input_file = op.join(testdir, 'sample_data', 'geneAnnotationsExonsUnions.short.bed')
+    output_files = []
+
+    # reading the file one chromosome per worker gives the same result (the
+    # rows are numbered in a different order since the file isn't sorted)
+    for num_workers in ['1', '3']:
+        f = tempfile.NamedTemporaryFile(delete=False)
+        output_files += [f.name]
+
+        runner = clt.CliRunner()
+        result = runner.invoke(
+                cca.bedfile,
+                [input_file,
+                    '--max-per-tile', '20', '--importance-column', '5',
+                    '--assembly', 'hg19', '--num-workers', num_workers,
+                    '--output-file', f.name])
+        assert(result.exit_code == 0)
+
+    def get_rows(filename):
+        conn = sqlite3.connect(filename)
+        return sorted(conn.execute('SELECT zoomLevel, startPos, endPos, fields '
+                'FROM intervals').fetchall())
+
+    assert(len(get_rows(output_files[0])) > 0)
+    assert(get_rows(output_files[0]) == get_rows(output_files[1]))
+
+    for filename in output_files:
+        os.remove(filename)
+
+def test_chromosome_limit_tabix(tmpdir):
+    pysam = pytest.importorskip('pysam')
+    input_file = op.join(testdir, 'sample_data', 'geneAnnotationsExonsUnions.short.bed')
+
+    with open(input_file, 'r') as f:
+        lines = sorted(f.readlines(), key=lambda l: (l.split()[0], int(l.split()[1])))
+
+    sorted_file = str(tmpdir.join('sorted.bed'))
+    with open(sorted_file, 'w') as f:
+        f.write(''.join(lines))
+
+    indexed_file = pysam.tabix_index(sorted_file, preset='bed', keep_original=True)
+
+    # seeking to the chromosome in the indexed file keeps the same lines
+    # as skipping the others in the plain file
+    output_files = []
+    for filepath in [sorted_file, indexed_file]:
+        output_files += [filepath + '.chr14.multires']
+
+        runner = clt.CliRunner()
+        result = runner.invoke(
+                cca.bedfile,
+                [filepath,
+                    '--max-per-tile', '20', '--importance-column', '5',
+                    '--assembly', 'hg19', '--chromosome', 'chr14',
+                    '--output-file', output_files[-1]])
+        assert(result.exit_code == 0)
+
+    def get_rows(filename):
+        conn = sqlite3.connect(filename)
+        return sorted(conn.execute('SELECT zoomLevel, startPos, endPos, fields '
+                'FROM intervals').fetchall())
+
+    rows = get_rows(output_files[0])
+    assert(len(rows) > 0)
+    assert(all([row[3].split()[0] == 'chr14' for row in rows]))
+    assert(rows == get_rows(output_files[1]))
+
+def test_num_workers_tabix(tmpdir):
+    pysam = pytest.importorskip('pysam')
+    input_file = op.join(testdir, 'sample_data', 'geneAnnotationsExonsUnions.short.bed')
+
+    # tabix needs the lines sorted by chromosome and position
+    with open(input_file, 'r') as f:
+        lines = sorted(f.readlines(), key=lambda l: (l.split()[0], int(l.split()[1])))
+
+    sorted_file = str(tmpdir.join('sorted.bed'))
+    with open(sorted_file, 'w') as f:
+        f.write(''.join(lines))
+
+    indexed_file = pysam.tabix_index(sorted_file, preset='bed', keep_original=True)
+    assert(indexed_file.endswith('.gz') and op.exists(indexed_file + '.tbi'))
+
+    # the workers seek to their chromosome in the indexed file and get
+    # the same result as reading the plain file with one worker
+    output_files = []
+    for (filepath, num_workers) in [(sorted_file, '1'), (indexed_file, '3')]:
+        output_files += [str(tmpdir.join('{}.multires'.format(num_workers)))]
+
+        runner = clt.CliRunner()
+        result = runner.invoke(
+                cca.bedfile,
+                [filepath,
+                    '--max-per-tile', '20', '--importance-column', '5',
+                    '--assembly', 'hg19', '--num-workers', num_workers,
+                    '--output-file', output_files[-1]])
+        assert(result.exit_code == 0)
+
+    def get_rows(filename):
+        conn = sqlite3.connect(filename)
+        return sorted(conn.execute('SELECT zoomLevel, startPos, endPos, fields '
+                'FROM intervals').fetchall())
+
+    assert(len(get_rows(output_files[0])) > 0)
+    assert(get_rows(output_files[0]) == get_rows(output_files[1]))
+
+    # the chromosomes in the index are checked against the assembly
+    with open(sorted_file, 'a') as f:
+        f.write('chrUnknown\t1000\t2000\tgene\t5\n')
+    indexed_file = pysam.tabix_index(sorted_file, preset='bed', force=True)
+
+    with pytest.raises(KeyError):
+        import clodius.cli.aggregate_bedfile as ccab
+        ccab._bedfile(indexed_file, str(tmpdir.join('unknown.multires')), 'hg19',
+                None, False, None, 100, 1024, None, None, 0, num_workers=2)
+
+def test_uid_hash(tmpdir):
+    input_file = op.join(testdir, 'sample_data', 'geneAnnotationsExonsUnions.short.bed')
+    output_files = [str(tmpdir.join('uid_hash1.multires')), str(tmpdir.join('uid_hash2.multires'))]
+
+    for output_file in output_files:
+        runner = clt.CliRunner()
+        result = runner.invoke(
+                cca.bedfile,
+                [input_file,
+                    '--max-per-tile', '20', '--importance-column', '5',
+                    '--assembly', 'hg19', '--uid-type', 'hash',
+                    '--output-file', output_file])
+        assert(result.exit_code == 0)
+
+    def get_uids(filename):
+        conn = sqlite3.connect(filename)
+        return dict(conn.execute('SELECT fields, uid FROM intervals').fetchall())
+
+    # the uids are integers which don't change when the file is aggregated
+    # again
+    uids = get_uids(output_files[0])
+    assert(all([isinstance(uid, int) for uid in uids.values()]))
+    assert(uids == get_uids(output_files[1]))
+
+    # and they're served as strings
+    rows = cdt.get_tiles(output_files[0], 0, 0)[0]
+    assert(rows[0]['uid'] == str(uids['\t'.join(rows[0]['fields'])]))
+
+def test_filtered_tiles():
+    filename = 'test/sample_data/gene_annotations.short.db'
+    zoom = 5
+    all_rows = cdt.get_tiles(filename, zoom, 0, num_tiles=4)
+
+    # only the most important intervals in each tile
+    top_rows = cdt.get_tiles(filename, zoom, 0, num_tiles=4, max_per_tile=2)
+    assert(len(top_rows) > 0)
+
+    for (tile_pos, rows) in all_rows.items():
+        importances = sorted([r['importance'] for r in rows], reverse=True)
+        assert([r['importance'] for r in top_rows[tile_pos]] == importances[:2])
+
+    # an importance range, without the fields
+    min_importance = sorted([r['importance'] for rows in all_rows.values() for r in rows])[5]
+    filtered_rows = cdt.get_tiles(filename, zoom, 0, num_tiles=4,
+            min_importance=min_importance, include_fields=False)
+
+    for (tile_pos, rows) in all_rows.items():
+        expected = [r['uid'] for r in rows if r['importance'] >= min_importance]
+        assert([r['uid'] for r in filtered_rows[tile_pos]] == expected)
+        assert(all(['fields' not in r for r in filtered_rows[tile_pos]]))
+
+def test_sorted_layout(tmpdir):
+    input_file = op.join(testdir, 'sample_data', 'geneAnnotationsExonsUnions.short.bed')
+
+    for layout in ['rtree', 'sorted']:
+        runner = clt.CliRunner()
+        result = runner.invoke(
+                cca.bedfile,
+                [input_file,
+                    '--max-per-tile', '20', '--importance-column', '5',
+                    '--assembly', 'hg19', '--uid-type', 'hash', '--layout', layout,
+                    '--output-file', str(tmpdir.join('layout.{}.multires'.format(layout)))])
+        assert(result.exit_code == 0)
+
+    # both layouts serve the same intervals
+    for zoom in [0, 5, 10]:
+        for max_per_tile in [None, 2]:
+            (rtree_tiles, sorted_tiles) = [cdt.get_tiles(str(tmpdir.join('layout.{}.multires'.format(layout))),
+                zoom, 0, num_tiles=4, max_per_tile=max_per_tile)
+                for layout in ['rtree', 'sorted']]
+
+            assert(sorted(rtree_tiles.keys()) == sorted(sorted_tiles.keys()))
+            for tile_pos in rtree_tiles:
+                assert(sorted([r['uid'] for r in rtree_tiles[tile_pos]]) ==
+                        sorted([r['uid'] for r in sorted_tiles[tile_pos]]))
+
+def test_assign_zoom_level():
+    import clodius.cli.aggregate_bedfile as ccab
+    import numpy as np
+
+    rng = np.random.RandomState(0)
+    starts = rng.randint(0, 100000, 2000)
+    ends = starts + rng.randint(1, 5000, len(starts))
+    importances = rng.randint(0, 100, len(starts)).astype(np.float64)
+    columns = (starts, ends, None, importances, None, None)
+
+    # each tile gets its most important intervals, out of the ones that
+    # weren't chosen for an earlier tile
+    chosen = ccab.assign_zoom_level(columns, np.arange(len(starts)), 1000, 5)
+    expected = []
+
+    for tile_num in range(105):
+        in_tile = [i for i in range(len(starts)) if starts[i] < (tile_num + 1) * 1000 and
+                ends[i] > tile_num * 1000 and i not in expected]
+        expected += sorted(in_tile, key=lambda i: (-importances[i], i))[:5]
+
+    assert(chosen.tolist() == expected)
+
+def test_num_workers_unknown_chromosome(tmpdir):
+    import clodius.cli.aggregate_bedfile as ccab
+
+    input_file = str(tmpdir.join('unknown_chrom.bed'))
+
+    with open(input_file, 'w') as f:
+        f.write('chr1\t1000\t2000\tgene1\t5\n')
+        f.write('chrUnknown\t1000\t2000\tgene2\t5\n')
+
+    # lines on chromosomes that aren't in the assembly fail the same way
+    # with one worker as with several
+    for num_workers in [1, 2]:
+        try:
+            ccab._bedfile(input_file, str(tmpdir.join('unknown_chrom.multires')), 'hg19',
+                    None, False, None, 100, 1024, None, None, 0, num_workers=num_workers)
+            assert(False)
+        except KeyError:
+            pass
@@ -3,6 +3,7 @@ from __future__ import print_function
 import clodius.db_tiles as cdt
 import click.testing as clt
 import clodius.cli.aggregate as cca
+import clodius.cli.aggregate_bedpe as ccap
 import h5py
 import negspy.coordinates as nc
 import os.path as op
@@ -16,7 +17,7 @@ def test_clodius_aggregate_bedpe():
     input_file = op.join(testdir, 'sample_data', 'isidro.bedpe')
     output_file = '/tmp/isidro.bed2ddb'
 
-    cca._bedpe(input_file, output_file, 'b37',
+    ccap._bedpe(input_file, output_file, 'b37',
             importance_column=None,
             chromosome=None,
             max_per_tile=100,
@@ -48,3 +49,130 @@ def test_clodius_aggregate_bedpe():
 
     tileset_info = cdt.get_tileset_info(output_file)
     #print('tileset_info', tileset_info)
+
+def test_bedpe_chromosome(tmpdir):
+    input_file = op.join(testdir, 'sample_data', 'isidro.bedpe')
+    output_file = str(tmpdir.join('isidro.chr1.bed2ddb'))
+
+    # only the contacts whose first position is on chromosome 1, not 11
+    # or 14
+    ccap._bedpe(input_file, output_file, 'b37',
+            importance_column=None,
+            chromosome='1',
+            max_per_tile=100,
+            tile_size=1024,
+            has_header=True)
+
+    import sqlite3
+    conn = sqlite3.connect(output_file)
+    rows = conn.execute('SELECT fields FROM intervals').fetchall()
+
+    assert(len(rows) == 4)
+    assert(all([row[0].split()[0] == '1' for row in rows]))
+
+def test_bedpe_columns(tmpdir):
+    input_file = op.join(testdir, 'sample_data', 'isidro.bedpe')
+    output_file = str(tmpdir.join('isidro.columns.bed2ddb'))
+
+    runner = clt.CliRunner()
+    result = runner.invoke(
+            cca.bedpe,
+            [input_file,
+            '--output-file', output_file,
+            '--importance-column', '8',
+            '--column', 'pe_support:8:int',
+            '--column', 'svclass:11:text',
+            '--has-header',
+            '--assembly', 'b37'])
+    assert(result.exit_code == 0)
+
+    import sqlite3
+    conn = sqlite3.connect(output_file)
+    rows = conn.execute('SELECT importance, pe_support, svclass, fields FROM intervals').fetchall()
+
+    for (importance, pe_support, svclass, fields) in rows:
+        fields = fields.split('\t')
+
+        assert(importance == float(fields[7]))
+        assert(pe_support == int(fields[7]))
+        assert(svclass == fields[10])
+
+    # the stored columns can be queried directly
+    (num_supported,) = conn.execute('SELECT COUNT(*) FROM intervals WHERE pe_support > 100').fetchone()
+    assert(num_supported == len([row for row in rows if row[1] > 100]))
+    assert(0 < num_supported < len(rows))
+
+    result = runner.invoke(
+            cca.bedpe,
+            [input_file,
+            '--output-file', output_file,
+            '--column', 'score:eight',
+            '--assembly', 'b37'])
+    assert(result.exit_code != 0)
+
+def test_filtered_2d_tiles(tmpdir):
+    input_file = op.join(testdir, 'sample_data', 'isidro.bedpe')
+    output_file = str(tmpdir.join('isidro.filtered.bed2ddb'))
+
+    ccap._bedpe(input_file, output_file, 'b37',
+            importance_column='8',
+            max_per_tile=100,
+            tile_size=1024,
+            has_header=True,
+            extra_columns=[('pe_support', 8, 'int')])
+
+    all_rows = cdt.get_2d_tiles(output_file, 1, 0, 0, numx=2, numy=2)
+    top_rows = cdt.get_2d_tiles(output_file, 1, 0, 0, numx=2, numy=2,
+            max_per_tile=3, include_fields=False, columns=['pe_support'])
+
+    assert(len(top_rows) > 0)
+
+    for (tile_pos, rows) in all_rows.items():
+        importances = sorted([r['importance'] for r in rows], reverse=True)
+        assert([r['importance'] for r in top_rows[tile_pos]] == importances[:3])
+        assert(all([r['pe_support'] == r['importance'] for r in top_rows[tile_pos]]))
+
+    try:
+        cdt.get_2d_tiles(output_file, 1, 0, 0, columns=['score'])
+        assert(False)
+    except ValueError:
+        pass
+
+def test_bedpe_num_workers(tmpdir):
+    input_file = str(tmpdir.join('contacts.bedpe'))
+    output_files = [str(tmpdir.join('contacts.1.bed2ddb')), str(tmpdir.join('contacts.3.bed2ddb'))]
+
+    # contacts of different lengths, some of which cross the boundaries
+    # between the parts of the genome that the workers fill in
+    with open(input_file, 'w') as f:
+        for (i, chrom) in enumerate(['chr1', 'chr2', 'chr3']):
+            for j in range(300):
+                start = (j * 7919) % 200000000
+                length = [1000, 100000, 50000000][j % 3]
+                f.write('{}\t{}\t{}\tchr2\t{}\t{}\t{}\n'.format(chrom, start,
+                    start + length, j * 1000, j * 1000 + 5000, i * 300 + j))
+
+    for (num_workers, output_file) in zip([1, 3], output_files):
+        ccap._bedpe(input_file, output_file, 'hg19',
+                importance_column='6',
+                max_per_tile=2,
+                tile_size=1024,
+                has_header=False,
+                num_workers=num_workers)
+
+    import sqlite3
+
+    def get_rows(filename):
+        conn = sqlite3.connect(filename)
+        return sorted(conn.execute('SELECT zoomLevel, fromX, toX, fromY, toY, fields '
+            'FROM intervals').fetchall())
+
+    rows = get_rows(output_files[0])
+    assert(len(set([row[0] for row in rows])) > 5)
+    assert(rows == get_rows(output_files[1]))
+
+    # every interval is indexed
+    conn = sqlite3.connect(output_files[1])
+    (num_indexed,) = conn.execute('SELECT COUNT(*) FROM intervals, position_index '
+            'WHERE intervals.id = position_index.id').fetchone()
+    assert(num_indexed == len(rows))
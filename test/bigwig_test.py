@@ -2,8 +2,12 @@ from __future__ import print_function
 
 import click.testing as clt
 import clodius.cli.aggregate as cca
+import clodius.cli.aggregate_bigwig as ccab
+import clodius.cli.checkpoint as ccc
 import clodius.hdf_tiles as ch
 import h5py
+import numpy as np
+import os
 import os.path as op
 import sys
 
@@ -38,6 +42,34 @@ def check_1d_file(filename):
 
     assert(d[513] == 4)
 
+def test_1d_tile_uncompressed(tmpdir):
+    output_file = str(tmpdir.join('test.tile_generation.uncompressed.hdf5'))
+
+    ch.write_uncompressed_hitile('test/sample_data/test.tile_generation.hdf5', output_file)
+
+    with h5py.File(output_file, 'r') as f:
+        assert(f['meta'].attrs['tile-size'] == 1024)
+        assert(isinstance(ch.get_values_array(f, 'values_0'), np.memmap))
+
+    check_1d_file(output_file)
+
+    # copying the values a few at a time gives the same file
+    ch.write_uncompressed_hitile('test/sample_data/test.tile_generation.hdf5',
+            output_file, block_size=1000)
+
+    with h5py.File('test/sample_data/test.tile_generation.hdf5', 'r') as f_in:
+        with h5py.File(output_file, 'r') as f_out:
+            for name in f_in:
+                assert(np.array_equal(f_in[name][:], f_out[name][:], equal_nan=True))
+
+            # rewriting the file replaces the old memory map rather than
+            # adding another one
+            os.utime(output_file, (0, 0))
+            ch.get_values_array(f_out, 'values_0')
+
+    assert(len([key for key in ch.memmap_cache
+        if key[:2] == (output_file, 'values_0')]) == 1)
+
 def test_tileset_info():
     check_tileset_info('test/sample_data/test.tile_generation.hdf5')
 
@@ -66,3 +98,194 @@ def test_clodius_aggregate_bigwig():
     print("Exception:", a,b)
 
     assert(result.exit_code == 0)
+
+def test_bigwig_zoom_summaries(tmpdir):
+    import pyBigWig as pbw
+
+    chromsizes_file = str(tmpdir.join('test.zoom_summaries.chromSizes'))
+    input_file = str(tmpdir.join('test.zoom_summaries.bw'))
+
+    with open(chromsizes_file, 'w') as f:
+        # chr2 isn't in the bigWig file
+        f.write('chr1\t200000\nchr2\t50000\n')
+
+    # values in aligned blocks so that the zoom summaries are exact (the
+    # last one is recalculated from the base-level values because
+    # libBigWig doesn't get its sum right)
+    starts = list(range(0, 200000, 64))
+    bwf = pbw.open(input_file, 'w')
+    bwf.addHeader([('chr1', 200000)], maxZooms=4)
+    bwf.addEntries(['chr1'] * len(starts), starts,
+            ends=[s + 32 for s in starts], values=[float(i // 64 % 8 + 1) for i in range(len(starts))])
+    bwf.close()
+
+    assert(ccab.get_bigwig_zoom_resolutions(input_file)[0] <= 4096)
+
+    for (output_file, use_zoom_summaries) in [('test.exact.hitile', False),
+            ('test.zoom_summaries.hitile', True)]:
+        ccab._bigwig(input_file, 4, 4, 16, str(tmpdir.join(output_file)), 'test',
+                chromsizes_file, None, use_zoom_summaries)
+
+    exact = h5py.File(str(tmpdir.join('test.exact.hitile')), 'r')
+    summaries = h5py.File(str(tmpdir.join('test.zoom_summaries.hitile')), 'r')
+
+    for key in exact.keys():
+        if key == 'meta':
+            continue
+
+        assert((np.isnan(exact[key][:]) == np.isnan(summaries[key][:])).all())
+        assert(np.allclose(np.nan_to_num(exact[key][:]),
+            np.nan_to_num(summaries[key][:])))
+
+    # the levels which can be calculated from the summaries are the same
+    # without reading the base-level values, the finer ones are empty
+    ccab._bigwig(input_file, 4, 4, 16, str(tmpdir.join('test.summaries_only.hitile')), 'test',
+            chromsizes_file, None, True, skip_fine_levels=True)
+    summaries_only = h5py.File(str(tmpdir.join('test.summaries_only.hitile')), 'r')
+
+    for z in [0, 4, 8, 12]:
+        values = summaries_only['values_' + str(z)][:]
+
+        if 2 ** z < ccab.get_bigwig_zoom_resolutions(input_file)[0]:
+            assert(np.isnan(values).all())
+        else:
+            assert(np.array_equal(np.isnan(values), np.isnan(exact['values_' + str(z)][:])))
+            assert(np.allclose(np.nan_to_num(values), np.nan_to_num(exact['values_' + str(z)][:])))
+
+def test_bigwig_zoom_summaries_unaligned(tmpdir):
+    import pyBigWig as pbw
+    import random
+
+    chromsizes_file = str(tmpdir.join('unaligned.chromSizes'))
+    rng = random.Random(0)
+
+    with open(chromsizes_file, 'w') as f:
+        # the chromosome boundaries don't line up with the bins either
+        f.write('chr1\t200003\nchr2\t150001\nchr3\t5000\n')
+
+    # intervals which don't line up with the zoom records or the bins, the
+    # gaps between them give the first file 256 and 1024 bp summaries and
+    # the second one 1600 bp summaries, which don't divide any bin size
+    for (name, gap, max_length, resolutions) in [('short_gaps', 64, 32, [256, 1024]),
+            ('long_gaps', 400, 200, [1600])]:
+        input_file = str(tmpdir.join(name + '.bw'))
+
+        bwf = pbw.open(input_file, 'w')
+        bwf.addHeader([('chr1', 200003), ('chr2', 150001)], maxZooms=4)
+        for (chrom, size) in [('chr1', 200003), ('chr2', 150001)]:
+            starts = [37 + gap * i + rng.randint(0, gap // 2)
+                    for i in range((size - 2 * gap) // gap)]
+            bwf.addEntries([chrom] * len(starts), starts,
+                    ends=[s + rng.randint(1, max_length) for s in starts],
+                    values=[rng.random() * 10 for s in starts])
+        bwf.close()
+
+        assert(ccab.get_bigwig_zoom_resolutions(input_file)[:len(resolutions)] == resolutions)
+
+        outputs = []
+        for use_zoom_summaries in [False, True]:
+            outputs += [str(tmpdir.join('{}.{}.hitile'.format(name, use_zoom_summaries)))]
+            ccab._bigwig(input_file, 4, 4, 16, outputs[-1], 'test',
+                    chromsizes_file, None, use_zoom_summaries)
+
+        with h5py.File(outputs[0], 'r') as exact:
+            with h5py.File(outputs[1], 'r') as summaries:
+                for key in exact.keys():
+                    if key == 'meta':
+                        continue
+
+                    assert(np.array_equal(np.isnan(exact[key][:]), np.isnan(summaries[key][:])))
+                    assert(np.allclose(np.nan_to_num(exact[key][:]),
+                        np.nan_to_num(summaries[key][:]), rtol=1e-4, atol=1e-2))
+
+def write_random_intervals(tmpdir):
+    '''
+    Write a bigWig file with randomly placed intervals on two chromosomes,
+    along with a chromsizes file that has a third chromosome.
+
+    :return: The (bigwig, chromsizes) filenames
+    '''
+    import pyBigWig as pbw
+
+    chromsizes_file = str(tmpdir.join('test.intervals.chromSizes'))
+    input_file = str(tmpdir.join('test.intervals.bw'))
+
+    with open(chromsizes_file, 'w') as f:
+        # chr3 isn't in the bigWig file
+        f.write('chr1\t100003\nchr2\t50000\nchr3\t20000\n')
+
+    np.random.seed(0)
+    bwf = pbw.open(input_file, 'w')
+    bwf.addHeader([('chr1', 100003), ('chr2', 50000)])
+    for (chrom, chrom_size) in [('chr1', 100003), ('chr2', 50000)]:
+        starts = np.arange(0, chrom_size - 100, 97) + np.random.randint(0, 40, (chrom_size - 100) // 97 + 1)
+        bwf.addEntries([chrom] * len(starts), starts.tolist(),
+                ends=(starts + np.random.randint(1, 50, len(starts))).tolist(),
+                values=np.random.random(len(starts)).tolist())
+    bwf.close()
+
+    return (input_file, chromsizes_file)
+
+def test_bigwig_intervals(tmpdir):
+    (input_file, chromsizes_file) = write_random_intervals(tmpdir)
+
+    for (output_file, use_intervals) in [('test.exact.hitile', False),
+            ('test.intervals.hitile', True)]:
+        ccab._bigwig(input_file, 4, 4, 16, str(tmpdir.join(output_file)), 'test',
+                chromsizes_file, None, False, use_intervals)
+
+    exact = h5py.File(str(tmpdir.join('test.exact.hitile')), 'r')
+    intervals = h5py.File(str(tmpdir.join('test.intervals.hitile')), 'r')
+
+    for key in exact.keys():
+        if key == 'meta':
+            continue
+
+        assert((np.isnan(exact[key][:]) == np.isnan(intervals[key][:])).all())
+        assert(np.allclose(np.nan_to_num(exact[key][:]),
+            np.nan_to_num(intervals[key][:]), rtol=1e-5))
+
+def test_bigwig_resume(tmpdir):
+    (input_file, chromsizes_file) = write_random_intervals(tmpdir)
+    full_file = str(tmpdir.join('test.full.hitile'))
+    resumed_file = str(tmpdir.join('test.resumed.hitile'))
+
+    ccab._bigwig(input_file, 6, 4, 16, full_file, 'test',
+            chromsizes_file, None, checkpoint_interval=-1)
+
+    # stop after a few checkpoints as if the job had been preempted
+    save_checkpoint = ccc.save_checkpoint
+    num_checkpoints = []
+
+    def interrupted_save_checkpoint(*args, **kwargs):
+        save_checkpoint(*args, **kwargs)
+        num_checkpoints.append(1)
+
+        if len(num_checkpoints) == 5:
+            raise KeyboardInterrupt()
+
+    ccc.save_checkpoint = interrupted_save_checkpoint
+    try:
+        ccab._bigwig(input_file, 6, 4, 16, resumed_file, 'test',
+                chromsizes_file, None, checkpoint_interval=-1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ccc.save_checkpoint = save_checkpoint
+
+    assert(op.exists(resumed_file + '.checkpoint'))
+
+    ccab._bigwig(input_file, 6, 4, 16, resumed_file, 'test',
+            chromsizes_file, None, resume=True, checkpoint_interval=-1)
+
+    assert(not op.exists(resumed_file + '.checkpoint'))
+
+    full = h5py.File(full_file, 'r')
+    resumed = h5py.File(resumed_file, 'r')
+
+    for key in full.keys():
+        if key == 'meta':
+            continue
+
+        assert((np.isnan(full[key][:]) == np.isnan(resumed[key][:])).all())
+        assert(np.allclose(np.nan_to_num(full[key][:]), np.nan_to_num(resumed[key][:])))
@@ -319,3 +319,173 @@ def test_clodius_aggregate_bigwig():
     assert(d[513] == 1)
 
     assert(result.exit_code == 0)
+
+def test_clodius_profile(tmpdir):
+    import pstats
+    import tracemalloc
+
+    input_file = op.join(testdir, 'sample_data', 'cnvs_hw.tsv')
+    assembly_file = op.join(testdir, 'sample_data', 'test_cnvs_assembly')
+    output_file = str(tmpdir.join('cnvs_hw.hitile'))
+    args = ['aggregate', 'bedgraph', input_file,
+            '--output-file', output_file,
+            '--chromsizes-filename', assembly_file,
+            '--chromosome-col', '2',
+            '--from-pos-col', '3',
+            '--to-pos-col', '4',
+            '--value-col', '5',
+            '--has-header',
+            '--nan-value', 'NA']
+    profile_file = str(tmpdir.join('cnvs_hw.pstats'))
+
+    runner = clt.CliRunner()
+    result = runner.invoke(
+            cca.cli,
+            ['--profile', 'cprofile',
+            '--profile-out', profile_file] + args)
+
+    assert(result.exit_code == 0)
+    stats = pstats.Stats(profile_file)
+    assert(any([func[2] == '_bedgraph' for func in stats.stats]))
+
+    # only sample the allocations during the aggregation stage
+    profile_file = str(tmpdir.join('cnvs_hw.tracemalloc'))
+    result = runner.invoke(
+            cca.cli,
+            ['--profile', 'tracemalloc',
+            '--profile-out', profile_file,
+            '--profile-stage', 'aggregate'] + args)
+
+    assert(result.exit_code == 0)
+    tracemalloc.Snapshot.load(profile_file)
+    tracemalloc.Snapshot.load(profile_file + '.aggregate.0')
+
+def test_clodius_lazy_imports():
+    import subprocess
+
+    # the heavy dependencies should only be imported when a command that
+    # needs them is run
+    output = subprocess.check_output([sys.executable, '-c',
+        'import sys; import clodius.cli.aggregate as cca; '
+        'cca.cli.main(["--help"], standalone_mode=False); '
+        'print(" ".join(sorted(sys.modules)))'])
+    modules = output.decode('utf-8').split()
+
+    for module in ['h5py', 'pyBigWig', 'numpy', 'negspy', 'sqlite3', 'slugid']:
+        assert(module not in modules)
+
+def test_assembly_choice():
+    import click
+
+    choice = cca.AssemblyChoice()
+
+    assert(choice.case_sensitive)
+    assert('hg19' in choice.choices)
+    assert(choice.convert('hg19', None, None) == 'hg19')
+
+    try:
+        choice.convert('not_an_assembly', None, None)
+        assert(False)
+    except click.BadParameter:
+        pass
+
+def test_clodius_aggregate_batch(tmpdir):
+    import json
+
+    bedfile_input = op.join(testdir, 'sample_data', 'geneAnnotationsExonsUnions.hg19.short.bed')
+    bedpe_input = op.join(testdir, 'sample_data', 'Rao_RepA_GM12878_Arrowhead.txt')
+    manifest = str(tmpdir.join('batch_manifest.tsv'))
+    report_file = str(tmpdir.join('batch_report.json'))
+    missing_input = str(tmpdir.join('does_not_exist.bed'))
+    cooler_input = str(tmpdir.join('batch.cool'))
+
+    with open(manifest, 'w') as f:
+        f.write('# input\ttype\toptions\n')
+        f.write('{}\tbedfile\t--importance-column 5 --output-file {}\n'.format(
+            bedfile_input, tmpdir.join('batch.beddb')))
+        f.write('{}\tbedpe\t--chr1-col 1 --from1-col 2 --to1-col 3 --chr2-col 1 '
+                '--from2-col 2 --to2-col 3 --output-file {}\n'.format(
+                    bedpe_input, tmpdir.join('batch.bed2ddb')))
+        f.write('{}\tbedfile\t--output-file {}\n'.format(missing_input, tmpdir.join('batch2.beddb')))
+        f.write('{}\tcooler\n'.format(cooler_input))
+
+    runner = clt.CliRunner()
+    result = runner.invoke(
+            cca.cli,
+            ['aggregate', 'batch', manifest,
+            '--num-workers', 2,
+            '--report-file', report_file])
+
+    # the failures are reported but don't stop the rest of the batch
+    assert(result.exit_code == 1)
+
+    with open(report_file, 'r') as f:
+        results = dict([(r['input'], r) for r in map(json.loads, f)])
+
+    assert(len(results) == 4)
+    assert(results[bedfile_input]['status'] == 'ok')
+    assert(results[bedpe_input]['status'] == 'ok')
+    assert(results[missing_input]['status'] == 'error')
+    assert(results[cooler_input]['status'] == 'error')
+
+    assert(len(cdt.get_tiles(str(tmpdir.join('batch.beddb')), 0, 0)[0]) > 0)
+    assert(len(cdt.get_2d_tiles(str(tmpdir.join('batch.bed2ddb')), 0, 0, 0)[(0, 0)]) > 0)
+
+def test_clodius_aggregate_batch_parallel_jobs(tmpdir):
+    import json
+
+    bedfile_input = op.join(testdir, 'sample_data', 'geneAnnotationsExonsUnions.hg19.short.bed')
+    manifest = str(tmpdir.join('manifest.tsv'))
+    report_file = str(tmpdir.join('report.json'))
+
+    with open(manifest, 'w') as f:
+        # the jobs can't start their own workers when the batch is run
+        # in parallel, so they're run with one
+        f.write('{}\tbedfile\t--importance-column 5 --num-workers 2 --output-file {}\n'.format(
+            bedfile_input, tmpdir.join('parallel.beddb')))
+        f.write('{}\tbedfile\t--importance-column 5 --output-file {}\n'.format(
+            bedfile_input, tmpdir.join('serial.beddb')))
+        # commands that stop early report an error
+        f.write('-\tbedgraph\t--resume --output-file {}\n'.format(tmpdir.join('stdin.hitile')))
+
+    runner = clt.CliRunner()
+    result = runner.invoke(
+            cca.cli,
+            ['aggregate', 'batch', manifest,
+            '--num-workers', 2,
+            '--report-file', report_file])
+
+    with open(report_file, 'r') as f:
+        results = dict([(r['input'], r) for r in map(json.loads, f)])
+
+    assert(result.exit_code == 1)
+    assert(results['-']['status'] == 'error')
+    assert(len(cdt.get_tiles(str(tmpdir.join('parallel.beddb')), 0, 0)[0]) > 0)
+
+    # the entries get new random uids in each run
+    (parallel, serial) = [[dict(e, uid=None) for e in cdt.get_tiles(str(tmpdir.join(name)), 0, 0)[0]]
+            for name in ['parallel.beddb', 'serial.beddb']]
+    assert(parallel == serial)
+
+def test_clodius_aggregate_batch_preload(tmpdir):
+    import clodius.cli.aggregate_batch as ccab
+    import clodius.cli.utils as ccu
+
+    chromsizes_file = str(tmpdir.join('batch_preload.chromSizes'))
+
+    with open(chromsizes_file, 'w') as f:
+        f.write('chr1\t1000\nchr2\t500\n')
+
+    ccu.chrominfo_cache.clear()
+    jobs = [(str(tmpdir.join('a.bed')), 'bedfile', ['--assembly', 'mm9']),
+            (str(tmpdir.join('b.bedGraph')), 'bedgraph', ['--assembly', 'mm9']),
+            (str(tmpdir.join('c.bed')), 'bedfile', ['--chromsizes-filename', chromsizes_file])]
+
+    assert(ccab.preload(jobs) == [None, None, None])
+    assert(set(ccu.chrominfo_cache.keys()) ==
+            set([('assembly', 'mm9'), ('file', chromsizes_file)]))
+
+    # the jobs get the copy that was loaded when preloading
+    chrom_info = ccu.chrominfo_cache[('assembly', 'mm9')]
+    assert(ccu.get_chrominfo('mm9')[0] is chrom_info)
+    assert(ccu.get_chrominfo(None, chromsizes_file)[1:] == (['chr1', 'chr2'], [1000, 500]))
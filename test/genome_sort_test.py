@@ -0,0 +1,302 @@
+from __future__ import print_function
+
+import clodius.cli.aggregate_bedgraph as ccag
+import clodius.genome_sort as cgs
+import h5py
+import negspy.coordinates as nc
+import numpy as np
+import os.path as op
+import pytest
+import random
+
+testdir = op.realpath(op.dirname(__file__))
+
+def test_sort_records(tmpdir):
+    output_file = str(tmpdir.join('sorted_records.npy'))
+
+    rng = np.random.RandomState(0)
+
+    records = np.empty(10000, dtype=cgs.RECORD_DTYPE)
+    records['start'] = rng.randint(0, 1000, len(records))
+    records['end'] = records['start'] + np.arange(len(records))
+    records['value'] = rng.random_sample(len(records))
+
+    # small enough that the records have to be merged from several runs
+    chunks = [records[i:i+700] for i in range(0, len(records), 700)]
+    num_records = cgs.sort_records(chunks, output_file, max_records=1000)
+
+    sorted_records = np.load(output_file)
+    expected = records[np.lexsort((records['end'], records['start']))]
+
+    assert(num_records == len(records))
+    assert((sorted_records == expected).all())
+
+def test_sorted_bedgraph_input(tmpdir):
+    input_file = op.join(testdir, 'sample_data', 'cnvs_hw.tsv')
+    assembly_file = op.join(testdir, 'sample_data', 'test_cnvs_assembly')
+    shuffled_file = str(tmpdir.join('cnvs_hw.shuffled.tsv'))
+    sorted_file = str(tmpdir.join('cnvs_hw.sorted.npy'))
+    text_output = str(tmpdir.join('cnvs_hw.text.hitile'))
+    sorted_output = str(tmpdir.join('cnvs_hw.sorted.hitile'))
+    chrom_info = nc.get_chrominfo_from_file(assembly_file)
+
+    # shuffle the lines so that there's something to sort
+    with open(input_file, 'r') as f:
+        header = f.readline()
+        lines = f.readlines()
+    random.Random(0).shuffle(lines)
+
+    with open(shuffled_file, 'w') as f:
+        f.write(header)
+        f.write(''.join(lines))
+
+    chunks = cgs.read_bedgraph(shuffled_file, chrom_info,
+            2, 3, 4, 5, has_header=True, nan_value='NA', chunk_size=10)
+    cgs.sort_records(chunks, sorted_file, max_records=50)
+
+    # aggregating the sorted binary file gives the same result as
+    # aggregating the original text
+    for (filepath, output_file) in [(input_file, text_output), (sorted_file, sorted_output)]:
+        ccag._bedgraph(filepath, output_file, 'hg19', 2, 3, 4, 5, True, None,
+                1024, 14, 'sum', 'NA', 'none', False, assembly_file, 8)
+
+    with h5py.File(text_output, 'r') as f1:
+        with h5py.File(sorted_output, 'r') as f2:
+            assert(f1['meta'].attrs['max-position'] == f2['meta'].attrs['max-position'])
+
+            for z in range(0, int(f1['meta'].attrs['max-zoom']) + 1, 8):
+                assert(np.allclose(f1['values_' + str(z)][:], f2['values_' + str(z)][:],
+                    equal_nan=True))
+                assert(np.allclose(f1['nan_values_' + str(z)][:], f2['nan_values_' + str(z)][:]))
+
+def test_process_file_stdout(tmpdir):
+    import io
+    import os
+    import subprocess
+    import sys
+
+    chromsizes_file = str(tmpdir.join('process_file.chromSizes'))
+    input_file = str(tmpdir.join('process_file.bedgraph'))
+    sorted_file = str(tmpdir.join('process_file.npy'))
+
+    with open(chromsizes_file, 'w') as f:
+        f.write('chr1\t50000\nchr2\t30000\n')
+
+    with open(input_file, 'w') as f:
+        for (chrom, start) in [('chr2', 5000), ('chr1', 3000), ('chr2', 1000), ('chr1', 100)]:
+            f.write('{}\t{}\t{}\t{}\n'.format(chrom, start, start + 100, start / 100.))
+
+    output = subprocess.check_output([sys.executable, 'scripts/process_file.py',
+        input_file, '--chromsizes-filename', chromsizes_file,
+        '--stdout'], env=dict(os.environ, PYTHONPATH='.'))
+
+    chrom_info = nc.get_chrominfo_from_file(chromsizes_file)
+    chunks = cgs.read_bedgraph(input_file, chrom_info)
+    cgs.sort_records(chunks, sorted_file)
+    expected = io.StringIO()
+    cgs.write_text(sorted_file, expected)
+
+    assert(output.decode('utf-8') == expected.getvalue())
+    assert([int(line.split()[0]) for line in expected.getvalue().split('\n')[:-1]] ==
+            [100, 3000, 51000, 55000])
+
+def test_iter_sorted_rows(tmpdir):
+    contacts_file = str(tmpdir.join('contacts.npy'))
+
+    contacts = np.array([[1, 5, 0.5], [2, 1, 1.], [3, 4, 2.], [5, 2, 3.]])
+    np.save(contacts_file, contacts)
+
+    rows = list(cgs.iter_sorted_rows(contacts_file, [0, 1], block_size=3))
+    assert(rows == [tuple(row) for row in contacts.tolist()])
+
+    # the smallest positions aren't sorted, which is only a problem for
+    # triangular tiling. The unsorted row is in the second block
+    try:
+        list(cgs.iter_sorted_rows(contacts_file, [0, 1], triangular=True, block_size=3))
+        assert(False)
+    except ValueError as e:
+        assert('row 3' in str(e))
+
+def test_bedgraph_chromosome(tmpdir):
+    chromsizes_file = str(tmpdir.join('two_chroms.chromSizes'))
+    input_file = str(tmpdir.join('two_chroms.bedgraph'))
+    sorted_file = str(tmpdir.join('two_chroms.npy'))
+    genome_output = str(tmpdir.join('two_chroms.hitile'))
+    chr2_output = str(tmpdir.join('two_chroms.chr2.hitile'))
+    sorted_chr2_output = str(tmpdir.join('two_chroms.npy.chr2.hitile'))
+
+    with open(chromsizes_file, 'w') as f:
+        f.write('chr1\t50000\nchr2\t30000\n')
+
+    with open(input_file, 'w') as f:
+        for (chrom, length) in [('chr1', 50000), ('chr2', 30000)]:
+            for start in range(1000, length, 1000):
+                f.write('{}\t{}\t{}\t{}\n'.format(chrom, start, start + 1000, start / 1000.))
+
+    chrom_info = nc.get_chrominfo_from_file(chromsizes_file)
+    chunks = cgs.read_bedgraph(input_file, chrom_info)
+    cgs.sort_records(chunks, sorted_file)
+
+    for (filepath, chromosome, output_file) in [
+            (input_file, None, genome_output),
+            (input_file, 'chr2', chr2_output),
+            (sorted_file, 'chr2', sorted_chr2_output)]:
+        ccag._bedgraph(filepath, output_file, 'hg19', 1, 2, 3, 4, False, chromosome,
+                1024, 2, 'sum', None, 'none', False, chromsizes_file, 8)
+
+    with h5py.File(genome_output, 'r') as f:
+        all_values = f['values_0'][:]
+
+    for output_file in [chr2_output, sorted_chr2_output]:
+        with h5py.File(output_file, 'r') as f:
+            values = f['values_0'][:]
+
+        # only the values on chr2 are filled in, the rest of the genome
+        # (including the last position, which is never written) is empty
+        assert(np.isnan(values[:50000]).all())
+        assert(np.allclose(values[50000:-1], all_values[50000:-1], equal_nan=True))
+        assert(not np.isnan(values[51000:-1]).any())
+        assert(np.isnan(values[-1]))
+
+def test_bedgraph_chromosome_tabix(tmpdir):
+    pysam = pytest.importorskip('pysam')
+    chromsizes_file = str(tmpdir.join('two_chroms.chromSizes'))
+    input_file = str(tmpdir.join('two_chroms.bedgraph'))
+
+    with open(chromsizes_file, 'w') as f:
+        f.write('chr1\t50000\nchr2\t30000\n')
+
+    with open(input_file, 'w') as f:
+        for (chrom, length) in [('chr1', 50000), ('chr2', 30000)]:
+            for start in range(1000, length, 1000):
+                f.write('{}\t{}\t{}\t{}\n'.format(chrom, start, start + 1000, start / 1000.))
+
+    indexed_file = pysam.tabix_index(input_file, preset='bed', keep_original=True)
+
+    # seeking to the chromosome in the indexed file gives the same values
+    # as skipping the other chromosomes' lines
+    output_files = []
+    for filepath in [input_file, indexed_file]:
+        output_files += [filepath + '.chr2.hitile']
+        ccag._bedgraph(filepath, output_files[-1], 'hg19', 1, 2, 3, 4, False, 'chr2',
+                1024, 2, 'sum', None, 'none', False, chromsizes_file, 2)
+
+    with h5py.File(output_files[0], 'r') as f1:
+        with h5py.File(output_files[1], 'r') as f2:
+            assert(not np.isnan(f1['values_0'][51000:79999]).any())
+
+            for name in f1:
+                if name != 'meta':
+                    assert(np.array_equal(f1[name][:], f2[name][:], equal_nan=True))
+
+def test_bedgraph_chromosome_zoom_levels(tmpdir):
+    chromsizes_file = str(tmpdir.join('two_chroms.chromSizes'))
+    input_file = str(tmpdir.join('chr2_only.bedgraph'))
+    genome_output = str(tmpdir.join('chr2_only.hitile'))
+    chr2_output = str(tmpdir.join('chr2_only.chr2.hitile'))
+
+    with open(chromsizes_file, 'w') as f:
+        f.write('chr1\t50000\nchr2\t30000\n')
+
+    with open(input_file, 'w') as f:
+        for start in range(1000, 30000, 1000):
+            f.write('chr2\t{}\t{}\t{}\n'.format(start, start + 1000, start / 1000.))
+
+    for (chromosome, output_file) in [(None, genome_output), ('chr2', chr2_output)]:
+        ccag._bedgraph(input_file, output_file, 'hg19', 1, 2, 3, 4, False,
+                chromosome, 256, 2, 'sum', None, 'none', False, chromsizes_file, 2)
+
+    # starting at the chromosome gives the same values at every zoom level
+    # as filling in the gap before it (the last position is never written)
+    with h5py.File(genome_output, 'r') as f1:
+        with h5py.File(chr2_output, 'r') as f2:
+            names = [name for name in f1 if name != 'meta']
+            assert(len(names) == 10)
+
+            for name in names:
+                assert(np.array_equal(f1[name][:-1], f2[name][:-1], equal_nan=True))
+
+def test_bedgraph_num_workers(tmpdir):
+    input_file = op.join(testdir, 'sample_data', 'dm3_values.tsv')
+
+    # one chromosome per worker gives the same result as reading the whole
+    # file at once
+    for num_workers in [1, 3]:
+        ccag._bedgraph(input_file, str(tmpdir.join('dm3_values.{}.hitile'.format(num_workers))),
+                'dm3', 1, 2, 3, 4, False, None, 1024, 14, 'sum', None, 'none', False,
+                None, 8, num_workers=num_workers)
+
+    with h5py.File(str(tmpdir.join('dm3_values.1.hitile')), 'r') as f1:
+        with h5py.File(str(tmpdir.join('dm3_values.3.hitile')), 'r') as f2:
+            assert(f1['meta'].attrs['max-position'] == f2['meta'].attrs['max-position'])
+
+            for z in range(0, int(f1['meta'].attrs['max-zoom']) + 1, 8):
+                assert(np.array_equal(f1['values_' + str(z)][:], f2['values_' + str(z)][:],
+                    equal_nan=True))
+                assert(np.array_equal(f1['nan_values_' + str(z)][:], f2['nan_values_' + str(z)][:]))
+
+def test_bedgraph_num_workers_tabix(tmpdir):
+    pysam = pytest.importorskip('pysam')
+    input_file = op.join(testdir, 'sample_data', 'dm3_values.tsv')
+
+    # tabix needs tab separated lines sorted by chromosome and position
+    with open(input_file, 'r') as f:
+        rows = sorted([line.split() for line in f], key=lambda r: (r[0], int(r[1])))
+
+    sorted_file = str(tmpdir.join('dm3_values.bedgraph'))
+    with open(sorted_file, 'w') as f:
+        f.write(''.join(['\t'.join(row) + '\n' for row in rows]))
+
+    indexed_file = pysam.tabix_index(sorted_file, preset='bed', keep_original=True)
+
+    # every worker seeks to its own chromosome in the indexed file
+    output_files = []
+    for (filepath, num_workers) in [(sorted_file, 1), (indexed_file, 3)]:
+        output_files += [str(tmpdir.join('{}.hitile'.format(num_workers)))]
+        ccag._bedgraph(filepath, output_files[-1], 'dm3', 1, 2, 3, 4, False, None, 1024,
+                14, 'sum', None, 'none', False, None, 8, num_workers=num_workers)
+
+    with h5py.File(output_files[0], 'r') as f1:
+        with h5py.File(output_files[1], 'r') as f2:
+            for z in range(0, int(f1['meta'].attrs['max-zoom']) + 1, 8):
+                assert(np.array_equal(f1['values_' + str(z)][:], f2['values_' + str(z)][:],
+                    equal_nan=True))
+                assert(np.array_equal(f1['nan_values_' + str(z)][:], f2['nan_values_' + str(z)][:]))
+
+def test_bedgraph_num_workers_chromosome_boundary(tmpdir):
+    chromsizes_file = str(tmpdir.join('boundary.chromSizes'))
+    input_file = str(tmpdir.join('boundary.bedgraph'))
+    output_file = str(tmpdir.join('boundary.hitile'))
+
+    with open(chromsizes_file, 'w') as f:
+        f.write('chr1\t50000\nchr2\t30000\n')
+
+    # chr1 ends with a gap and chr2 starts at its first base
+    with open(input_file, 'w') as f:
+        f.write('chr1\t1000\t40000\t1\n')
+        f.write('chr2\t0\t30000\t2\n')
+
+    ccag._bedgraph(input_file, output_file, 'hg19', 1, 2, 3, 4, False, None, 1024, 2,
+            'sum', None, 'none', False, chromsizes_file, 8, num_workers=2)
+
+    # each worker only writes the values of its own chromosome
+    with h5py.File(output_file, 'r') as f:
+        values = f['values_0'][:]
+        nan_values = f['nan_values_0'][:]
+
+    assert(np.isnan(values[40000:50000]).all())
+    assert((nan_values[40000:50000] == 1).all())
+    assert((values[50000:80000] == 2).all())
+
+    # lines on chromosomes that aren't in the assembly are an error, like
+    # they are with one worker
+    with open(input_file, 'a') as f:
+        f.write('chr3\t0\t1000\t3\n')
+
+    for num_workers in [1, 2]:
+        try:
+            ccag._bedgraph(input_file, output_file, 'hg19', 1, 2, 3, 4, False, None, 1024,
+                    2, 'sum', None, 'none', False, chromsizes_file, 8, num_workers=num_workers)
+            assert(False)
+        except KeyError:
+            pass
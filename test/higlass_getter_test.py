@@ -0,0 +1,133 @@
+from __future__ import print_function
+
+import clodius.higlass_getter as chg
+import cooler
+import numpy as np
+import os.path as op
+
+testdir = op.realpath(op.dirname(__file__))
+cooler_file = op.join(testdir, 'sample_data', 'Dixon2012-J1-NcoI-R1-filtered.1000kb.cool')
+
+def test_chrominfo_from_cooler():
+    c = cooler.Cooler(cooler_file)
+    chrominfo = chg.get_chrominfo(c)
+
+    assert(chrominfo.chromosomes[0] == 'chr1')
+    assert(chrominfo.total_length == c.chroms()[:]['length'].sum())
+
+    # the chromosome sizes should only be loaded once
+    assert(chg.get_chrominfo(c) is chrominfo)
+
+def test_abs_coord_2_bin():
+    c = cooler.Cooler(cooler_file)
+    chrominfo = chg.get_chrominfo(c)
+
+    positions = np.linspace(0, chrominfo.total_length - 1, 1000).astype(int)
+    bins = chg.absCoord2bin(c, positions)
+
+    for pos, b in zip(positions, bins):
+        cid = np.flatnonzero(chrominfo.cumul_lengths > pos)[0] - 1
+        chrom = chrominfo.chromosomes[cid]
+        rel_pos = int(pos - chrominfo.cumul_lengths[cid])
+
+        assert(b == c.offset((chrom, rel_pos, int(chrominfo.chromsizes[chrom]))))
+
+    # positions past the end of the genome map to the number of bins
+    assert(chg.absCoord2bin(c, chrominfo.total_length + 10) == c.info['nbins'])
+
+    i0, i1, j0, j1 = chg.get_bin_ranges(c, 0, 5e6, 1e8, 2e8)
+    assert((i0, i1, j0, j1) == (0, 5, 100, 200))
+
+def test_get_tile_bins():
+    c = cooler.Cooler(cooler_file)
+    binsize = int(c.info['bin-size'])
+    bins_per_dimension = 256
+
+    (i, j, v) = chg.getTileBins({'cooler': c}, 0, 0, binsize * bins_per_dimension,
+                                0, binsize * bins_per_dimension, bins_per_dimension)
+    assert(len(i) == len(j) == len(v))
+    assert(v.dtype == np.float32)
+
+    dense = chg.binsToDenseTile(i, j, v, bins_per_dimension)
+    assert(len(dense) == bins_per_dimension ** 2)
+
+    # bins within the first chromosome line up exactly with the cooler's bins
+    n = int(c.chroms()[:]['length'][0] // binsize)
+    expected = np.nan_to_num(c.matrix(balance=True)[:n, :n])
+    tile = dense.reshape((bins_per_dimension, bins_per_dimension)).T[:n, :n]
+
+    assert(np.allclose(tile, expected))
+
+def test_bin_offsets_by_name():
+    c = cooler.Cooler(cooler_file)
+    chroms = c.chroms()[:]
+
+    # an assembly with a chromosome that the cooler doesn't have, and
+    # without the cooler's last chromosome
+    names = [chroms['name'][0], 'chrExtra'] + list(chroms['name'][1:-1])
+    lengths = [chroms['length'][0], 5000000] + list(chroms['length'][1:-1])
+    chrominfo = chg.ChromInfo(names, lengths)
+
+    for (chrom, length) in zip(chroms['name'][1:-1], chroms['length'][1:-1]):
+        cid = names.index(chrom)
+
+        for rel_pos in [0, length // 2, length - 1]:
+            pos = chrominfo.cumul_lengths[cid] + rel_pos
+            b = chg.absCoord2bin(c, pos, chrominfo)
+
+            assert(b == c.offset((chrom, rel_pos, int(length))))
+            assert(chrominfo.bin_to_abs_coord(np.array([b]), c)[0] <= pos)
+
+    # positions on the missing chromosome don't have any bins
+    assert(chg.absCoord2bin(c, chrominfo.cumul_lengths[1] + 100, chrominfo) ==
+            c.offset(chroms['name'][1]))
+
+    try:
+        chrominfo.chrom_codes([chroms['name'][0], chroms['name'].iloc[-1]])
+        assert(False)
+    except KeyError:
+        pass
+
+    # the bins can't be looked up if the chromosomes are in a different order
+    reordered = chg.ChromInfo(list(chroms['name'][::-1]), list(chroms['length'][::-1]))
+
+    try:
+        chg.absCoord2bin(c, 0, reordered)
+        assert(False)
+    except ValueError:
+        pass
+
+def test_bins_to_dense_tile_sums_duplicates():
+    i = np.array([0, 1, 0])
+    j = np.array([0, 1, 0])
+    v = np.array([1, 2, 3], dtype=np.float32)
+
+    dense = chg.binsToDenseTile(i, j, v, 2)
+
+    assert(list(dense) == [4, 0, 0, 2])
+
+def test_annotate_pixels_missing_chromosome():
+    c = cooler.Cooler(cooler_file)
+    chroms = c.chroms()[:]
+    bins = c.bins()[:]
+
+    # an assembly without the cooler's second chromosome
+    names = [chroms['name'][0]] + list(chroms['name'][2:])
+    lengths = [chroms['length'][0]] + list(chroms['length'][2:])
+    chrominfo = chg.ChromInfo(names, lengths)
+
+    # a window from the first chromosome into the third, which covers all of
+    # the cooler's second chromosome
+    end = chrominfo.cumul_lengths[2]
+    (i0, i1, j0, j1) = chg.get_bin_ranges(c, 0, end, 0, end, chrominfo)
+
+    pixels = c.pixels()[:]
+    pixels = pixels[(pixels['bin1_id'] >= i0) & (pixels['bin1_id'] < i1) &
+            (pixels['bin2_id'] >= j0) & (pixels['bin2_id'] < j1)]
+    on_missing = (bins['chrom'][pixels['bin1_id']].values == chroms['name'][1]) | \
+            (bins['chrom'][pixels['bin2_id']].values == chroms['name'][1])
+
+    annotated = chg.annotatePixels(c, pixels, min(i0, j0), max(i1, j1), chrominfo)
+
+    assert(len(annotated) == (~on_missing).sum())
+    assert(annotated['genome_start'].max() < end)
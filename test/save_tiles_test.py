@@ -0,0 +1,105 @@
+from __future__ import print_function
+
+import base64
+import clodius.save_tiles as cst
+import numpy as np
+
+def test_encode_dense_values():
+    values = np.array([0, 1.5, np.nan, 100.25, -3], dtype=np.float32)
+
+    encoded = cst.encode_dense_values(values, 'json')
+    assert(encoded['dense'][1] == 1.5)
+
+    encoded = cst.encode_dense_values(values, 'float32')
+    decoded = np.frombuffer(base64.b64decode(encoded['dense']), dtype='<f4')
+    assert(np.isnan(decoded[2]))
+    assert(all(decoded[[0,1,3,4]] == values[[0,1,3,4]]))
+
+    encoded = cst.encode_dense_values(values, 'float16')
+    decoded = np.frombuffer(base64.b64decode(encoded['dense']), dtype='<f2')
+    assert(np.allclose(decoded, values, equal_nan=True))
+
+    encoded = cst.encode_dense_values(values, 'fixed')
+    fixed = np.frombuffer(base64.b64decode(encoded['dense']), dtype='<u2')
+    decoded = encoded['fixed_min'] + fixed * (encoded['fixed_max'] - encoded['fixed_min']) / 65534.
+
+    assert(fixed[2] == 65535)
+    assert(np.allclose(decoded[[0,1,3,4]], values[[0,1,3,4]], atol=0.01))
+
+def test_encode_float16_clipping():
+    import warnings
+
+    values = np.array([1e6, -70000, 3, np.inf, np.nan], dtype=np.float32)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        encoded = cst.encode_dense_values(values, 'float16')
+
+    decoded = np.frombuffer(base64.b64decode(encoded['dense']), dtype='<f2')
+
+    # only the finite values that don't fit are clipped
+    assert(len(caught) == 1)
+    assert(list(decoded[:4]) == [65504, -65504, 3, np.inf])
+    assert(np.isnan(decoded[4]))
+
+def test_save_tile_array_encoding():
+    saved = []
+
+    class ListTileSaver(cst.TileSaver):
+        def save_tile(self, tile):
+            saved.append(tile)
+
+    tile_saver = ListTileSaver(10, 4, 2, encoding='float16')
+    tile_saver.save_tile_array(1, (0, 1), np.arange(16, dtype=np.float32))
+
+    tile_value = saved[0]['tile_value']
+    assert(saved[0]['tile_id'] == '1.0.1')
+    assert(tile_value['dtype'] == 'float16')
+    assert(tile_value['max_value'] == 15)
+    assert(len(base64.b64decode(tile_value['dense'])) == 16 * 2)
+
+def test_save_binned_tile_dense():
+    saved = []
+
+    class ListTileSaver(cst.TileSaver):
+        def save_tile(self, tile):
+            saved.append(tile)
+
+    tile_saver = ListTileSaver(2, 4, 2, initial_value=[0.])
+    tile_bins = {(1, 0): np.array([1.]), (0, 2): np.array([2.]), (3, 3): np.array([3.])}
+    tile_saver.save_binned_tile(0, (0, 0), tile_bins)
+
+    tile_value = saved[0]['tile_value']
+    dense = tile_value['dense']
+
+    # the first dimension varies fastest
+    assert(dense[1] == 1.)
+    assert(dense[2 * 4] == 2.)
+    assert(dense[3 + 3 * 4] == 3.)
+    assert(sum(dense) == 6.)
+    assert(tile_value['min_value'] == [1.])
+    assert(tile_value['max_value'] == [3.])
+
+def test_save_binned_tile_coo():
+    saved = []
+
+    class ListTileSaver(cst.TileSaver):
+        def save_tile(self, tile):
+            saved.append(tile)
+
+    tile_bins = {(1, 0): np.array([1.]), (0, 2): np.array([2.]), (3, 3): np.array([3.])}
+    bin_positions = np.array(list(tile_bins.keys()))
+    values = np.array([v[0] for v in tile_bins.values()])
+
+    # COO tiles are stored the same way as dictionaries of bins, and are
+    # only sparse when they have fewer than max_data_in_sparse values
+    for max_data_in_sparse in [2, 10]:
+        tile_saver = ListTileSaver(max_data_in_sparse, 4, 2, initial_value=[0.])
+        tile_saver.save_binned_tile(0, (0, 0), tile_bins)
+        tile_saver.save_binned_tile(0, (0, 0), (bin_positions, values))
+
+        assert(saved[-2]['tile_value'] == saved[-1]['tile_value'])
+
+    assert('dense' in saved[0]['tile_value'])
+    assert('sparse' in saved[2]['tile_value'])
+    assert(saved[2]['tile_value']['sparse'][0] == [[1., 0.], 1.])
@@ -0,0 +1,75 @@
+from __future__ import print_function
+
+import click.testing as clt
+import clodius.cli.aggregate as cca
+import clodius.stats as cs
+import json
+import os.path as op
+import time
+
+def test_nested_timers():
+    stats = cs.AggregationStats('test')
+
+    with stats.timer('parse'):
+        time.sleep(0.02)
+        with stats.timer('hdf5_write'):
+            time.sleep(0.05)
+
+    # time spent in the inner stage isn't counted towards the outer one
+    assert(0.02 <= stats.timers['parse'] < 0.05)
+    assert(stats.timers['hdf5_write'] >= 0.05)
+
+def test_stats_file(tmpdir):
+    stats_file = str(tmpdir.join('test.stats.jsonl'))
+    stats = cs.AggregationStats('test', stats_file, interval=0)
+
+    for i in range(3):
+        stats.add(rows=1, bytes=10)
+        stats.report(position=i)
+    stats.close()
+
+    with open(stats_file, 'r') as f:
+        lines = [json.loads(line) for line in f]
+
+    assert(len(lines) == 4)
+    assert(lines[0]['position'] == 0)
+    assert(lines[-1]['finished'])
+    assert(lines[-1]['rows'] == 3)
+    assert(lines[-1]['bytes'] == 30)
+    assert('other' in lines[-1]['stages'])
+
+def test_log(tmpdir):
+    stats_file = str(tmpdir.join('test.stats.jsonl'))
+
+    # without a stats file nothing is written
+    cs.AggregationStats('test').log('chrom_order:', ['chr1'])
+
+    stats = cs.AggregationStats('test', stats_file)
+    stats.log('chrom_order:', ['chr1'])
+    stats.close()
+
+    with open(stats_file, 'r') as f:
+        lines = [json.loads(line) for line in f]
+
+    assert(lines[0]['message'] == "chrom_order: ['chr1']")
+    assert(lines[-1]['finished'])
+
+def test_quiet_by_default(tmpdir):
+    testdir = op.realpath(op.dirname(__file__))
+    runner = clt.CliRunner()
+
+    runs = [
+            (cca.bedfile, op.join(testdir, 'sample_data', 'geneAnnotationsExonsUnions.hg19.short.bed'),
+                ['--importance-column', 5, '--delimiter', '\t']),
+            (cca.bedgraph, op.join(testdir, 'sample_data', 'dm3_values.tsv'),
+                ['--assembly', 'dm3']),
+            (cca.bigwig, op.join(testdir, 'sample_data', 'test1.bw'),
+                ['--chromsizes-filename', op.join(testdir, 'sample_data', 'test.mr.chromSizes')])
+            ]
+
+    for (i, (command, input_file, args)) in enumerate(runs):
+        result = runner.invoke(command,
+                [input_file, '--output-file', str(tmpdir.join('out.{}'.format(i)))] + args)
+
+        assert(result.exit_code == 0)
+        assert(result.output == '')